@@ -0,0 +1,75 @@
+"""Measure the memory used by activities held in memory (like a timeline).
+
+    python benchmarks/memory.py [count]
+
+It only relies on the original API, so it can be run against older versions too. With 20k Create activities (and
+their Note): 1169 bytes per activity before the slotted representation, 697 after.
+"""
+import contextlib
+import gc
+import os
+import sys
+import tracemalloc
+
+import little_boxes.activitypub as ap
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tests"))
+from test_backend import InMemBackend  # noqa: E402
+
+ACTOR = {
+    "type": "Person",
+    "id": "https://lol.com/users/bob",
+    "inbox": "https://lol.com/users/bob/inbox",
+    "outbox": "https://lol.com/users/bob/outbox",
+    "preferredUsername": "bob",
+}
+
+
+def _payload(i):
+    # Built from scratch, like a payload decoded from the database
+    return {
+        "@context": [
+            "https://www.w3.org/ns/activitystreams",
+            "https://w3id.org/security/v1",
+            {"Hashtag": "as:Hashtag", "sensitive": "as:sensitive"},
+        ],
+        "type": "Create",
+        "id": f"https://lol.com/outbox/{i}/activity",
+        "actor": ACTOR["id"],
+        "published": "2018-05-21T15:51:59Z",
+        "to": ["https://www.w3.org/ns/activitystreams#Public"],
+        "object": {
+            "type": "Note",
+            "id": f"https://lol.com/outbox/{i}",
+            "attributedTo": ACTOR["id"],
+            "content": f"<p>Hello {i}</p>",
+            "published": "2018-05-21T15:51:59Z",
+            "to": ["https://www.w3.org/ns/activitystreams#Public"],
+        },
+    }
+
+
+def main(count: int) -> None:
+    back = InMemBackend()
+    back.FETCH_MOCK[ACTOR["id"]] = ACTOR
+    ap.use_backend(back)
+    payloads = [_payload(i) for i in range(count)]
+
+    # Older versions have no operations (the fetched objects are not shared)
+    operation = getattr(ap, "operation", contextlib.nullcontext)
+
+    gc.collect()
+    tracemalloc.start()
+    with operation():
+        activities = [ap.parse_activity(p) for p in payloads]
+        for activity in activities:
+            activity.get_object()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{count} activities: {size / count:.0f} bytes per activity")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
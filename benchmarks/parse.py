@@ -0,0 +1,144 @@
+"""Measure the `parse_activity` throughput on a corpus of typical (untrusted) payloads.
+
+    python benchmarks/parse.py [rounds]
+"""
+import os
+import sys
+import time
+
+import little_boxes.activitypub as ap
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tests"))
+from test_backend import InMemBackend  # noqa: E402
+
+CTX = [
+    "https://www.w3.org/ns/activitystreams",
+    "https://w3id.org/security/v1",
+    {"Hashtag": "as:Hashtag", "sensitive": "as:sensitive"},
+]
+PUBLIC = "https://www.w3.org/ns/activitystreams#Public"
+
+BOB = {
+    "type": "Person",
+    "id": "https://lol.com/users/bob",
+    "inbox": "https://lol.com/users/bob/inbox",
+    "outbox": "https://lol.com/users/bob/outbox",
+    "preferredUsername": "bob",
+}
+ALICE = {
+    "type": "Person",
+    "id": "https://mastodon.social/users/alice",
+    "inbox": "https://mastodon.social/users/alice/inbox",
+    "outbox": "https://mastodon.social/users/alice/outbox",
+    "endpoints": {"sharedInbox": "https://mastodon.social/inbox"},
+    "preferredUsername": "alice",
+}
+
+NOTE = {
+    "type": "Note",
+    "id": "https://mastodon.social/users/alice/statuses/1",
+    "attributedTo": ALICE["id"],
+    "content": "<p>Hello</p>",
+    "published": "2018-05-21T15:51:59Z",
+    "sensitive": False,
+    "to": [PUBLIC],
+    "cc": [ALICE["id"] + "/followers", BOB["id"]],
+    "tag": [{"type": "Mention", "href": BOB["id"], "name": "@bob@lol.com"}],
+}
+FOLLOW = {
+    "@context": CTX,
+    "type": "Follow",
+    "id": "https://mastodon.social/follows/1",
+    "actor": ALICE["id"],
+    "object": BOB["id"],
+}
+
+CORPUS = [
+    {
+        "@context": CTX,
+        "type": "Create",
+        "id": NOTE["id"] + "/activity",
+        "actor": ALICE["id"],
+        "published": "2018-05-21T15:51:59Z",
+        "to": [PUBLIC],
+        "cc": NOTE["cc"],
+        "object": NOTE,
+    },
+    {
+        "@context": CTX,
+        "type": "Update",
+        "id": NOTE["id"] + "#updates/1",
+        "actor": ALICE["id"],
+        "to": [PUBLIC],
+        "object": NOTE,
+    },
+    {
+        "@context": CTX,
+        "type": "Delete",
+        "id": NOTE["id"] + "#delete",
+        "actor": ALICE["id"],
+        "to": [PUBLIC],
+        "object": {"type": "Tombstone", "id": NOTE["id"]},
+    },
+    {
+        "@context": CTX,
+        "type": "Like",
+        "id": ALICE["id"] + "#likes/1",
+        "actor": ALICE["id"],
+        "object": "https://lol.com/outbox/1",
+    },
+    {
+        "@context": CTX,
+        "type": "Announce",
+        "id": ALICE["id"] + "/statuses/2/activity",
+        "actor": ALICE["id"],
+        "published": "2018-05-21T15:51:59Z",
+        "to": [PUBLIC],
+        "cc": [BOB["id"]],
+        "object": "https://lol.com/outbox/1",
+    },
+    FOLLOW,
+    {
+        "@context": CTX,
+        "type": "Undo",
+        "id": FOLLOW["id"] + "/undo",
+        "actor": ALICE["id"],
+        "object": {k: v for k, v in FOLLOW.items() if k != "@context"},
+    },
+    {
+        "@context": CTX,
+        "type": "Accept",
+        "id": BOB["id"] + "#accepts/1",
+        "actor": BOB["id"],
+        "object": {k: v for k, v in FOLLOW.items() if k != "@context"},
+    },
+    dict(ALICE, **{"@context": CTX}),
+]
+
+
+def main(rounds: int) -> None:
+    back = InMemBackend()
+    for actor in [BOB, ALICE]:
+        back.FETCH_MOCK[actor["id"]] = actor
+    ap.use_backend(back)
+
+    with ap.operation():
+        # Warm up the identity map (the actors are only fetched once)
+        for payload in CORPUS:
+            ap.parse_activity(payload)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for payload in CORPUS:
+                ap.parse_activity(payload)
+        elapsed = time.perf_counter() - start
+
+    count = rounds * len(CORPUS)
+    print(
+        f"{count} activities in {elapsed:.2f}s: {count / elapsed:.0f} activities/s "
+        f"({elapsed / count * 1e6:.1f}us per activity)"
+    )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
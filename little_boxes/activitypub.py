@@ -1,22 +1,47 @@
 """Core ActivityPub classes."""
+import copy
 import json
 import logging
+import threading
 import weakref
+from contextlib import contextmanager
 from datetime import datetime
 from enum import Enum
+from types import MappingProxyType
 from typing import Any
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Mapping
 from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import Type
 from typing import Union
 
 from .backend import Backend
-from .collection import parse_collection
+from .blocklist import Blocklist
+from .cache import LRUCache
+from .circuit import HostUnavailableError
+from .collection import iter_collection
+from .concurrency import guarded
+from .concurrency import resolver_pool
+from .concurrency import use_circuit_breaker  # noqa: F401
+from .delivery import DeliveryBatch
+from .delivery import DeliveryEngine
+from .delivery import DeliveryPlan
+from .delivery import DeliveryPlanner
+from .delivery_queue import DeliveryQueue
+from .delivery_queue import QueuedDelivery
 from .errors import BadActivityError
 from .errors import Error
 from .errors import NotFromOutboxError
 from .errors import UnexpectedActivityTypeError
+from .routing import ACTOR_TYPES
+from .routing import Route
+from .routing import RoutingIndex
+from .routing import route_from_actor
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +53,13 @@ ObjectOrIDType = Union[str, ObjectType]
 
 CTX_AS = "https://www.w3.org/ns/activitystreams"
 CTX_SECURITY = "https://w3id.org/security/v1"
+
+# Default @context, shared by every activity using it (it must never be mutated in place)
+DEFAULT_CTX = [
+    CTX_AS,
+    CTX_SECURITY,
+    {"Hashtag": "as:Hashtag", "sensitive": "as:sensitive"},
+]
 AS_PUBLIC = "https://www.w3.org/ns/activitystreams#Public"
 
 COLLECTION_CTX = [
@@ -38,9 +70,32 @@ COLLECTION_CTX = [
 
 # Will be used to keep track of all the defined activities
 _ACTIVITY_CLS: Dict["ActivityType", Type["BaseActivity"]] = {}
+# Same as above, but keyed by the raw `type` value (to skip the enum conversion)
+_ACTIVITY_CLS_BY_TYPE: Dict[str, Type["BaseActivity"]] = {}
 
 BACKEND: Optional[Backend] = None
 
+# Optional cache of fetched objects shared across operations
+OBJECT_CACHE: Optional[LRUCache] = None
+
+# Optional index of the actors inbox/sharedInbox, filled every time an actor is fetched
+ROUTING_INDEX: Optional[RoutingIndex] = None
+
+# Optional blocklist, checked against the raw actor IRI before the backend `outbox_is_blocked`
+BLOCKLIST: Optional[Blocklist] = None
+
+# The backend is not asked anymore when the blocklist is authoritative (seeded with the existing blocks)
+BLOCKLIST_AUTHORITATIVE = False
+
+# Optional engine for delivering activities concurrently (deliveries are sequential without it)
+DELIVERY_ENGINE: Optional[DeliveryEngine] = None
+
+# Turns the resolved recipients into the inboxes to deliver to
+DELIVERY_PLANNER = DeliveryPlanner()
+
+# Optional durable queue the outbox activities are enqueued into (delivered by `DeliveryWorker`s)
+DELIVERY_QUEUE: Optional[DeliveryQueue] = None
+
 
 def get_backend() -> Backend:
     if BACKEND is None:
@@ -53,6 +108,163 @@ def use_backend(backend_instance):
     BACKEND = backend_instance
 
 
+def use_object_cache(cache: Optional[LRUCache]) -> None:
+    """Set the cache used to share fetched actors/objects across operations (`None` to disable it)."""
+    global OBJECT_CACHE
+    OBJECT_CACHE = cache
+
+
+def use_routing_index(index: Optional[RoutingIndex]) -> None:
+    """Set the index used to resolve the actors inboxes without fetching them (`None` to disable it)."""
+    global ROUTING_INDEX
+    ROUTING_INDEX = index
+
+
+def use_blocklist(blocklist: Optional[Blocklist], authoritative: bool = False) -> None:
+    """Set the blocklist, kept up to date by the outbox Block/Undo activities (`None` to only use the backend).
+
+    The actors not blocked by the blocklist are still checked with the backend `outbox_is_blocked`, as the blocks
+    made before the blocklist was set are only known by the backend. Once the blocklist has been seeded with them
+    (with `Blocklist.block_actor`), `authoritative` can be set to skip the backend.
+    """
+    global BLOCKLIST
+    global BLOCKLIST_AUTHORITATIVE
+    BLOCKLIST = blocklist
+    BLOCKLIST_AUTHORITATIVE = authoritative and blocklist is not None
+
+
+def use_delivery_engine(engine: Optional[DeliveryEngine]) -> None:
+    """Set the engine used to fan-out outbox activities (`None` to deliver sequentially)."""
+    global DELIVERY_ENGINE
+    DELIVERY_ENGINE = engine
+
+
+def use_delivery_planner(planner: DeliveryPlanner) -> None:
+    global DELIVERY_PLANNER
+    DELIVERY_PLANNER = planner
+
+
+def use_delivery_queue(queue: Optional[DeliveryQueue]) -> None:
+    """Set the queue the outbox activities are enqueued into (takes precedence over the delivery engine)."""
+    global DELIVERY_QUEUE
+    DELIVERY_QUEUE = queue
+
+
+def _post_to_remote_inbox(as_actor: "Person", payload: str, recp: str) -> None:
+    backend = get_backend()
+    guarded(recp, lambda: backend.post_to_remote_inbox(as_actor, payload, recp))
+
+
+def _delivery_plan(actor_id: str, recipients: List[Any]) -> DeliveryPlan:  # noqa: C901
+    """Resolve the recipients to the inboxes to deliver to, grouped by host (see `DeliveryPlanner`).
+
+    Actors (and collections members) are looked up in the routing index first, the unknown ones are fetched
+    concurrently, using at most `concurrency.RESOLVER_MAX_WORKERS` threads.
+    """
+    idmap = _identity_map()
+    targets: List[Tuple[str, Optional[Route]]] = []
+
+    def _add(actor_id: str, route: Optional[Route]) -> None:
+        targets.append((actor_id, route))
+
+    def _lookup(iri: str) -> Union[Route, ObjectType, None]:
+        if ROUTING_INDEX is not None:
+            route = ROUTING_INDEX.get(iri)
+            if route is not None:
+                return route
+        try:
+            return idmap.fetch(iri)
+        except HostUnavailableError:
+            logger.warning(f"skipping {iri!r}, its host is unavailable")
+            return None
+
+    def _get_member_route(item: str) -> Optional[Route]:
+        try:
+            raw_actor = idmap.fetch(item)
+        except HostUnavailableError:
+            logger.warning(f"skipping {item!r}, its host is unavailable")
+            return None
+        route = route_from_actor(raw_actor)
+        if route is None:
+            logger.error(f"failed to fetch actor {item!r}")
+        return route
+
+    iris: List[str] = []
+    for recipient in recipients:
+        # if recipient in PUBLIC_INSTANCES:
+        #    if recipient not in out:
+        #        out.append(str(recipient))
+        #    continue
+        if recipient in [actor_id, AS_PUBLIC, None]:
+            continue
+        if isinstance(recipient, Person):
+            if recipient.id != actor_id:
+                _add(recipient.id, route_from_actor(recipient.view()))
+            continue
+        iris.append(recipient)
+
+    # Deduplicate while keeping the order
+    iris = list(dict.fromkeys(iris))
+    with resolver_pool(len(iris)) as pool:
+        resolved = list(pool.map(_lookup, iris))
+
+    for recipient, raw_actor in zip(iris, resolved):
+        if raw_actor is None:
+            continue
+
+        # The actor is already known by the routing index
+        elif isinstance(raw_actor, Route):
+            _add(recipient, raw_actor)
+
+        elif raw_actor["type"] in ACTOR_TYPES:
+            _add(recipient, route_from_actor(raw_actor))
+
+        # Is the activity a `Collection`/`OrderedCollection`?
+        elif raw_actor["type"] in [
+            ActivityType.COLLECTION.value,
+            ActivityType.ORDERED_COLLECTION.value,
+        ]:
+            members = [
+                item
+                for item in dict.fromkeys(
+                    _get_actor_id(item)
+                    for item in iter_collection(raw_actor, fetcher=idmap.fetch)
+                )
+                if item not in [actor_id, AS_PUBLIC]
+            ]
+            routes: Dict[str, Optional[Route]] = {}
+            if ROUTING_INDEX is not None:
+                routes.update(ROUTING_INDEX.get_many(members))
+            missing = [item for item in members if item not in routes]
+            with resolver_pool(len(missing)) as pool:
+                routes.update(zip(missing, pool.map(_get_member_route, missing)))
+
+            for item in members:
+                _add(item, routes[item])
+        else:
+            raise BadActivityError(f"failed to parse {raw_actor!r}")
+
+    return DELIVERY_PLANNER.plan(targets, ROUTING_INDEX)
+
+
+def resolve_queued(delivery: QueuedDelivery) -> List[str]:
+    """Resolve the recipients of a fan-out job to inboxes, meant to be the `resolve` callback of `DeliveryWorker`."""
+    with operation():
+        return _delivery_plan(delivery.actor_id, delivery.recipients or []).inboxes()
+
+
+def deliver_queued(delivery: QueuedDelivery) -> None:
+    """Perform a delivery from the queue with the backend, meant to be the `post` callback of `DeliveryWorker`."""
+    # The fan-out jobs are resolved by the worker (with `resolve_queued`), only the per-inbox deliveries are posted
+    inbox = delivery.inbox
+    if inbox is None:
+        raise Error("should never happen")
+
+    with operation():
+        as_actor = _identity_map().get_person(delivery.actor_id)
+        _post_to_remote_inbox(as_actor, delivery.payload, inbox)
+
+
 class ActivityType(Enum):
     """Supported activity `type`."""
 
@@ -77,19 +289,32 @@ class ActivityType(Enum):
 
 
 def parse_activity(
-    payload: ObjectType, expected: Optional[ActivityType] = None
+    payload: ObjectType, expected: Optional[ActivityType] = None, trusted: bool = False
 ) -> "BaseActivity":
-    t = ActivityType(payload["type"])
+    """Build an activity from a payload.
+
+    If the payload is `trusted` (like one loaded back from the database), the activity is rehydrated without any
+    validation nor remote requests.
+    """
+    t = payload.get("type")
 
-    if expected and t != expected:
+    if expected and t != expected.value:
         raise UnexpectedActivityTypeError(
-            f'expected a {expected.name} activity, got a {payload["type"]}'
+            f"expected a {expected.name} activity, got a {t}",
+            payload={"field": "type", "reason": "unexpected_type", "got": t},
+        )
+
+    cls = _ACTIVITY_CLS_BY_TYPE.get(t) if isinstance(t, str) else None
+    if cls is None:
+        raise BadActivityError(
+            f"unsupported activity type {t}",
+            payload={"field": "type", "reason": "unsupported_type", "got": t},
         )
 
-    if t not in _ACTIVITY_CLS:
-        raise BadActivityError(f'unsupported activity type {payload["type"]}')
+    if trusted:
+        return cls.rehydrate(payload)
 
-    activity = _ACTIVITY_CLS[t](**payload)
+    activity = cls(**payload)
 
     return activity
 
@@ -104,16 +329,35 @@ def _to_list(data: Union[List[Any], Any]) -> List[Any]:
 
 def clean_activity(activity: ObjectType) -> Dict[str, Any]:
     """Clean the activity before rendering it.
-     - Remove the hidden bco and bcc field
+    - Remove the hidden bco and bcc field
     """
     for field in ["bto", "bcc"]:
         if field in activity:
-            del (activity[field])
+            del activity[field]
         if activity["type"] == "Create" and field in activity["object"]:
-            del (activity["object"][field])
+            del activity["object"][field]
     return activity
 
 
+def _build_ctx(ctx: Any) -> Any:
+    """Returns the @context of an activity (with the security context and the extra terms), without modifying
+    the given one."""
+    if ctx is DEFAULT_CTX:
+        return ctx
+    ctx = list(ctx) if isinstance(ctx, list) else [ctx]
+    if CTX_SECURITY not in ctx:
+        ctx.append(CTX_SECURITY)
+    if isinstance(ctx[-1], dict):
+        ctx[-1] = dict(ctx[-1], Hashtag="as:Hashtag", sensitive="as:sensitive")
+    else:
+        ctx.append({"Hashtag": "as:Hashtag", "sensitive": "as:sensitive"})
+
+    # Share a single copy of the default context across activities
+    if ctx == DEFAULT_CTX:
+        return DEFAULT_CTX
+    return ctx
+
+
 def _get_actor_id(actor: ObjectOrIDType) -> str:
     """Helper for retrieving an actor `id`."""
     if isinstance(actor, dict):
@@ -121,10 +365,268 @@ def _get_actor_id(actor: ObjectOrIDType) -> str:
     return actor
 
 
+def _payload_actor_iri(payload: Mapping[str, Any]) -> Optional[str]:
+    """Returns the IRI of the actor of a raw payload (the author for a Note), without fetching it."""
+    actor = payload.get("actor") or payload.get("attributedTo")
+    if isinstance(actor, list) and len(actor) == 1:
+        actor = actor[0]
+    if isinstance(actor, dict):
+        actor = actor.get("id")
+    if isinstance(actor, str):
+        return actor
+    return None
+
+
+def is_blocked(as_actor: "Person", actor_iri: str) -> bool:
+    """Returns True if the activities of the given actor must be dropped (it doesn't fetch anything)."""
+    if BLOCKLIST is not None:
+        if BLOCKLIST.is_blocked(as_actor.id, actor_iri):
+            return True
+        if BLOCKLIST_AUTHORITATIVE:
+            return False
+    return get_backend().outbox_is_blocked(as_actor, actor_iri)
+
+
+# Collections change too often to be shared across operations
+_UNCACHEABLE_TYPES = {
+    "Collection",
+    "OrderedCollection",
+    "CollectionPage",
+    "OrderedCollectionPage",
+}
+
+
+class IdentityMap(object):
+    """Keep track of the objects fetched during a single inbox/outbox operation, so each IRI is fetched and
+    parsed at most once (optionally backed by a cache shared across operations).
+
+    The raw objects are copied when they go in or out of the shared cache, and before being parsed, so an
+    activity modifying its fields (like `Create` setting the `attributedTo` of its object) can't leak into the
+    cache or into the raw objects."""
+
+    def __init__(
+        self,
+        cache: Optional[LRUCache] = None,
+        routing_index: Optional[RoutingIndex] = None,
+    ) -> None:
+        self.cache = cache
+        self.routing_index = routing_index
+        self._raw: Dict[str, ObjectType] = {}
+        self._parsed: Dict[str, "BaseActivity"] = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, iri: str) -> Optional[ObjectType]:
+        """Returns the raw object for the given IRI if it's already known (without fetching it)."""
+        with self._lock:
+            if iri in self._raw:
+                self.hits += 1
+                return self._raw[iri]
+
+        data = None
+        if self.cache is not None:
+            data = self.cache.get(iri)
+        if data is None:
+            return None
+
+        with self._lock:
+            self.hits += 1
+            return self._raw.setdefault(iri, copy.deepcopy(data))
+
+    def add(self, iri: str, data: ObjectType) -> ObjectType:
+        """Register an object that was just fetched from the remote server."""
+        with self._lock:
+            self.misses += 1
+        if self.routing_index is not None and isinstance(data, dict):
+            self.routing_index.update_from_actor(data, iri)
+        if (
+            self.cache is not None
+            and isinstance(data, dict)
+            and data.get("type") not in _UNCACHEABLE_TYPES
+        ):
+            self.cache.set(iri, copy.deepcopy(data))
+
+        with self._lock:
+            return self._raw.setdefault(iri, data)
+
+    def fetch(self, iri: str) -> ObjectType:
+        """Returns the raw object for the given IRI, fetching it only if needed."""
+        data = self.lookup(iri)
+        if data is not None:
+            return data
+
+        backend = get_backend()
+        return self.add(iri, guarded(iri, lambda: backend.fetch_iri(iri)))
+
+    def _get_parsed(self, iri: str, parse: Any) -> "BaseActivity":
+        with self._lock:
+            if iri in self._parsed:
+                self.hits += 1
+                return self._parsed[iri]
+
+        obj = parse(copy.deepcopy(self.fetch(iri)))
+        with self._lock:
+            return self._parsed.setdefault(iri, obj)
+
+    def get_person(self, iri: str) -> "Person":
+        """Returns the actor for the given IRI as a `Person`."""
+        person = self._get_parsed(iri, lambda data: Person(**data))
+        if not isinstance(person, Person):
+            raise UnexpectedActivityTypeError(f"{iri} is not a Person")
+        return person
+
+    def get_activity(self, iri: str) -> "BaseActivity":
+        """Returns the object for the given IRI as a `BaseActivity` instance."""
+        return self._get_parsed(iri, parse_activity)
+
+    def invalidate(self, iri: str) -> None:
+        """Forget about the given IRI (like when receiving an `Update` or a `Delete`)."""
+        with self._lock:
+            self._raw.pop(iri, None)
+            self._parsed.pop(iri, None)
+        if self.cache is not None:
+            self.cache.delete(iri)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._raw)}
+
+
+_LOCAL = threading.local()
+
+
+def current_identity_map() -> Optional[IdentityMap]:
+    """Returns the identity map of the operation running in the current thread, if any."""
+    return getattr(_LOCAL, "identity_map", None)
+
+
+@contextmanager
+def operation(identity_map: Optional[IdentityMap] = None) -> Iterator[IdentityMap]:
+    """Scope an inbox/outbox operation, the objects fetched within it are shared by all the activities involved.
+
+    Nested calls re-use the identity map of the outermost operation.
+    """
+    current = current_identity_map()
+    if current is not None:
+        yield current
+        return
+
+    idmap = identity_map or IdentityMap(OBJECT_CACHE, ROUTING_INDEX)
+    _LOCAL.identity_map = idmap
+    try:
+        yield idmap
+    finally:
+        _LOCAL.identity_map = None
+        logger.debug(f"identity map stats: {idmap.stats()}")
+
+
+def _identity_map() -> IdentityMap:
+    """Returns the identity map of the current operation, or a throwaway one when called out of an operation."""
+    idmap = current_identity_map()
+    if idmap is None:
+        return IdentityMap(OBJECT_CACHE, ROUTING_INDEX)
+    return idmap
+
+
+def _invalidate(iri: str) -> None:
+    idmap = current_identity_map()
+    if idmap is not None:
+        idmap.invalidate(iri)
+    if OBJECT_CACHE is not None:
+        OBJECT_CACHE.delete(iri)
+    if ROUTING_INDEX is not None:
+        ROUTING_INDEX.delete(iri)
+
+
+class _ActivityValidator(object):
+    """Validation rules of an activity class, compiled once when the class is registered by `_ActivityMeta`."""
+
+    __slots__ = (
+        "type",
+        "actor_required",
+        "attributed_to",
+        "object_required",
+        "object_id_required",
+        "allowed_object_types",
+        "custom_init",
+    )
+
+    def __init__(self, cls: Type["BaseActivity"]) -> None:
+        activity_type = cls.ACTIVITY_TYPE
+        if activity_type is None:
+            raise Error("should never happen")
+
+        self.type = activity_type.value
+        self.actor_required = (
+            cls.ACTOR_REQUIRED and activity_type != ActivityType.PERSON
+        )
+        # A Note can be attributed to an actor instead
+        self.attributed_to = activity_type == ActivityType.NOTE
+        self.object_required = cls.OBJECT_REQUIRED
+        # The object of a new Create activity has no ID yet
+        self.object_id_required = activity_type != ActivityType.CREATE
+        self.allowed_object_types = frozenset(t.value for t in cls.ALLOWED_OBJECT_TYPES)
+        self.custom_init = cls._init is not BaseActivity._init
+
+    def error(
+        self, exc: Type[Error], message: str, field: str, reason: str, **details: Any
+    ) -> Error:
+        """Build an error with a payload describing the failed check."""
+        payload = {"activity_type": self.type, "field": field, "reason": reason}
+        payload.update(details)
+        return exc(message, payload=payload)
+
+    def check_type(self, type_: Any) -> None:
+        if type_ != self.type:
+            raise self.error(
+                UnexpectedActivityTypeError,
+                f"Expect the type to be {self.type!r}",
+                "type",
+                "unexpected_type",
+                got=type_,
+            )
+
+    def check_object_type(self, type_: Any) -> None:
+        if not isinstance(type_, str) or type_ not in self.allowed_object_types:
+            raise self.error(
+                UnexpectedActivityTypeError,
+                f"unexpected object type {type_} (allowed={sorted(self.allowed_object_types)!r})",
+                "object",
+                "unexpected_type",
+                got=type_,
+                allowed=sorted(self.allowed_object_types),
+            )
+
+    def check_object(self, obj: ObjectType) -> None:
+        if not self.allowed_object_types:
+            raise self.error(
+                UnexpectedActivityTypeError,
+                "unexpected object",
+                "object",
+                "embedded_object",
+            )
+        if "type" not in obj:
+            raise self.error(
+                BadActivityError,
+                "invalid object, missing type",
+                "object",
+                "missing_type",
+            )
+        if self.object_id_required and "id" not in obj:
+            raise self.error(
+                BadActivityError, "invalid object, missing id", "object", "missing_id"
+            )
+        self.check_object_type(obj["type"])
+
+
 class _ActivityMeta(type):
     """Metaclass for keeping track of subclass."""
 
     def __new__(meta, name, bases, class_dict):
+        # The activities of this module don't need an instance dict (`BaseActivity` defines the slots)
+        if class_dict.get("__module__") == __name__:
+            class_dict.setdefault("__slots__", ())
+
         cls = type.__new__(meta, name, bases, class_dict)
 
         # Ensure the class has an activity type defined
@@ -133,113 +635,128 @@ class _ActivityMeta(type):
 
         # Register it
         _ACTIVITY_CLS[cls.ACTIVITY_TYPE] = cls
+        if cls.ACTIVITY_TYPE:
+            _ACTIVITY_CLS_BY_TYPE[cls.ACTIVITY_TYPE.value] = cls
+            cls._VALIDATOR = _ActivityValidator(cls)
         return cls
 
 
 class BaseActivity(object, metaclass=_ActivityMeta):
     """Base class for ActivityPub activities."""
 
-    ACTIVITY_TYPE: Optional[
-        ActivityType
-    ] = None  # the ActivityTypeEnum the class will represent
+    ACTIVITY_TYPE: Optional[ActivityType] = (
+        None  # the ActivityTypeEnum the class will represent
+    )
     OBJECT_REQUIRED = False  # Whether the object field is required or note
     ALLOWED_OBJECT_TYPES: List[ActivityType] = []
     ACTOR_REQUIRED = (
-        True
-    )  # Most of the object requires an actor, so this flag in on by default
+        True  # Most of the object requires an actor, so this flag in on by default
+    )
+
+    # Compiled by `_ActivityMeta`
+    _VALIDATOR: Optional[_ActivityValidator] = None
 
-    def __init__(self, **kwargs) -> None:  # noqa: C901
-        if not self.ACTIVITY_TYPE:
+    __slots__ = ("_data", "__ctx", "__obj", "__trusted", "__weakref__")
+
+    def __init__(self, **kwargs) -> None:
+        validator = self._VALIDATOR
+        if validator is None:
             raise Error("should never happen")
 
-        if kwargs.get("type") and kwargs.pop("type") != self.ACTIVITY_TYPE.value:
-            raise UnexpectedActivityTypeError(
-                f"Expect the type to be {self.ACTIVITY_TYPE.value!r}"
-            )
+        if kwargs.get("type"):
+            validator.check_type(kwargs.pop("type"))
 
         # Initialize the dict that will contains all the activity fields
-        self._data: Dict[str, Any] = {"type": self.ACTIVITY_TYPE.value}
-        logger.debug(f"initializing a {self.ACTIVITY_TYPE.value} activity: {kwargs!r}")
+        self._data: Dict[str, Any] = {"type": validator.type}
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"initializing a {validator.type} activity: {kwargs!r}")
 
         # A place to set ephemeral data
-        self.__ctx: Any = {}
+        self.__ctx: Any = None
+        self.__obj: Optional["BaseActivity"] = None
+        self.__trusted = False
 
         # The id may not be present for new activities
         if "id" in kwargs:
             self._data["id"] = kwargs.pop("id")
 
-        if self.ACTIVITY_TYPE != ActivityType.PERSON and self.ACTOR_REQUIRED:
+        if validator.actor_required:
             actor = kwargs.get("actor")
             if actor:
                 kwargs.pop("actor")
                 actor = self._validate_person(actor)
                 self._data["actor"] = actor
-            elif self.ACTIVITY_TYPE == ActivityType.NOTE:
+            elif validator.attributed_to:
                 if "attributedTo" not in kwargs:
-                    raise BadActivityError(f"Note is missing attributedTo")
+                    raise validator.error(
+                        BadActivityError,
+                        "Note is missing attributedTo",
+                        "attributedTo",
+                        "missing",
+                    )
             else:
-                raise BadActivityError("missing actor")
+                raise validator.error(
+                    BadActivityError, "missing actor", "actor", "missing"
+                )
 
-        if self.OBJECT_REQUIRED and "object" in kwargs:
+        if validator.object_required and "object" in kwargs:
             obj = kwargs.pop("object")
-            if isinstance(obj, str):
-                # The object is a just a reference the its ID/IRI
-                # FIXME(tsileo): fetch the ref
-                self._data["object"] = obj
-            else:
-                if not self.ALLOWED_OBJECT_TYPES:
-                    raise UnexpectedActivityTypeError("unexpected object")
-                if "type" not in obj or (
-                    self.ACTIVITY_TYPE != ActivityType.CREATE and "id" not in obj
-                ):
-                    raise BadActivityError("invalid object, missing type")
-                if ActivityType(obj["type"]) not in self.ALLOWED_OBJECT_TYPES:
-                    raise UnexpectedActivityTypeError(
-                        f'unexpected object type {obj["type"]} (allowed={self.ALLOWED_OBJECT_TYPES!r})'
-                    )
-                self._data["object"] = obj
+            # The object may be a just a reference the its ID/IRI
+            if not isinstance(obj, str):
+                validator.check_object(obj)
+            self._data["object"] = obj
 
-        if "@context" not in kwargs:
-            self._data["@context"] = CTX_AS
-        else:
-            self._data["@context"] = kwargs.pop("@context")
-
-        # @context check
-        if not isinstance(self._data["@context"], list):
-            self._data["@context"] = [self._data["@context"]]
-        if CTX_SECURITY not in self._data["@context"]:
-            self._data["@context"].append(CTX_SECURITY)
-        if isinstance(self._data["@context"][-1], dict):
-            self._data["@context"][-1]["Hashtag"] = "as:Hashtag"
-            self._data["@context"][-1]["sensitive"] = "as:sensitive"
-        else:
-            self._data["@context"].append(
-                {"Hashtag": "as:Hashtag", "sensitive": "as:sensitive"}
-            )
+        self._data["@context"] = _build_ctx(kwargs.pop("@context", CTX_AS))
 
         # FIXME(tsileo): keys required for some subclasses?
         allowed_keys = None
-        try:
-            allowed_keys = self._init(**kwargs)
-            logger.debug("calling custom init")
-        except NotImplementedError:
-            pass
+        if validator.custom_init:
+            try:
+                allowed_keys = self._init(**kwargs)
+                logger.debug("calling custom init")
+            except NotImplementedError:
+                pass
 
         if allowed_keys:
             # Allows an extra to (like for Accept and Follow)
             kwargs.pop("to", None)
-            if len(set(kwargs.keys()) - set(allowed_keys)) > 0:
-                raise BadActivityError(f"extra data left: {kwargs!r}")
+            extra = kwargs.keys() - frozenset(allowed_keys)
+            if extra:
+                raise validator.error(
+                    BadActivityError,
+                    f"extra data left: {kwargs!r}",
+                    "extra",
+                    "unexpected_keys",
+                    keys=sorted(extra),
+                )
         else:
             # Remove keys with `None` value
-            valid_kwargs = {}
-            for k, v in kwargs.items():
-                if v is None:
-                    continue
-                valid_kwargs[k] = v
-            self._data.update(**valid_kwargs)
+            self._data.update({k: v for k, v in kwargs.items() if v is not None})
+
+    @classmethod
+    def rehydrate(cls, payload: ObjectType) -> "BaseActivity":
+        """Rebuild an activity from a trusted payload, without validating it (no remote requests are made).
+
+        The embedded object (returned by `get_object`) is rehydrated the same way.
+        """
+        if not cls.ACTIVITY_TYPE or payload.get("type") != cls.ACTIVITY_TYPE.value:
+            raise UnexpectedActivityTypeError(
+                f"unexpected type {payload.get('type')!r} for {cls.__name__}"
+            )
+
+        activity = cls.__new__(cls)
+        activity._data = {k: v for k, v in payload.items() if v is not None}
+        activity._data["@context"] = _build_ctx(payload.get("@context", CTX_AS))
+        if isinstance(activity._data.get("actor"), dict):
+            activity._data["actor"] = _get_actor_id(activity._data["actor"])
+        activity.__ctx = None
+        activity.__obj = None
+        activity.__trusted = True
+        return activity
 
     def ctx(self) -> Any:
+        if self.__ctx is None:
+            return None
         return self.__ctx()
 
     def set_ctx(self, ctx: Any) -> None:
@@ -260,6 +777,8 @@ class BaseActivity(object, metaclass=_ActivityMeta):
 
     def __getattr__(self, name: str) -> Any:
         """Allow to access the object field as regular attributes."""
+        if name == "_data":
+            raise AttributeError(name)
         if self._data.get(name):
             return self._data.get(name)
 
@@ -293,7 +812,7 @@ class BaseActivity(object, metaclass=_ActivityMeta):
 
         obj_id = self._actor_id(obj)
         try:
-            actor = BACKEND.fetch_iri(obj_id)
+            actor = _identity_map().fetch(obj_id)
         except Exception:
             raise BadActivityError(f"failed to validate actor {obj!r}")
 
@@ -310,30 +829,38 @@ class BaseActivity(object, metaclass=_ActivityMeta):
         if self.__obj:
             return self.__obj
         if isinstance(self._data["object"], dict):
-            p = parse_activity(self._data["object"])
+            p = parse_activity(self._data["object"], trusted=self.__trusted)
         else:
-            obj = BACKEND.fetch_iri(self._data["object"])
-            if ActivityType(obj.get("type")) not in self.ALLOWED_OBJECT_TYPES:
-                raise UnexpectedActivityTypeError(
-                    f'invalid object type {obj.get("type")!r}'
-                )
-            p = parse_activity(obj)
-
-        self.__obj: Optional["BaseActivity"] = p
+            validator = self._VALIDATOR
+            if validator is None:
+                raise Error("should never happen")
+            idmap = _identity_map()
+            obj = idmap.fetch(self._data["object"])
+            validator.check_object_type(obj.get("type"))
+            p = idmap.get_activity(self._data["object"])
+
+        self.__obj = p
         return p
 
     def reset_object_cache(self) -> None:
         self.__obj = None
 
+    def view(self) -> Mapping[str, Any]:
+        """Returns a read-only view of the activity fields (without copying them, unlike `to_dict`)."""
+        return MappingProxyType(self._data)
+
     def to_dict(
         self, embed: bool = False, embed_object_id_only: bool = False
     ) -> ObjectType:
         """Serializes the activity back to a dict, ready to be JSON serialized."""
         data = dict(self._data)
+        if data.get("@context") is DEFAULT_CTX:
+            # The shared default context is copied, so the caller can modify it
+            data["@context"] = [CTX_AS, CTX_SECURITY, dict(DEFAULT_CTX[-1])]
         if embed:
             for k in ["@context", "signature"]:
                 if k in data:
-                    del (data[k])
+                    del data[k]
         if (
             data.get("object")
             and embed_object_id_only
@@ -352,7 +879,10 @@ class BaseActivity(object, metaclass=_ActivityMeta):
         if BACKEND is None:
             raise UninitializedBackendError
 
-        # FIXME(tsileo): cache the actor (same way as get_object)
+        return _identity_map().get_person(self._get_actor_iri())
+
+    def _get_actor_iri(self) -> str:
+        """Returns the IRI of the actor (without fetching it)."""
         actor = self._data.get("actor")
         if not actor and self.ACTOR_REQUIRED:
             # Quick hack for Note objects
@@ -364,8 +894,7 @@ class BaseActivity(object, metaclass=_ActivityMeta):
         if not isinstance(actor, (str, dict)):
             raise BadActivityError(f"invalid actor: {self._data!r}")
 
-        actor_id = self._actor_id(actor)
-        return Person(**BACKEND.fetch_iri(actor_id))
+        return self._actor_id(actor)
 
     def _pre_post_to_outbox(self) -> None:
         raise NotImplementedError
@@ -392,25 +921,36 @@ class BaseActivity(object, metaclass=_ActivityMeta):
         raise NotImplementedError
 
     def process_from_inbox(self, as_actor: "Person") -> None:
-        """Process the message posted to `as_actor` inbox."""
+        """Process the message posted to `as_actor` inbox.
+
+        The activity is already parsed, so its actor was fetched when it was built (unless rehydrated), the block
+        check only spares the processing. Use `Inbox.receive` to drop the blocked actors before any fetch.
+        """
         if BACKEND is None:
             raise UninitializedBackendError
 
+        with operation():
+            self._process_from_inbox_op(as_actor)
+
+    def _process_from_inbox_op(self, as_actor: "Person", triaged: bool = False) -> None:
         logger.debug(f"calling main process from inbox hook for {self}")
-        actor = self.get_actor()
+        backend = get_backend()
+
+        # The block and duplicate checks are already done by the triage
+        if not triaged:
+            # Check for Block activity (before processing the activity)
+            actor_id = self._get_actor_iri()
+            if is_blocked(as_actor, actor_id):
+                # TODO(tsileo): raise ActorBlockedError?
+                logger.info(
+                    f"actor {actor_id} is blocked, dropping the received activity {self!r}"
+                )
+                return
 
-        # Check for Block activity
-        if BACKEND.outbox_is_blocked(as_actor, actor.id):
-            # TODO(tsileo): raise ActorBlockedError?
-            logger.info(
-                f"actor {actor!r} is blocked, dropping the received activity {self!r}"
-            )
-            return
-
-        if BACKEND.inbox_get_by_iri(as_actor, self.id):
-            # The activity is already in the inbox
-            logger.info(f"received duplicate activity {self}, dropping it")
-            return
+            if backend.inbox_get_by_iri(as_actor, self.id):
+                # The activity is already in the inbox
+                logger.info(f"received duplicate activity {self}, dropping it")
+                return
 
         try:
             self._pre_process_from_inbox(as_actor)
@@ -418,7 +958,7 @@ class BaseActivity(object, metaclass=_ActivityMeta):
         except NotImplementedError:
             logger.debug("pre process from inbox hook not implemented")
 
-        BACKEND.inbox_new(as_actor, self)
+        backend.inbox_new(as_actor, self)
         logger.info("activity {self!r} saved")
 
         try:
@@ -427,7 +967,49 @@ class BaseActivity(object, metaclass=_ActivityMeta):
         except NotImplementedError:
             logger.debug("process from inbox hook not implemented")
 
-    def post_to_outbox(self) -> None:
+    def post_to_outbox(self) -> Optional[DeliveryBatch]:
+        """Post the activity to the outbox and deliver it to the recipients.
+
+        Returns the `DeliveryBatch` tracking the deliveries if a delivery engine is used. With a delivery queue,
+        the deliveries are only enqueued (the remote inboxes are not contacted).
+        """
+        if BACKEND is None:
+            raise UninitializedBackendError
+
+        with operation():
+            return self._post_to_outbox_op()
+
+    def _post_to_outbox_op(self) -> Optional[DeliveryBatch]:
+        if DELIVERY_QUEUE is not None:
+            # Only the recipients IRIs are collected here, they're resolved to inboxes by the workers
+            as_actor, payload, recipients = self._outbox_publish(resolve_recipients=False)
+            DELIVERY_QUEUE.enqueue_fan_out(self.id, as_actor.id, payload, recipients)
+            logger.info(f"{self!r} enqueued")
+            return None
+
+        as_actor, payload, recipients = self._outbox_publish()
+
+        if DELIVERY_ENGINE is not None:
+            return DELIVERY_ENGINE.deliver(
+                recipients,
+                lambda recp: _post_to_remote_inbox(as_actor, payload, recp),
+            )
+
+        for recp in recipients:
+            logger.debug(f"posting to {recp}")
+
+            _post_to_remote_inbox(as_actor, payload, recp)
+
+        return None
+
+    def _outbox_publish(
+        self, resolve_recipients: bool = True
+    ) -> Tuple["Person", str, List[str]]:
+        """Save the activity in the outbox, returns the actor, the encoded payload and the recipients.
+
+        If `resolve_recipients` is False, the recipients IRIs are returned instead of their inboxes (and the post to
+        outbox hook gets no recipients).
+        """
         if BACKEND is None:
             raise UninitializedBackendError
 
@@ -445,82 +1027,52 @@ class BaseActivity(object, metaclass=_ActivityMeta):
 
         BACKEND.outbox_new(self.get_actor(), self)
 
-        recipients = self.recipients()
+        # The recipients are collected before the outbox side effects (like a Delete replacing its object with a
+        # Tombstone), and before the hidden bto/bcc fields are removed
+        if resolve_recipients:
+            recipients = self.recipients()
+        else:
+            recipients = self._recipient_iris()
         logger.info(f"recipients={recipients}")
         activity = clean_activity(self.to_dict())
 
         try:
-            self._post_to_outbox(self.get_actor(), obj_id, activity, recipients)
+            self._post_to_outbox(
+                self.get_actor(),
+                obj_id,
+                activity,
+                recipients if resolve_recipients else [],
+            )
             logger.debug(f"called post to outbox hook")
         except NotImplementedError:
             logger.debug("post to outbox hook not implemented")
 
-        payload = json.dumps(activity)
-        for recp in recipients:
-            logger.debug(f"posting to {recp}")
-
-            BACKEND.post_to_remote_inbox(self.get_actor(), payload, recp)
+        return self.get_actor(), json.dumps(activity), recipients
 
     def _recipients(self) -> List[str]:
         return []
 
-    def recipients(self) -> List[str]:  # noqa: C901
-        if BACKEND is None:
-            raise UninitializedBackendError
+    def recipients(self) -> List[str]:
+        return self.delivery_plan().inboxes()
 
-        recipients = self._recipients()
+    def _recipient_iris(self) -> List[str]:
+        """Returns the IRIs of the recipients (actors and collections), without resolving them."""
         actor_id = self.get_actor().id
-
-        out: List[str] = []
-        for recipient in recipients:
-            # if recipient in PUBLIC_INSTANCES:
-            #    if recipient not in out:
-            #        out.append(str(recipient))
-            #    continue
-            if recipient in [actor_id, AS_PUBLIC, None]:
-                continue
+        iris = []
+        for recipient in self._recipients():
             if isinstance(recipient, Person):
-                if recipient.id == actor_id:
-                    continue
-                actor = recipient
-            else:
-                raw_actor = BACKEND.fetch_iri(recipient)
-                if raw_actor["type"] == ActivityType.PERSON.value:
-                    actor = Person(**raw_actor)
-
-                    if actor.endpoints:
-                        shared_inbox = actor.endpoints.get("sharedInbox")
-                        if shared_inbox not in out:
-                            out.append(shared_inbox)
-                            continue
-
-                    if actor.inbox and actor.inbox not in out:
-                        out.append(actor.inbox)
-
-                # Is the activity a `Collection`/`OrderedCollection`?
-                elif raw_actor["type"] in [
-                    ActivityType.COLLECTION.value,
-                    ActivityType.ORDERED_COLLECTION.value,
-                ]:
-                    for item in parse_collection(raw_actor, fetcher=BACKEND.fetch_iri):
-                        if item in [actor_id, AS_PUBLIC]:
-                            continue
-                        try:
-                            col_actor = Person(**BACKEND.fetch_iri(item))
-                        except UnexpectedActivityTypeError:
-                            logger.exception(f"failed to fetch actor {item!r}")
-
-                        if col_actor.endpoints:
-                            shared_inbox = col_actor.endpoints.get("sharedInbox")
-                            if shared_inbox not in out:
-                                out.append(shared_inbox)
-                                continue
-                        if col_actor.inbox and col_actor.inbox not in out:
-                            out.append(col_actor.inbox)
-                else:
-                    raise BadActivityError(f"failed to parse {raw_actor!r}")
+                recipient = recipient.id
+            if recipient not in [actor_id, AS_PUBLIC, None]:
+                iris.append(recipient)
+
+        return list(dict.fromkeys(iris))
 
-        return out
+    def delivery_plan(self) -> DeliveryPlan:
+        """Resolve the recipients to the inboxes to deliver to, grouped by host (see `_delivery_plan`)."""
+        if BACKEND is None:
+            raise UninitializedBackendError
+
+        return _delivery_plan(self.get_actor().id, self._recipients())
 
     def build_undo(self) -> "BaseActivity":
         raise NotImplementedError
@@ -537,9 +1089,24 @@ class Person(BaseActivity):
 
 class Block(BaseActivity):
     ACTIVITY_TYPE = ActivityType.BLOCK
+    ALLOWED_OBJECT_TYPES = [ActivityType.PERSON]
     OBJECT_REQUIRED = True
     ACTOR_REQUIRED = True
 
+    def _post_to_outbox(
+        self,
+        as_actor: "Person",
+        obj_id: str,
+        activity: ObjectType,
+        recipients: List[str],
+    ) -> None:
+        if BLOCKLIST is not None:
+            BLOCKLIST.block_actor(as_actor.id, _get_actor_id(self._data["object"]))
+
+    def _undo_outbox(self, as_actor: "Person") -> None:
+        if BLOCKLIST is not None:
+            BLOCKLIST.unblock_actor(as_actor.id, _get_actor_id(self._data["object"]))
+
 
 class Collection(BaseActivity):
     ACTIVITY_TYPE = ActivityType.COLLECTION
@@ -641,14 +1208,18 @@ class Undo(BaseActivity):
         ActivityType.FOLLOW,
         ActivityType.LIKE,
         ActivityType.ANNOUNCE,
+        ActivityType.BLOCK,
     ]
     OBJECT_REQUIRED = True
     ACTOR_REQUIRED = True
 
     def _recipients(self) -> List[str]:
         obj = self.get_object()
+        if obj.ACTIVITY_TYPE == ActivityType.BLOCK:
+            # Blocks are not federated, neither are their undo
+            return []
         if obj.ACTIVITY_TYPE == ActivityType.FOLLOW:
-            return [obj.get_object().id]
+            return [_get_actor_id(obj._data["object"])]
         else:
             return [obj.get_object().get_actor().id]
             # TODO(tsileo): handle like and announce
@@ -806,6 +1377,10 @@ class Delete(BaseActivity):
     ALLOWED_OBJECT_TYPES = [ActivityType.NOTE, ActivityType.TOMBSTONE]
     OBJECT_REQUIRED = True
 
+    def _deletes_actor(self) -> bool:
+        """Returns True if the actor deletes itself (the object is the actor IRI, which is gone by now)."""
+        return _get_actor_id(self._data["object"]) == self._get_actor_iri()
+
     def _get_actual_object(self) -> BaseActivity:
         if BACKEND is None:
             raise UninitializedBackendError
@@ -813,7 +1388,7 @@ class Delete(BaseActivity):
         # FIXME(tsileo): overrides get_object instead?
         obj = self.get_object()
         if obj.ACTIVITY_TYPE == ActivityType.TOMBSTONE:
-            obj = parse_activity(BACKEND.fetch_iri(obj.id))
+            obj = _identity_map().get_activity(obj.id)
         return obj
 
     def _recipients(self) -> List[str]:
@@ -822,6 +1397,10 @@ class Delete(BaseActivity):
 
     def _pre_process_from_inbox(self, as_actor: "Person") -> None:
         """Ensures a Delete activity comes from the same actor as the deleted activity."""
+        if self._deletes_actor():
+            # Fetching the deleted actor would fail
+            return
+
         obj = self._get_actual_object()
         actor = self.get_actor()
         if actor.id != obj.get_actor().id:
@@ -831,6 +1410,8 @@ class Delete(BaseActivity):
         if BACKEND is None:
             raise UninitializedBackendError
 
+        # Forget the deleted object (or actor) first, so the backend can't get it (or its route) from the caches
+        _invalidate(_get_actor_id(self._data["object"]))
         BACKEND.inbox_delete(as_actor, self)
         # FIXME(tsileo): handle the delete_threads here?
 
@@ -869,7 +1450,12 @@ class Update(BaseActivity):
         """Ensures an Update activity comes from the same actor as the updated activity."""
         obj = self.get_object()
         actor = self.get_actor()
-        if actor.id != obj.get_actor().id:
+        # An actor is its own "owner"
+        if obj.ACTIVITY_TYPE == ActivityType.PERSON:
+            owner_id = obj.id
+        else:
+            owner_id = obj.get_actor().id
+        if actor.id != owner_id:
             raise BadActivityError(f"{actor!r} cannot update {obj!r}")
 
     def _process_from_inbox(self, as_actor: "Person") -> None:
@@ -877,6 +1463,9 @@ class Update(BaseActivity):
             raise UninitializedBackendError
 
         BACKEND.inbox_update(as_actor, self)
+        obj = self._data["object"]
+        if isinstance(obj, dict) and obj.get("type") == ActivityType.PERSON.value:
+            _invalidate(obj["id"])
 
     def _pre_post_to_outbox(self) -> None:
         if BACKEND is None:
@@ -911,7 +1500,7 @@ class Create(BaseActivity):
                 print("SETTING ID")
                 # FIXME(tsileo): use a weakref instead of ctx, and make it generic to every object (when
                 # building things (and drop the set_ctx usage)
-                self.ctx().id = self._data["object"]["id"]
+                self.ctx()._data["id"] = self._data["object"]["id"]
                 print(f"CTX {self.ctx()}")
             except NotImplementedError:
                 pass
@@ -1039,7 +1628,11 @@ class Box(object):
 
 
 class Outbox(Box):
-    def post(self, activity: BaseActivity) -> None:
+    def post(self, activity: BaseActivity) -> Optional[DeliveryBatch]:
+        with operation():
+            return self._post(activity)
+
+    def _post(self, activity: BaseActivity) -> Optional[DeliveryBatch]:
         if activity.get_actor().id != self.actor.id:
             raise ValueError(
                 f"{activity.get_actor()!r} cannot post into {self.actor!r} outbox"
@@ -1048,7 +1641,7 @@ class Outbox(Box):
         if activity.ACTIVITY_TYPE == ActivityType.NOTE:
             activity = activity.build_create()
 
-        activity.post_to_outbox()
+        return activity.post_to_outbox()
 
     def get(self, activity_iri: str) -> BaseActivity:
         pass
@@ -1058,6 +1651,329 @@ class Outbox(Box):
         pass
 
 
+class DropReason(Enum):
+    """Why a payload posted to an inbox was dropped by the triage."""
+
+    TOO_LARGE = "too_large"
+    INVALID = "invalid"
+    UNSUPPORTED_TYPE = "unsupported_type"
+    BLOCKED = "blocked"
+    DUPLICATE = "duplicate"
+
+
+class InboxTriage(object):
+    """Cheap checks on the raw payloads posted to an inbox, run before fetching or parsing anything.
+
+    The checks are run cheapest first: size, JSON shape, activity type, blocked actor/domain and duplicate ID.
+    The dropped payloads are counted by reason.
+
+    Args:
+        max_size: the maximum size (in bytes) of a payload, only checked when the caller knows the raw size
+    """
+
+    DEFAULT_MAX_SIZE = 256 * 1024
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.dropped: Dict[str, int] = {reason.value: 0 for reason in DropReason}
+
+    def _check_payload(
+        self, as_actor: "Person", payload: Any, size: Optional[int]
+    ) -> Optional[DropReason]:
+        if size is not None and size > self.max_size:
+            return DropReason.TOO_LARGE
+
+        if not isinstance(payload, dict):
+            return DropReason.INVALID
+        activity_id = payload.get("id")
+        if not isinstance(activity_id, str) or not activity_id.startswith("http"):
+            return DropReason.INVALID
+        actor_id = _payload_actor_iri(payload)
+        if actor_id is None:
+            return DropReason.INVALID
+        obj = payload.get("object")
+        if isinstance(obj, dict) and not isinstance(obj.get("type"), str):
+            return DropReason.INVALID
+
+        type_ = payload.get("type")
+        if not isinstance(type_, str):
+            return DropReason.INVALID
+        if type_ not in _ACTIVITY_CLS_BY_TYPE:
+            return DropReason.UNSUPPORTED_TYPE
+
+        if is_blocked(as_actor, actor_id):
+            return DropReason.BLOCKED
+
+        return None
+
+    def _count(self, reasons: List[Optional[DropReason]]) -> None:
+        with self._lock:
+            for reason in reasons:
+                if reason is None:
+                    self.accepted += 1
+                else:
+                    self.dropped[reason.value] += 1
+
+    def check(
+        self, as_actor: "Person", payload: Any, size: Optional[int] = None
+    ) -> Optional[DropReason]:
+        """Returns the reason why the payload must be dropped, or None if it can be processed."""
+        return self.check_many(as_actor, [payload], [size])[0]
+
+    def check_many(
+        self,
+        as_actor: "Person",
+        payloads: List[Any],
+        sizes: Optional[List[Optional[int]]] = None,
+    ) -> List[Optional[DropReason]]:
+        """Same as `check` for a batch of payloads, the duplicates are looked up at once (and within the batch)."""
+        if sizes is None:
+            sizes = [None] * len(payloads)
+        reasons = [
+            self._check_payload(as_actor, payload, size)
+            for payload, size in zip(payloads, sizes)
+        ]
+
+        todo = [i for i, reason in enumerate(reasons) if reason is None]
+        known = _known_inbox_iris(as_actor, [payloads[i]["id"] for i in todo])
+        seen: Set[str] = set()
+        for i in todo:
+            activity_id = payloads[i]["id"]
+            if activity_id in known or activity_id in seen:
+                reasons[i] = DropReason.DUPLICATE
+            seen.add(activity_id)
+
+        self._count(reasons)
+        return reasons
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.dropped, accepted=self.accepted)
+
+
+# Triage of the payloads received with `Inbox.receive`
+INBOX_TRIAGE = InboxTriage()
+
+
+def use_inbox_triage(triage: InboxTriage) -> None:
+    """Set the triage (and its limits) of the raw payloads posted to the inboxes."""
+    global INBOX_TRIAGE
+    INBOX_TRIAGE = triage
+
+
+class InboxBatchResult(object):
+    """Outcome of `Inbox.post_many`: the activities saved, the payloads dropped and the ones that failed (by ID).
+
+    An activity that failed to be processed once saved is in both `saved` and `failed`, one that couldn't be saved
+    is only in `failed` (and wasn't processed).
+    """
+
+    def __init__(self) -> None:
+        self.saved: List[BaseActivity] = []
+        self.blocked: List[ObjectType] = []
+        self.duplicates: List[ObjectType] = []
+        self.failed: Dict[str, Exception] = {}
+
+    def __repr__(self) -> str:
+        return (
+            f"InboxBatchResult(saved={len(self.saved)}, blocked={len(self.blocked)}, "
+            f"duplicates={len(self.duplicates)}, failed={len(self.failed)})"
+        )
+
+
+def _payload_key(payload: Any) -> str:
+    """Returns the key of a payload in `InboxBatchResult.failed` (its ID if it has one)."""
+    if isinstance(payload, dict) and isinstance(payload.get("id"), str):
+        return payload["id"]
+    return repr(payload)
+
+
+def _blocked_actors(as_actor: "Person", actor_ids: List[str]) -> Set[str]:
+    blocked: Set[str] = set()
+    if BLOCKLIST is not None:
+        blocked = BLOCKLIST.blocked_among(as_actor.id, actor_ids)
+        if BLOCKLIST_AUTHORITATIVE:
+            return blocked
+        actor_ids = [actor_id for actor_id in actor_ids if actor_id not in blocked]
+
+    backend = get_backend()
+    try:
+        return blocked | set(backend.outbox_is_blocked_many(as_actor, actor_ids))
+    except NotImplementedError:
+        return blocked | {
+            actor_id
+            for actor_id in actor_ids
+            if backend.outbox_is_blocked(as_actor, actor_id)
+        }
+
+
+def _known_inbox_iris(as_actor: "Person", iris: List[str]) -> Set[str]:
+    backend = get_backend()
+    try:
+        return set(backend.inbox_get_by_iri_many(as_actor, iris))
+    except NotImplementedError:
+        return {iri for iri in iris if backend.inbox_get_by_iri(as_actor, iri)}
+
+
+def _inbox_new_many(
+    as_actor: "Person", activities: List[BaseActivity], failed: Dict[str, Exception]
+) -> List[BaseActivity]:
+    """Save the activities, returns the ones saved and records the others in `failed`."""
+    backend = get_backend()
+    try:
+        backend.inbox_new_many(as_actor, activities)
+        return activities
+    except NotImplementedError:
+        pass
+    except Exception as exc:
+        # The batch is all or nothing
+        logger.exception(f"failed to save {len(activities)} activities")
+        for activity in activities:
+            failed[str(activity)] = exc
+        return []
+
+    saved: List[BaseActivity] = []
+    for activity in activities:
+        try:
+            backend.inbox_new(as_actor, activity)
+        except Exception as exc:
+            logger.exception(f"failed to save {activity!r}")
+            failed[str(activity)] = exc
+            continue
+        saved.append(activity)
+    return saved
+
+
 class Inbox(Box):
     def post(self, activity: BaseActivity) -> None:
-        activity.process_from_inbox(self.actor)
+        """Process an activity posted to the inbox (already parsed, see `receive` for the raw payloads)."""
+        with operation():
+            activity.process_from_inbox(self.actor)
+
+    def receive(
+        self, payload: ObjectType, size: Optional[int] = None
+    ) -> Optional[BaseActivity]:
+        """Process a raw payload posted to the inbox (`size` is the size of the HTTP body, if known).
+
+        The payload goes through the triage first, returns None if it was dropped.
+        """
+        if BACKEND is None:
+            raise UninitializedBackendError
+
+        with operation():
+            reason = INBOX_TRIAGE.check(self.actor, payload, size)
+            if reason is not None:
+                logger.info(
+                    f"dropping a payload posted to {self.actor!r} ({reason.value})"
+                )
+                return None
+
+            activity = parse_activity(payload)
+            activity._process_from_inbox_op(self.actor, triaged=True)
+            return activity
+
+    def post_many(self, payloads: Iterable[ObjectType]) -> InboxBatchResult:
+        """Process a batch of raw payloads posted to the inbox (like when draining a backlog).
+
+        The payloads are grouped by actor, the blocked actors and the duplicates are dropped before anything is
+        fetched or parsed (with a single backend call each, when the backend implements the batched hooks), then
+        the actors are fetched once per actor. All the activities are saved before being processed, in the order
+        they were received. A failure is recorded in the result and doesn't stop the rest of the batch.
+        """
+        if BACKEND is None:
+            raise UninitializedBackendError
+
+        with operation():
+            return self._post_many(list(payloads))
+
+    def _post_many(self, payloads: List[ObjectType]) -> InboxBatchResult:  # noqa: C901
+        result = InboxBatchResult()
+
+        # Group the payloads by actor, from the raw actor IRI
+        actor_ids: List[Optional[str]] = []
+        groups: Dict[str, List[ObjectType]] = {}
+        for payload in payloads:
+            actor_id = None
+            if isinstance(payload, dict) and isinstance(payload.get("id"), str):
+                actor_id = _payload_actor_iri(payload)
+            actor_ids.append(actor_id)
+            if actor_id is None:
+                result.failed[_payload_key(payload)] = BadActivityError(
+                    "invalid payload"
+                )
+                continue
+            groups.setdefault(actor_id, []).append(payload)
+
+        # Drop the blocked actors before fetching anything
+        blocked = _blocked_actors(self.actor, list(groups))
+        for actor_id in blocked:
+            logger.info(f"actor {actor_id} is blocked, dropping {len(groups[actor_id])} activities")
+            result.blocked.extend(groups.pop(actor_id))
+
+        # And the duplicates (within the batch too)
+        known = _known_inbox_iris(
+            self.actor, [p["id"] for group in groups.values() for p in group]
+        )
+        pending: List[Tuple[ObjectType, str]] = []
+        seen: Set[str] = set()
+        for payload, actor_id in zip(payloads, actor_ids):
+            if actor_id is None or actor_id not in groups:
+                continue
+            if payload["id"] in known or payload["id"] in seen:
+                logger.info(f"received duplicate activity {payload['id']}, dropping it")
+                result.duplicates.append(payload)
+                continue
+            seen.add(payload["id"])
+            pending.append((payload, actor_id))
+
+        idmap = _identity_map()
+
+        def _resolve(actor_id: str) -> Optional[Exception]:
+            try:
+                idmap.get_person(actor_id)
+            except Exception as exc:
+                return exc
+            return None
+
+        # Fetch the remaining actors (concurrently), once per actor
+        to_resolve = list(dict.fromkeys(actor_id for _, actor_id in pending))
+        with resolver_pool(len(to_resolve)) as pool:
+            errors = dict(zip(to_resolve, pool.map(_resolve, to_resolve)))
+
+        todo: List[BaseActivity] = []
+        for payload, actor_id in pending:
+            error = errors[actor_id]
+            if error is not None:
+                result.failed[payload["id"]] = error
+                continue
+
+            try:
+                activity = parse_activity(payload)
+            except Exception as exc:
+                result.failed[payload["id"]] = exc
+                continue
+
+            try:
+                activity._pre_process_from_inbox(self.actor)
+            except NotImplementedError:
+                pass
+            except Exception as exc:
+                result.failed[str(activity)] = exc
+                continue
+            todo.append(activity)
+
+        saved = _inbox_new_many(self.actor, todo, result.failed)
+        result.saved.extend(saved)
+        logger.info(f"{len(saved)} activities saved")
+
+        for activity in saved:
+            try:
+                activity._process_from_inbox(self.actor)
+            except NotImplementedError:
+                pass
+            except Exception as exc:
+                result.failed[str(activity)] = exc
+
+        return result
@@ -0,0 +1,598 @@
+"""Asyncio support: an `AsyncBackend` and async versions of the inbox/outbox processing.
+
+The network I/O (fetching actors, objects, collections and delivering activities) is done concurrently on the
+event loop. The objects are fetched ahead of time into the operation identity map, then the regular (synchronous)
+processing is run in an executor, calling back the async backend on the event loop for its side effects.
+"""
+import abc
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Set
+from typing import Union
+
+from . import activitypub as ap
+from . import concurrency
+from .backend import Backend
+from .backend import USER_AGENT
+from .delivery import DeliveryPlan
+from .delivery import DeliverySummary
+from .errors import Error
+from .httpclient import HTTPClient
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of fetches/deliveries in flight for a single operation
+MAX_CONCURRENCY = 64
+
+# Timeout (in seconds) for a single delivery
+DELIVERY_TIMEOUT = 30.0
+
+# Maximum number of synchronous processings running at the same time (each one blocks a thread)
+SYNC_MAX_WORKERS = 16
+
+_HTTP_CLIENT_LOCK = threading.Lock()
+
+_COLLECTION_TYPES = ["Collection", "OrderedCollection"]
+
+
+class AsyncBackend(abc.ABC):
+    """Awaitable counterpart of `Backend`."""
+
+    # See `Backend.PIN_IPS`
+    PIN_IPS = True
+
+    def user_agent(self) -> str:
+        return USER_AGENT
+
+    def http_client(self) -> HTTPClient:
+        client = getattr(self, "_http_client", None)
+        if client is None:
+            with _HTTP_CLIENT_LOCK:
+                client = getattr(self, "_http_client", None)
+                if client is None:
+                    client = HTTPClient(
+                        user_agent=self.user_agent(), pin_ips=self.PIN_IPS
+                    )
+                    self._http_client = client
+        return client
+
+    async def fetch_json(self, url: str, **kwargs):
+        # Blocking fallback (using the shared client), meant to be overridden with an async HTTP client
+        return await asyncio.get_event_loop().run_in_executor(
+            None,
+            functools.partial(
+                self.http_client().get,
+                url,
+                headers={"User-Agent": self.user_agent(), "Accept": "application/json"},
+                **kwargs,
+            ),
+        )
+
+    @abc.abstractmethod
+    def base_url(self) -> str:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def activity_url(self, obj_id: str) -> str:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def random_object_id(self) -> str:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def fetch_iri(self, iri: str) -> "ap.ObjectType":
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def post_to_remote_inbox(
+        self, as_actor: "ap.Person", payload_encoded: str, recp: str
+    ) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def is_from_outbox(self, activity: "ap.BaseActivity") -> bool:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def inbox_get_by_iri(
+        self, as_actor: "ap.Person", iri: str
+    ) -> Optional["ap.BaseActivity"]:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def outbox_create(self, as_actor: "ap.Person", activity: "ap.Create") -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def outbox_delete(self, as_actor: "ap.Person", activity: "ap.Delete") -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def inbox_create(self, as_actor: "ap.Person", activity: "ap.Create") -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def inbox_delete(self, as_actor: "ap.Person", activity: "ap.Delete") -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def outbox_is_blocked(self, as_actor: "ap.Person", actor_id: str) -> bool:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def inbox_new(
+        self, as_actor: "ap.Person", activity: "ap.BaseActivity"
+    ) -> None:
+        pass  # pragma: no cover
+
+    async def outbox_is_blocked_many(
+        self, as_actor: "ap.Person", actor_ids: List[str]
+    ) -> Set[str]:
+        """Optional batched `outbox_is_blocked`, returns the blocked actors among `actor_ids`."""
+        raise NotImplementedError
+
+    async def inbox_get_by_iri_many(
+        self, as_actor: "ap.Person", iris: List[str]
+    ) -> Set[str]:
+        """Optional batched `inbox_get_by_iri`, returns the IRIs of the activities already in the inbox."""
+        raise NotImplementedError
+
+    async def inbox_new_many(
+        self, as_actor: "ap.Person", activities: List["ap.BaseActivity"]
+    ) -> None:
+        """Optional batched `inbox_new`."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def outbox_new(
+        self, as_actor: "ap.Person", activity: "ap.BaseActivity"
+    ) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def new_follower(self, as_actor: "ap.Person", follow: "ap.Follow") -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def new_following(self, as_actor: "ap.Person", follow: "ap.Follow") -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def undo_new_follower(
+        self, as_actor: "ap.Person", follow: "ap.Follow"
+    ) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def undo_new_following(
+        self, as_actor: "ap.Person", follow: "ap.Follow"
+    ) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def inbox_update(self, as_actor: "ap.Person", activity: "ap.Update") -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def outbox_update(self, as_actor: "ap.Person", activity: "ap.Update") -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def inbox_like(self, as_actor: "ap.Person", activity: "ap.Like") -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def inbox_undo_like(self, as_actor: "ap.Person", activity: "ap.Like") -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def outbox_like(self, as_actor: "ap.Person", activity: "ap.Like") -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def outbox_undo_like(
+        self, as_actor: "ap.Person", activity: "ap.Like"
+    ) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def inbox_announce(
+        self, as_actor: "ap.Person", activity: "ap.Announce"
+    ) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def inbox_undo_announce(
+        self, as_actor: "ap.Person", activity: "ap.Announce"
+    ) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def outbox_announce(
+        self, as_actor: "ap.Person", activity: "ap.Announce"
+    ) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    async def outbox_undo_announce(
+        self, as_actor: "ap.Person", activity: "ap.Announce"
+    ) -> None:
+        pass  # pragma: no cover
+
+
+# Every hook that may be called by the synchronous processing
+_HOOKS = [
+    "user_agent",
+    "fetch_json",
+    "base_url",
+    "activity_url",
+    "random_object_id",
+    "fetch_iri",
+    "post_to_remote_inbox",
+    "is_from_outbox",
+    "inbox_get_by_iri",
+    "outbox_create",
+    "outbox_delete",
+    "inbox_create",
+    "inbox_delete",
+    "outbox_is_blocked",
+    "outbox_is_blocked_many",
+    "inbox_get_by_iri_many",
+    "inbox_new",
+    "inbox_new_many",
+    "outbox_new",
+    "new_follower",
+    "new_following",
+    "undo_new_follower",
+    "undo_new_following",
+    "inbox_update",
+    "outbox_update",
+    "inbox_like",
+    "inbox_undo_like",
+    "outbox_like",
+    "outbox_undo_like",
+    "inbox_announce",
+    "inbox_undo_announce",
+    "outbox_announce",
+    "outbox_undo_announce",
+]
+
+
+class _SyncBackendAdapter(Backend):
+    def __init__(
+        self, backend: AsyncBackend, loop: Optional[asyncio.AbstractEventLoop] = None
+    ) -> None:
+        self.backend = backend
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # Ident of the thread running the event loop
+        self.loop_thread: Optional[int] = None
+        # Runs the synchronous processing, apart from the default executor of the loop (used by the blocking
+        # `fetch_json`), or the threads waiting on the loop could starve the requests they are waiting for
+        self.executor = ThreadPoolExecutor(
+            max_workers=SYNC_MAX_WORKERS, thread_name_prefix="little-boxes-sync"
+        )
+        if loop is not None:
+            self.set_loop(loop)
+
+    def set_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        # Runs as soon as the loop does, before the callbacks scheduled later on
+        loop.call_soon_threadsafe(self._set_loop_thread)
+
+    def _set_loop_thread(self) -> None:
+        self.loop_thread = threading.get_ident()
+
+    def _call(self, name: str, *args, **kwargs) -> Any:
+        res = getattr(self.backend, name)(*args, **kwargs)
+        if not asyncio.iscoroutine(res):
+            return res
+
+        # Waiting for the result from the event loop thread would block forever
+        if self.loop_thread == threading.get_ident():
+            res.close()
+            raise Error(
+                f"cannot call {name} synchronously from the event loop, use the little_boxes.aio functions"
+            )
+        if self.loop is None:
+            res.close()
+            raise Error("the event loop of the async backend is unknown")
+
+        return asyncio.run_coroutine_threadsafe(res, self.loop).result()
+
+
+def _bridge(name: str) -> Callable[..., Any]:
+    def _hook(self, *args, **kwargs):
+        return self._call(name, *args, **kwargs)
+
+    _hook.__name__ = name
+    return _hook
+
+
+# Exposes an `AsyncBackend` as a (synchronous) `Backend`, only usable out of the event loop thread
+SyncBackendAdapter = type(
+    "SyncBackendAdapter",
+    (_SyncBackendAdapter,),
+    {name: _bridge(name) for name in _HOOKS},
+)
+
+
+def use_backend(
+    backend: AsyncBackend, loop: Optional[asyncio.AbstractEventLoop] = None
+) -> None:
+    """Initialize the library with an async backend (the loop defaults to the one running the first operation)."""
+    ap.use_backend(SyncBackendAdapter(backend, loop))
+
+
+def _get_adapter() -> _SyncBackendAdapter:
+    backend = ap.get_backend()
+    if not isinstance(backend, _SyncBackendAdapter):
+        raise Error("an async backend must be initialized with aio.use_backend")
+    if backend.loop is None:
+        backend.set_loop(asyncio.get_event_loop())
+    # Only called from coroutines, so this is the loop thread
+    backend.loop_thread = threading.get_ident()
+    return backend
+
+
+def _new_identity_map() -> ap.IdentityMap:
+    return ap.IdentityMap(ap.OBJECT_CACHE, ap.ROUTING_INDEX)
+
+
+async def _run_sync(
+    idmap: ap.IdentityMap, fn: Callable[..., Any], *args, **kwargs
+) -> Any:
+    """Run the synchronous processing in an executor, within the operation of the given identity map."""
+
+    def _run():
+        with ap.operation(idmap):
+            return fn(*args, **kwargs)
+
+    return await asyncio.get_event_loop().run_in_executor(_get_adapter().executor, _run)
+
+
+async def run_sync(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Call the synchronous API (like building an activity) out of the event loop."""
+    return await _run_sync(_new_identity_map(), fn, *args, **kwargs)
+
+
+async def _guarded(iri: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+    """Await `fn` (a request to the host of `iri`) through the circuit breaker, if any."""
+    if concurrency.CIRCUIT_BREAKER is None:
+        return await fn()
+    return await concurrency.CIRCUIT_BREAKER.acall(iri, fn)
+
+
+async def _prefetch(idmap: ap.IdentityMap, iris: Iterable[Any]) -> None:
+    """Concurrently fetch the given IRIs into the identity map.
+
+    Errors are only logged, the synchronous processing will try again (and fail properly).
+    """
+    backend = _get_adapter().backend
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def _fetch(iri: str) -> None:
+        async with sem:
+            try:
+                data = await _guarded(iri, lambda: backend.fetch_iri(iri))
+            except Exception:
+                logger.exception(f"failed to prefetch {iri}")
+                return
+        idmap.add(iri, data)
+
+    todo = [
+        iri
+        for iri in dict.fromkeys(i for i in iris if isinstance(i, str))
+        if iri.startswith("http") and idmap.lookup(iri) is None
+    ]
+    if todo:
+        await asyncio.gather(*[_fetch(iri) for iri in todo])
+
+
+def _refs(obj: Any, fields: Iterable[str]) -> List[str]:
+    """Returns the IRIs referenced by the given fields of an object."""
+    if not isinstance(obj, dict):
+        return []
+    out = []
+    for field in fields:
+        for val in ap._to_list(obj.get(field) or []):
+            if isinstance(val, dict):
+                val = val.get("id")
+            if isinstance(val, str):
+                out.append(val)
+    return out
+
+
+async def _prefetch_activity(idmap: ap.IdentityMap, payload: Mapping[str, Any]) -> None:
+    """Prefetch the actor and the object of an activity, then the actor of the object."""
+    await _prefetch(idmap, _refs(payload, ["actor", "object"]))
+
+    obj = payload.get("object")
+    if isinstance(obj, str):
+        obj = idmap.lookup(obj)
+    await _prefetch(idmap, _refs(obj, ["actor", "attributedTo", "object"]))
+
+
+async def _collection_members(
+    idmap: ap.IdentityMap, collection: ap.ObjectType
+) -> List[str]:
+    """Walk a collection (fetching its pages into the identity map), returns its items IRIs."""
+    backend = _get_adapter().backend
+
+    async def _get(iri: str) -> ap.ObjectType:
+        data = idmap.lookup(iri)
+        if data is None:
+            data = idmap.add(iri, await _guarded(iri, lambda: backend.fetch_iri(iri)))
+        return data
+
+    out: List[str] = []
+    page: Optional[ap.ObjectType] = collection
+    for _ in range(3):
+        if not page or page.get("type") not in _COLLECTION_TYPES:
+            break
+        first = page.get("first")
+        if "orderedItems" in page or "items" in page or not first:
+            break
+        page = await _get(first) if isinstance(first, str) else first
+
+    while page:
+        out.extend(_refs(page, ["orderedItems", "items"]))
+        next_page = page.get("next")
+        if not next_page or page.get("type") in _COLLECTION_TYPES:
+            break
+        page = await _get(next_page)
+
+    return out
+
+
+async def _prefetch_recipients(
+    idmap: ap.IdentityMap, activity: "ap.BaseActivity"
+) -> None:
+    await _prefetch_activity(idmap, activity.view())
+    recipients = await _run_sync(idmap, activity._recipients)
+
+    def _unknown(iris: List[str]) -> List[str]:
+        if ap.ROUTING_INDEX is None:
+            return iris
+        known = ap.ROUTING_INDEX.get_many(iris)
+        return [iri for iri in iris if iri not in known]
+
+    iris = [r for r in recipients if isinstance(r, str) and r != ap.AS_PUBLIC]
+    await _prefetch(idmap, _unknown(iris))
+
+    for iri in iris:
+        raw = idmap.lookup(iri)
+        if isinstance(raw, dict) and raw.get("type") in _COLLECTION_TYPES:
+            try:
+                members = await _collection_members(idmap, raw)
+            except Exception:
+                logger.exception(f"failed to prefetch the collection {iri}")
+                continue
+            await _prefetch(idmap, _unknown(members))
+
+
+async def parse_activity(
+    payload: ap.ObjectType,
+    expected: Optional[ap.ActivityType] = None,
+    trusted: bool = False,
+) -> "ap.BaseActivity":
+    if trusted:
+        # No remote requests are needed
+        return ap.parse_activity(payload, expected, trusted=True)
+
+    idmap = _new_identity_map()
+    await _prefetch_activity(idmap, payload)
+    return await _run_sync(idmap, ap.parse_activity, payload, expected)
+
+
+async def _is_blocked(as_actor: "ap.Person", actor_id: str) -> bool:
+    if ap.BLOCKLIST is not None:
+        if ap.BLOCKLIST.is_blocked(as_actor.id, actor_id):
+            return True
+        if ap.BLOCKLIST_AUTHORITATIVE:
+            return False
+    return await _get_adapter().backend.outbox_is_blocked(as_actor, actor_id)
+
+
+async def process_from_inbox(
+    activity: Union["ap.BaseActivity", ap.ObjectType], as_actor: "ap.Person"
+) -> None:
+    """Process an activity (or a raw payload) posted to the `as_actor` inbox."""
+    payload = activity if isinstance(activity, dict) else activity.view()
+    idmap = _new_identity_map()
+
+    # Drop the unwanted activities before fetching anything
+    triaged = isinstance(activity, dict)
+    if triaged:
+        reason = await _run_sync(idmap, ap.INBOX_TRIAGE.check, as_actor, payload)
+        if reason is not None:
+            logger.info(f"dropping a payload posted to {as_actor!r} ({reason.value})")
+            return
+    else:
+        actor_id = ap._payload_actor_iri(payload)
+        if actor_id is not None and await _is_blocked(as_actor, actor_id):
+            logger.info(f"actor {actor_id} is blocked, dropping {activity!r}")
+            return
+
+    await _prefetch_activity(idmap, payload)
+
+    def _process():
+        act = ap.parse_activity(activity) if triaged else activity
+        with ap.operation():
+            act._process_from_inbox_op(as_actor, triaged=triaged)
+
+    await _run_sync(idmap, _process)
+
+
+async def delivery_plan(activity: "ap.BaseActivity") -> DeliveryPlan:
+    idmap = _new_identity_map()
+    await _prefetch_recipients(idmap, activity)
+    return await _run_sync(idmap, activity.delivery_plan)
+
+
+async def recipients(activity: "ap.BaseActivity") -> List[str]:
+    plan = await delivery_plan(activity)
+    return plan.inboxes()
+
+
+async def post_to_outbox(activity: "ap.BaseActivity") -> DeliverySummary:
+    """Post an activity to the outbox, and deliver it concurrently to its recipients (or enqueue its fan-out)."""
+    adapter = _get_adapter()
+    idmap = _new_identity_map()
+
+    if ap.DELIVERY_QUEUE is not None:
+        # The recipients are resolved (and the deliveries made) by the workers of the queue
+        await _prefetch_activity(idmap, activity.view())
+        as_actor, payload, recipients = await _run_sync(
+            idmap, activity._outbox_publish, resolve_recipients=False
+        )
+        await asyncio.get_event_loop().run_in_executor(
+            None,
+            ap.DELIVERY_QUEUE.enqueue_fan_out,
+            activity.id,
+            as_actor.id,
+            payload,
+            recipients,
+        )
+        return DeliverySummary([], {}, recipients)
+
+    await _prefetch_recipients(idmap, activity)
+    as_actor, payload, inboxes = await _run_sync(idmap, activity._outbox_publish)
+
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def _deliver(recp: str) -> None:
+        async with sem:
+            logger.debug(f"posting to {recp}")
+            await _guarded(
+                recp,
+                lambda: asyncio.wait_for(
+                    adapter.backend.post_to_remote_inbox(as_actor, payload, recp),
+                    DELIVERY_TIMEOUT,
+                ),
+            )
+
+    results = await asyncio.gather(
+        *[_deliver(recp) for recp in inboxes], return_exceptions=True
+    )
+    succeeded = []
+    failed: Dict[str, Exception] = {}
+    for recp, res in zip(inboxes, results):
+        if isinstance(res, Exception):
+            logger.error(f"failed to deliver to {recp}: {res!r}")
+            failed[recp] = res
+        else:
+            succeeded.append(recp)
+
+    return DeliverySummary(succeeded, failed, [])
@@ -1,26 +1,60 @@
 import abc
+import threading
 import typing
 
-import requests
-
 from .__version__ import __version__
+from .httpclient import HTTPClient
 
 if typing.TYPE_CHECKING:
     from little_boxes import activitypub as ap  # noqa: type checking
 
+USER_AGENT = f"Little Boxes {__version__} (+http://github.com/tsileo/little-boxes)"
+
+_HTTP_CLIENT_LOCK = threading.Lock()
+
 
 class Backend(abc.ABC):
+    # Connect to the IPs validated by `urlutils` (set it to False to let the HTTP client resolve the hosts)
+    PIN_IPS = True
+
     def user_agent(self) -> str:
-        return f"Little Boxes {__version__} (+http://github.com/tsileo/little-boxes)"
+        return USER_AGENT
+
+    def new_http_client(self) -> HTTPClient:
+        """Build the HTTP client shared by all the requests of this backend (override it to tweak the limits)."""
+        return HTTPClient(user_agent=self.user_agent(), pin_ips=self.PIN_IPS)
+
+    def http_client(self) -> HTTPClient:
+        client = getattr(self, "_http_client", None)
+        if client is None:
+            with _HTTP_CLIENT_LOCK:
+                client = getattr(self, "_http_client", None)
+                if client is None:
+                    client = self.new_http_client()
+                    self._http_client = client
+        return client
 
     def fetch_json(self, url: str, **kwargs):
-        resp = requests.get(
+        resp = self.http_client().get(
             url,
             headers={"User-Agent": self.user_agent(), "Accept": "application/json"},
             **kwargs,
         )
         return resp
 
+    def post_json(self, url: str, payload_encoded: str, **kwargs):
+        """POST an encoded activity, meant to be used by `post_to_remote_inbox` implementations."""
+        resp = self.http_client().post(
+            url,
+            data=payload_encoded,
+            headers={
+                "User-Agent": self.user_agent(),
+                "Content-Type": "application/activity+json",
+            },
+            **kwargs,
+        )
+        return resp
+
     @abc.abstractmethod
     def base_url(self) -> str:
         pass  # pragma: no cover
@@ -57,6 +91,33 @@ class Backend(abc.ABC):
     def inbox_new(self, as_actor: "ap.Person", activity: "ap.BaseActivity") -> None:
         pass  # pragma: no cover
 
+    def outbox_is_blocked_many(
+        self, as_actor: "ap.Person", actor_ids: typing.List[str]
+    ) -> typing.Set[str]:
+        """Optional batched `outbox_is_blocked`, returns the blocked actors among `actor_ids`."""
+        raise NotImplementedError
+
+    def inbox_get_by_iri(
+        self, as_actor: "ap.Person", iri: str
+    ) -> typing.Optional["ap.BaseActivity"]:
+        """Returns the activity with the given IRI if it's already in the inbox (used to drop the duplicates).
+
+        The default implementation never finds any, override it or the duplicates are processed again.
+        """
+        return None
+
+    def inbox_get_by_iri_many(
+        self, as_actor: "ap.Person", iris: typing.List[str]
+    ) -> typing.Set[str]:
+        """Batched `inbox_get_by_iri`, returns the IRIs of the activities already in the inbox."""
+        return {iri for iri in iris if self.inbox_get_by_iri(as_actor, iri)}
+
+    def inbox_new_many(
+        self, as_actor: "ap.Person", activities: typing.List["ap.BaseActivity"]
+    ) -> None:
+        """Optional batched `inbox_new`."""
+        raise NotImplementedError
+
     @abc.abstractmethod
     def outbox_new(self, as_actor: "ap.Person", activity: "ap.BaseActivity") -> None:
         pass  # pragma: no cover
@@ -0,0 +1,148 @@
+"""Blocklist of actors and domains, checked against the raw actor IRI before anything is fetched."""
+import abc
+import sqlite3
+import threading
+from typing import Iterable
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+
+def iri_domain(iri: str) -> str:
+    """Returns the (lowercased) host of an IRI, without the port, or an empty string."""
+    parts = iri.split("/", 3)
+    if len(parts) < 3 or not parts[0].endswith(":"):
+        return ""
+    host = parts[2].rsplit("@", 1)[-1]
+    if host.startswith("["):
+        host = host.split("]", 1)[0] + "]"
+    else:
+        host = host.split(":", 1)[0]
+    return host.lower()
+
+
+def _parent_domains(domain: str) -> Iterable[str]:
+    """Yields the domain and its parents (`a.b.com`, `b.com` and `com`)."""
+    while domain:
+        yield domain
+        domain = domain.partition(".")[2]
+
+
+class Blocklist(abc.ABC):
+    """Actors blocked by a local actor, and domains blocked by a local actor or the whole instance.
+
+    A blocked domain also blocks its subdomains.
+    """
+
+    @abc.abstractmethod
+    def block_actor(self, owner: str, actor_id: str) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def unblock_actor(self, owner: str, actor_id: str) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def block_domain(self, domain: str, owner: Optional[str] = None) -> None:
+        """Block a domain for the given local actor, or for everyone if no owner is given."""
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def unblock_domain(self, domain: str, owner: Optional[str] = None) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def is_blocked(self, owner: str, actor_id: str) -> bool:
+        """Returns True if the activities of `actor_id` must be dropped for the local actor `owner`."""
+        pass  # pragma: no cover
+
+    def blocked_among(self, owner: str, actor_ids: Iterable[str]) -> Set[str]:
+        """Returns the blocked actors among `actor_ids`."""
+        return {actor_id for actor_id in actor_ids if self.is_blocked(owner, actor_id)}
+
+
+class InMemoryBlocklist(Blocklist):
+    def __init__(self) -> None:
+        self._actors: Set[Tuple[str, str]] = set()
+        self._domains: Set[Tuple[Optional[str], str]] = set()
+
+    def block_actor(self, owner: str, actor_id: str) -> None:
+        self._actors.add((owner, actor_id))
+
+    def unblock_actor(self, owner: str, actor_id: str) -> None:
+        self._actors.discard((owner, actor_id))
+
+    def block_domain(self, domain: str, owner: Optional[str] = None) -> None:
+        self._domains.add((owner, domain.lower()))
+
+    def unblock_domain(self, domain: str, owner: Optional[str] = None) -> None:
+        self._domains.discard((owner, domain.lower()))
+
+    def is_blocked(self, owner: str, actor_id: str) -> bool:
+        if (owner, actor_id) in self._actors:
+            return True
+        if not self._domains:
+            return False
+        for domain in _parent_domains(iri_domain(actor_id)):
+            if (None, domain) in self._domains or (owner, domain) in self._domains:
+                return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self._actors) + len(self._domains)
+
+
+class SqliteBlocklist(InMemoryBlocklist):
+    """Persistent blocklist stored in a SQLite database (and fully loaded in memory for the lookups)."""
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS blocks ("
+                "owner TEXT NOT NULL, target TEXT NOT NULL, is_domain INTEGER NOT NULL, "
+                "PRIMARY KEY (owner, target, is_domain))"
+            )
+            rows = self._conn.execute(
+                "SELECT owner, target, is_domain FROM blocks"
+            ).fetchall()
+        for owner, target, is_domain in rows:
+            if is_domain:
+                self._domains.add((owner or None, target))
+            else:
+                self._actors.add((owner, target))
+
+    def _save(self, owner: Optional[str], target: str, is_domain: bool) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO blocks (owner, target, is_domain) VALUES (?, ?, ?)",
+                (owner or "", target, int(is_domain)),
+            )
+
+    def _remove(self, owner: Optional[str], target: str, is_domain: bool) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM blocks WHERE owner = ? AND target = ? AND is_domain = ?",
+                (owner or "", target, int(is_domain)),
+            )
+
+    def block_actor(self, owner: str, actor_id: str) -> None:
+        self._save(owner, actor_id, False)
+        super().block_actor(owner, actor_id)
+
+    def unblock_actor(self, owner: str, actor_id: str) -> None:
+        self._remove(owner, actor_id, False)
+        super().unblock_actor(owner, actor_id)
+
+    def block_domain(self, domain: str, owner: Optional[str] = None) -> None:
+        self._save(owner, domain.lower(), True)
+        super().block_domain(domain, owner)
+
+    def unblock_domain(self, domain: str, owner: Optional[str] = None) -> None:
+        self._remove(owner, domain.lower(), True)
+        super().unblock_domain(domain, owner)
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,379 @@
+"""Fast-path URDNA2015 canonicalization (N-Quads) for the common ActivityPub documents.
+
+Only a subset of JSON-LD is supported: the contexts must be bundled (or inline term definitions), and every blank
+node must be distinguishable by its first degree quads. `canonicalize` returns None for anything else, and the
+caller is expected to fall back to pyld (the output is byte-identical to pyld's, from pyld 2, when a result is
+returned).
+"""
+import hashlib
+import math
+import re
+import threading
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+XSD_BOOLEAN = "http://www.w3.org/2001/XMLSchema#boolean"
+XSD_DOUBLE = "http://www.w3.org/2001/XMLSchema#double"
+XSD_INTEGER = "http://www.w3.org/2001/XMLSchema#integer"
+XSD_STRING = "http://www.w3.org/2001/XMLSchema#string"
+
+_TERM_KEYS = {"@id", "@type", "@container"}
+_CONTAINERS = {"@set", "@language", "@list"}
+_SCHEME_RE = re.compile(r"[A-Za-z][A-Za-z0-9+.-]*")
+# The IRI of a prefix term (usable in compact IRIs) ends with a gen-delim
+_PREFIX_IRI_RE = re.compile(r".*[:/?#\[\]@]$")
+# IRIs with these characters are dropped (or not escaped) by pyld
+_INVALID_IRI_RE = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+
+Quad = Tuple[str, str, str]
+
+
+class Unsupported(Exception):
+    """Raised when the document needs the generic (pyld) processing."""
+
+
+class Term(NamedTuple):
+    iri: str
+    type: Optional[str]
+    container: Optional[str]
+    # Only the prefix terms are expanded in compact IRIs (JSON-LD 1.1)
+    prefix: bool
+
+
+class Context(NamedTuple):
+    terms: Dict[str, Term]
+    vocab: Optional[str]
+
+
+# Processed remote contexts, keyed by the tuple of the context URLs
+_CONTEXTS: Dict[Tuple[str, ...], Context] = {}
+_CONTEXTS_LOCK = threading.Lock()
+
+
+def _expand_iri(ctx: Context, value: str, vocab: bool) -> Optional[str]:
+    """Mimics pyld's `_expand_iri` (without base IRI, relative IRIs are returned as None)."""
+    if value.startswith("@"):
+        return value
+    if vocab and value in ctx.terms:
+        return ctx.terms[value].iri
+    if ":" in value:
+        prefix, suffix = value.split(":", 1)
+        if prefix == "_" or suffix.startswith("//"):
+            return value
+        term = ctx.terms.get(prefix)
+        if term is not None and term.prefix:
+            return term.iri + suffix
+        if not _SCHEME_RE.fullmatch(prefix):
+            # A relative IRI (like a date), not handled the same way by every pyld version
+            raise Unsupported(f"relative IRI {value}")
+        return value
+    if vocab and ctx.vocab is not None:
+        return ctx.vocab + value
+    return None
+
+
+def _process_local_context(ctx: Context, local: Dict[str, Any]) -> Context:
+    terms = dict(ctx.terms)
+    vocab = ctx.vocab
+    for key, val in local.items():
+        if key == "@vocab":
+            if not isinstance(val, str):
+                raise Unsupported("@vocab")
+            vocab = val
+        elif key.startswith("@"):
+            raise Unsupported(f"context keyword {key}")
+
+    new = Context(terms, vocab)
+    defining: Set[str] = set()
+
+    def _define(term: str) -> None:
+        if term in defining:
+            raise Unsupported(f"cyclic term definition {term}")
+        defining.add(term)
+
+        val = local[term]
+        simple = isinstance(val, str)
+        if simple:
+            val = {"@id": val}
+        if not isinstance(val, dict) or not val.keys() <= _TERM_KEYS:
+            raise Unsupported(f"term definition {term}")
+        if not isinstance(val.get("@id"), str):
+            raise Unsupported(f"term definition without @id {term}")
+
+        # The dependencies (prefixes) defined in this local context are defined first
+        for dep in (val["@id"], val.get("@type")):
+            if isinstance(dep, str) and ":" in dep:
+                prefix = dep.split(":", 1)[0]
+                if prefix in local and prefix not in done:
+                    _define(prefix)
+
+        iri = _expand_iri(new, val["@id"], vocab=True)
+        if iri is None or (":" not in iri and iri not in ("@id", "@type")):
+            raise Unsupported(f"term definition {term}")
+        if iri.startswith("@") and (iri not in ("@id", "@type") or len(val) > 1):
+            raise Unsupported(f"keyword alias {term}")
+
+        type_ = val.get("@type")
+        if type_ is not None:
+            if not isinstance(type_, str):
+                raise Unsupported(f"term type {term}")
+            if type_ not in ("@id", "@vocab"):
+                type_ = _expand_iri(new, type_, vocab=True)
+                if type_ is None or ":" not in type_ or type_.startswith("_:"):
+                    raise Unsupported(f"term type {term}")
+
+        container = val.get("@container")
+        if container is not None and container not in _CONTAINERS:
+            raise Unsupported(f"term container {term}")
+
+        is_prefix = (
+            simple
+            and ":" not in term
+            and (iri.startswith("_:") or bool(_PREFIX_IRI_RE.match(iri)))
+        )
+        terms[term] = Term(iri, type_, container, is_prefix)
+        done.add(term)
+
+    done: Set[str] = set()
+    for term in local:
+        if not term.startswith("@") and term not in done:
+            _define(term)
+
+    return new
+
+
+def _remote_context(
+    urls: Tuple[str, ...], load_context: Callable[[str], Optional[Dict[str, Any]]]
+) -> Context:
+    with _CONTEXTS_LOCK:
+        cached = _CONTEXTS.get(urls)
+    if cached is not None:
+        return cached
+
+    ctx = Context({}, None)
+    for url in urls:
+        doc = load_context(url)
+        if doc is None or not isinstance(doc.get("@context"), dict):
+            raise Unsupported(f"context {url}")
+        ctx = _process_local_context(ctx, doc["@context"])
+
+    with _CONTEXTS_LOCK:
+        _CONTEXTS[urls] = ctx
+    return ctx
+
+
+def _active_context(
+    raw: Any, load_context: Callable[[str], Optional[Dict[str, Any]]]
+) -> Context:
+    contexts = raw if isinstance(raw, list) else [raw]
+    urls = []
+    for i, local in enumerate(contexts):
+        if not isinstance(local, str):
+            break
+        urls.append(local)
+    else:
+        i = len(contexts)
+
+    ctx = _remote_context(tuple(urls), load_context)
+    for local in contexts[i:]:
+        if not isinstance(local, dict):
+            raise Unsupported("context")
+        ctx = _process_local_context(ctx, local)
+    return ctx
+
+
+def _escape(value: str) -> str:
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+        .replace('"', '\\"')
+    )
+
+
+def _literal(value: Any, datatype: Optional[str]) -> str:
+    if isinstance(value, bool):
+        out = "true" if value else "false"
+        datatype = datatype or XSD_BOOLEAN
+    elif isinstance(value, float) or datatype == XSD_DOUBLE:
+        if not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise Unsupported("double")
+        # Canonical double representation, like pyld
+        out = re.sub(r"(\d)0*E\+?(-)?0*(\d)", r"\1E\2\3", "%1.15E" % value)
+        datatype = datatype or XSD_DOUBLE
+    elif isinstance(value, int):
+        if abs(value) >= 10 ** 21:
+            # Serialized as a double by pyld
+            raise Unsupported("integer")
+        out = str(value)
+        datatype = datatype or XSD_INTEGER
+    elif isinstance(value, str):
+        out = value
+        datatype = datatype or XSD_STRING
+    else:
+        raise Unsupported("literal")
+
+    if datatype == XSD_STRING:
+        return f'"{_escape(out)}"'
+    return f'"{_escape(out)}"^^<{datatype}>'
+
+
+class _Converter(object):
+    """Converts a (compacted) JSON-LD document to RDF quads, with temporary blank node labels."""
+
+    def __init__(self, ctx: Context) -> None:
+        self.ctx = ctx
+        self.quads: Set[Quad] = set()
+        self._bnodes = 0
+
+    def _new_bnode(self) -> str:
+        self._bnodes += 1
+        return f"_:b{self._bnodes}"
+
+    def _iri(self, value: Any, vocab: bool) -> str:
+        if not isinstance(value, str) or value.startswith("_:"):
+            raise Unsupported("IRI")
+        iri = _expand_iri(self.ctx, value, vocab=vocab)
+        if iri is None or ":" not in iri or iri.startswith("_:"):
+            raise Unsupported(f"IRI {value}")
+        if _INVALID_IRI_RE.search(iri):
+            raise Unsupported(f"invalid IRI {value}")
+        return f"<{iri}>"
+
+    def node(self, obj: Dict[str, Any], top_level: bool = False) -> str:
+        """Emit the quads of a node object, returns its subject."""
+        subject = None
+        for key, val in obj.items():
+            if key == "@context" and top_level:
+                continue
+            if self._expand_key(key) == "@id":
+                subject = self._iri(val, vocab=False)
+        if subject is None:
+            subject = self._new_bnode()
+
+        for key, val in obj.items():
+            if key == "@context" and top_level:
+                continue
+            prop = self._expand_key(key)
+            if prop == "@id":
+                continue
+            if prop == "@type":
+                for type_ in val if isinstance(val, list) else [val]:
+                    self.quads.add((subject, f"<{RDF_TYPE}>", self._iri(type_, True)))
+                continue
+            if prop is None:
+                # Dropped by the expansion
+                continue
+            if prop.startswith("@"):
+                raise Unsupported(f"keyword {key}")
+
+            # Properties expanded to a blank node are dropped, but not the nodes they contain
+            predicate = None if prop.startswith("_:") else f"<{prop}>"
+            if predicate is not None and (":" not in prop or _INVALID_IRI_RE.search(prop)):
+                raise Unsupported(f"property {key}")
+            for obj_ in self._values(key, val):
+                if predicate is not None:
+                    self.quads.add((subject, predicate, obj_))
+
+        return subject
+
+    def _expand_key(self, key: str) -> Optional[str]:
+        return _expand_iri(self.ctx, key, vocab=True)
+
+    def _values(self, key: str, val: Any) -> List[str]:
+        term = self.ctx.terms.get(key)
+        container = term.container if term else None
+        type_ = term.type if term else None
+
+        if container == "@list":
+            raise Unsupported("@list")
+        if container == "@language":
+            if not isinstance(val, dict):
+                raise Unsupported("language map")
+            out = []
+            for lang, items in val.items():
+                if lang.startswith("@"):
+                    raise Unsupported("language map")
+                for item in items if isinstance(items, list) else [items]:
+                    if item is None:
+                        continue
+                    if not isinstance(item, str):
+                        raise Unsupported("language map")
+                    out.append(f'"{_escape(item)}"@{lang.lower()}')
+            return out
+
+        out = []
+        for item in val if isinstance(val, list) else [val]:
+            if item is None:
+                continue
+            if isinstance(item, list):
+                raise Unsupported("nested list")
+            if isinstance(item, dict):
+                if any(k.startswith("@") for k in item):
+                    raise Unsupported("nested keyword")
+                out.append(self.node(item))
+            elif type_ in ("@id", "@vocab") and isinstance(item, str):
+                out.append(self._iri(item, vocab=type_ == "@vocab"))
+            else:
+                out.append(_literal(item, None if type_ in ("@id", "@vocab") else type_))
+        return out
+
+
+def _first_degree_hash(bnode: str, quads: List[Quad]) -> str:
+    lines = []
+    for s, p, o in quads:
+        if s.startswith("_:"):
+            s = "_:a" if s == bnode else "_:z"
+        if o.startswith("_:"):
+            o = "_:a" if o == bnode else "_:z"
+        lines.append(f"{s} {p} {o} .\n")
+    lines.sort()
+    return hashlib.sha256("".join(lines).encode("utf-8")).hexdigest()
+
+
+def _canonical_labels(quads: Set[Quad]) -> Dict[str, str]:
+    """Issue the canonical blank node labels, when the first degree hashes are enough to tell them apart."""
+    by_bnode: Dict[str, List[Quad]] = {}
+    for quad in quads:
+        s, _, o = quad
+        if s.startswith("_:"):
+            by_bnode.setdefault(s, []).append(quad)
+        if o.startswith("_:"):
+            by_bnode.setdefault(o, []).append(quad)
+
+    hashes = {_first_degree_hash(bnode, qs): bnode for bnode, qs in by_bnode.items()}
+    if len(hashes) != len(by_bnode):
+        raise Unsupported("ambiguous blank nodes")
+
+    return {bnode: f"_:c14n{i}" for i, (_, bnode) in enumerate(sorted(hashes.items()))}
+
+
+def canonicalize(
+    doc: Dict[str, Any], load_context: Callable[[str], Optional[Dict[str, Any]]]
+) -> Optional[str]:
+    """Returns the URDNA2015 N-Quads of the document, or None if it's not supported by the fast path.
+
+    `load_context` returns the JSON document of a context URL (only the bundled contexts are meant to be used).
+    """
+    try:
+        if not isinstance(doc, dict) or "@context" not in doc:
+            return None
+        conv = _Converter(_active_context(doc["@context"], load_context))
+        conv.node(doc, top_level=True)
+        labels = _canonical_labels(conv.quads)
+    except Unsupported:
+        return None
+
+    lines = []
+    for s, p, o in conv.quads:
+        lines.append(f"{labels.get(s, s)} {p} {labels.get(o, o)} .\n")
+    lines.sort()
+    return "".join(lines)
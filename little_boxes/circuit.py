@@ -0,0 +1,283 @@
+"""Per-host circuit breaker, to fail fast on the remote instances that are down instead of waiting for timeouts."""
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import TypeVar
+from urllib.parse import urlparse
+
+import requests
+
+from .blocklist import iri_domain
+from .errors import Error
+from .urlutils import InvalidURLError
+from .urlutils import check_url
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class HostUnavailableError(Error):
+    """Raised instead of contacting a host whose circuit is open."""
+
+    status_code = 503
+
+
+def is_host_failure(error: Exception) -> bool:
+    """Returns True if the error means the host is unreachable or broken (a 4xx response means it's alive).
+
+    Only the connection errors, the timeouts and the 5xx responses count, not the invalid responses (like a
+    malformed JSON body).
+    """
+    status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status_code, int):
+        return status_code >= 500
+    # Every requests exception is an OSError
+    if isinstance(error, requests.RequestException):
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+    return isinstance(error, (asyncio.TimeoutError, OSError))
+
+
+def _http_probe(origin: str) -> bool:
+    """Returns True if the server at `origin` (like `https://host:port`) answers without a server error."""
+    # Imported here as activitypub depends on this module
+    from .activitypub import get_backend
+
+    try:
+        check_url(origin)
+        resp = (
+            get_backend()
+            .http_client()
+            .request("HEAD", f"{origin}/", allow_redirects=False)
+        )
+    except (requests.RequestException, InvalidURLError):
+        return False
+    return resp.status_code < 500
+
+
+class _HostState(object):
+    __slots__ = ("state", "failures", "open_until", "reset_timeout", "trial", "origin")
+
+    def __init__(self, reset_timeout: float, origin: str) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.reset_timeout = reset_timeout
+        # Whether the single request allowed in the half-open state is in flight
+        self.trial = False
+        # The scheme and netloc (with the port) of the host, to probe it
+        self.origin = origin
+
+
+class CircuitBreaker(object):
+    """Track the health of the remote hosts.
+
+    After `failure_threshold` consecutive failures, the circuit of a host opens and the requests fail right away
+    with `HostUnavailableError`. Once `reset_timeout` elapsed, it's half-open: a single request (or a background
+    probe) is let through, it closes the circuit if it succeeds, otherwise the circuit opens again for twice as long
+    (up to `max_reset_timeout`).
+
+    Args:
+        path: the SQLite database to persist the open circuits to (kept in memory only if not set)
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 60.0,
+        max_reset_timeout: float = 6 * 3600.0,
+        path: Optional[str] = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, _HostState] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self._conn: Optional[sqlite3.Connection] = None
+        if path is not None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS circuits ("
+                    "host TEXT PRIMARY KEY, failures INTEGER NOT NULL, open_until REAL NOT NULL, "
+                    "reset_timeout REAL NOT NULL, origin TEXT NOT NULL)"
+                )
+            rows = self._conn.execute(
+                "SELECT host, failures, open_until, reset_timeout, origin FROM circuits"
+            ).fetchall()
+            for host, failures, open_until, reset_timeout, origin in rows:
+                h = _HostState(reset_timeout, origin)
+                h.state = OPEN
+                h.failures = failures
+                h.open_until = open_until
+                self._hosts[host] = h
+
+    def _save(self, host: str, h: _HostState) -> None:
+        """Must be called with the lock held."""
+        if self._conn is None:
+            return
+        with self._conn:
+            if h.state == CLOSED:
+                self._conn.execute("DELETE FROM circuits WHERE host = ?", (host,))
+            else:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO circuits (host, failures, open_until, reset_timeout, origin) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (host, h.failures, h.open_until, h.reset_timeout, h.origin),
+                )
+
+    def state(self, host: str) -> str:
+        with self._lock:
+            h = self._hosts.get(host)
+            if h is None:
+                return CLOSED
+            if h.state == OPEN and self._clock() >= h.open_until:
+                return HALF_OPEN
+            return h.state
+
+    def allow(self, host: str) -> bool:
+        """Returns True if a request to the host can be made (it must be followed by `record_success/failure`)."""
+        with self._lock:
+            h = self._hosts.get(host)
+            if h is None or h.state == CLOSED:
+                return True
+            if h.state == OPEN:
+                if self._clock() < h.open_until:
+                    return False
+                h.state = HALF_OPEN
+                h.trial = False
+            if h.trial:
+                return False
+            h.trial = True
+            return True
+
+    def record_success(self, host: str) -> None:
+        with self._lock:
+            h = self._hosts.pop(host, None)
+            if h is not None and h.state != CLOSED:
+                logger.info(f"{host} is back, closing its circuit")
+                h.state = CLOSED
+                self._save(host, h)
+
+    def record_failure(self, host: str, origin: Optional[str] = None) -> None:
+        """Record a failure, `origin` is the scheme and netloc the host was reached at (`https://host` by default)."""
+        with self._lock:
+            h = self._hosts.get(host)
+            if h is None:
+                h = self._hosts[host] = _HostState(
+                    self.reset_timeout, origin or f"https://{host}"
+                )
+            elif origin:
+                h.origin = origin
+            h.failures += 1
+            if h.state == HALF_OPEN:
+                # The trial failed
+                h.reset_timeout = min(h.reset_timeout * 2, self.max_reset_timeout)
+            elif h.state == OPEN or h.failures < self.failure_threshold:
+                return
+
+            logger.warning(
+                f"{host} failed {h.failures} times, opening its circuit for {h.reset_timeout}s"
+            )
+            h.state = OPEN
+            h.trial = False
+            h.open_until = self._clock() + h.reset_timeout
+            self._save(host, h)
+
+    def _enter(self, iri: str) -> str:
+        host = iri_domain(iri)
+        if host and not self.allow(host):
+            raise HostUnavailableError(f"{host} is unavailable", payload={"host": host})
+        return host
+
+    def _exit(self, iri: str, host: str, error: Optional[Exception]) -> None:
+        if not host:
+            return
+        if error is not None and is_host_failure(error):
+            parsed = urlparse(iri)
+            self.record_failure(host, f"{parsed.scheme}://{parsed.netloc}")
+        else:
+            self.record_success(host)
+
+    def call(self, iri: str, fn: Callable[[], T]) -> T:
+        """Call `fn` (a request to the host of `iri`) through the circuit of the host."""
+        host = self._enter(iri)
+        try:
+            res = fn()
+        except Exception as exc:
+            self._exit(iri, host, exc)
+            raise
+        self._exit(iri, host, None)
+        return res
+
+    async def acall(self, iri: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """Async version of `call`."""
+        host = self._enter(iri)
+        try:
+            res = await fn()
+        except Exception as exc:
+            self._exit(iri, host, exc)
+            raise
+        self._exit(iri, host, None)
+        return res
+
+    def open_hosts(self) -> List[str]:
+        with self._lock:
+            return [host for host, h in self._hosts.items() if h.state != CLOSED]
+
+    def probe(self, check: Callable[[str], bool] = _http_probe) -> None:
+        """Check the hosts whose circuit can be half-opened with `check(origin)`, the hosts that are up are closed."""
+        with self._lock:
+            origins = {
+                host: h.origin for host, h in self._hosts.items() if h.state != CLOSED
+            }
+        for host, origin in origins.items():
+            if not self.allow(host):
+                continue
+            try:
+                ok = check(origin)
+            except Exception:
+                logger.exception(f"failed to probe {host}")
+                ok = False
+            if ok:
+                self.record_success(host)
+            else:
+                self.record_failure(host)
+
+    def start_probing(
+        self, interval: float = 30.0, check: Callable[[str], bool] = _http_probe
+    ) -> None:
+        """Probe the unavailable hosts in a background thread, every `interval` seconds."""
+
+        def _run() -> None:
+            while not self._stop.wait(interval):
+                self.probe(check)
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=_run, name="circuit-breaker-probe", daemon=True
+        )
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._conn is not None:
+            self._conn.close()
@@ -1,70 +1,140 @@
 """Collection releated utils."""
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 from typing import Callable
 from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
 
 from .errors import RecursionLimitExceededError
 from .errors import UnexpectedActivityTypeError
 
+_COLLECTION_TYPES = ["Collection", "OrderedCollection"]
+_PAGE_TYPES = ["CollectionPage", "OrderedCollectionPage"]
 
-def parse_collection(  # noqa: C901
-    payload: Optional[Dict[str, Any]] = None,
-    url: Optional[str] = None,
-    level: int = 0,
-    fetcher: Optional[Callable[[str], Dict[str, Any]]] = None,
-) -> List[Any]:
-    """Resolve/fetch a `Collection`/`OrderedCollection`."""
+
+def _page_items(payload: Dict[str, Any]) -> List[Any]:
+    return list(payload.get("orderedItems", [])) + list(payload.get("items", []))
+
+
+def _iter_collection(  # noqa: C901
+    payload: Optional[Dict[str, Any]],
+    url: Optional[str],
+    level: int,
+    fetcher: Optional[Callable[[str], Dict[str, Any]]],
+    max_items: Optional[int],
+    max_pages: Optional[int],
+    prefetch: bool,
+) -> Iterator[Any]:
     if not fetcher:
         raise Exception("must provide a fetcher")
     if level > 3:
         raise RecursionLimitExceededError("recursion limit exceeded")
+    if max_items is not None and max_items <= 0:
+        return
 
-    # Go through all the pages
-    out: List[Any] = []
     if url:
         payload = fetcher(url)
     if not payload:
         raise ValueError("must at least prove a payload or an URL")
 
-    if payload["type"] in ["Collection", "OrderedCollection"]:
-        if "orderedItems" in payload:
-            return payload["orderedItems"]
-        if "items" in payload:
-            return payload["items"]
-        if "first" in payload:
-            if isinstance(payload["first"], str):
-                out.extend(
-                    parse_collection(
-                        url=payload["first"], level=level + 1, fetcher=fetcher
-                    )
+    # Follow the `first` page of the collection
+    while payload["type"] in _COLLECTION_TYPES:
+        if "orderedItems" in payload or "items" in payload:
+            page: Optional[Dict[str, Any]] = payload
+            break
+        if "first" not in payload:
+            return
+
+        level += 1
+        if level > 3:
+            raise RecursionLimitExceededError("recursion limit exceeded")
+        if isinstance(payload["first"], str):
+            payload = fetcher(payload["first"])
+        else:
+            payload = dict(payload["first"])
+            payload.setdefault("type", "CollectionPage")
+    else:
+        page = payload
+
+    count = 0
+    pages = 0
+    executor: Optional[ThreadPoolExecutor] = None
+    next_page: Optional[Future] = None
+    try:
+        while page:
+            if page["type"] not in _COLLECTION_TYPES + _PAGE_TYPES:
+                raise UnexpectedActivityTypeError(
+                    "unexpected activity type {}".format(page["type"])
                 )
-            else:
-                if "orderedItems" in payload["first"]:
-                    out.extend(payload["first"]["orderedItems"])
-                if "items" in payload["first"]:
-                    out.extend(payload["first"]["items"])
-                n = payload["first"].get("next")
-                if n:
-                    out.extend(
-                        parse_collection(url=n, level=level + 1, fetcher=fetcher)
-                    )
-        return out
-
-    while payload:
-        if payload["type"] in ["CollectionPage", "OrderedCollectionPage"]:
-            if "orderedItems" in payload:
-                out.extend(payload["orderedItems"])
-            if "items" in payload:
-                out.extend(payload["items"])
-            n = payload.get("next")
-            if n is None:
+            pages += 1
+
+            items = _page_items(page)
+            n = page.get("next")
+            if (
+                page["type"] in _COLLECTION_TYPES
+                or (max_pages is not None and pages >= max_pages)
+                or (max_items is not None and count + len(items) >= max_items)
+            ):
+                # No need for the next page
+                n = None
+
+            # Fetch the next page in the background while the current one is consumed
+            if n and prefetch:
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=1)
+                next_page = executor.submit(fetcher, n)
+
+            for item in items:
+                yield item
+                count += 1
+                if max_items is not None and count >= max_items:
+                    return
+
+            if not n:
                 break
-            payload = fetcher(n)
-        else:
-            raise UnexpectedActivityTypeError(
-                "unexpected activity type {}".format(payload["type"])
-            )
+            if next_page is not None:
+                page, next_page = next_page.result(), None
+            else:
+                page = fetcher(n)
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def iter_collection(
+    payload: Optional[Dict[str, Any]] = None,
+    url: Optional[str] = None,
+    fetcher: Optional[Callable[[str], Dict[str, Any]]] = None,
+    max_items: Optional[int] = None,
+    max_pages: Optional[int] = None,
+    prefetch: bool = True,
+) -> Iterator[Any]:
+    """Iterate over the items of a `Collection`/`OrderedCollection`, page by page.
 
-    return out
+    The next page is fetched in the background while the current one is consumed (unless `prefetch` is False),
+    and the iteration stops after `max_items` items or `max_pages` pages.
+    """
+    return _iter_collection(
+        payload, url, 0, fetcher, max_items, max_pages, prefetch=prefetch
+    )
+
+
+def parse_collection(
+    payload: Optional[Dict[str, Any]] = None,
+    url: Optional[str] = None,
+    level: int = 0,
+    fetcher: Optional[Callable[[str], Dict[str, Any]]] = None,
+    max_items: Optional[int] = None,
+    max_pages: Optional[int] = None,
+) -> List[Any]:
+    """Resolve/fetch a `Collection`/`OrderedCollection`."""
+    return list(
+        _iter_collection(
+            payload, url, level, fetcher, max_items, max_pages, prefetch=False
+        )
+    )
@@ -0,0 +1,46 @@
+"""Helpers for the requests made to the remote instances, shared by the synchronous modules."""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Optional
+
+from .circuit import CircuitBreaker
+
+# Maximum number of threads used to fetch the recipients of an activity (or the keys of signed requests)
+RESOLVER_MAX_WORKERS = 8
+
+# Optional per-host circuit breaker, consulted before fetching from/delivering to a remote host
+CIRCUIT_BREAKER: Optional[CircuitBreaker] = None
+
+
+def use_circuit_breaker(breaker: Optional[CircuitBreaker]) -> None:
+    """Set the circuit breaker used to fail fast on the unavailable hosts (`None` to disable it)."""
+    global CIRCUIT_BREAKER
+    CIRCUIT_BREAKER = breaker
+
+
+def guarded(iri: str, fn: Callable[[], Any]) -> Any:
+    """Call `fn` (a request to the host of `iri`) through the circuit breaker, if any."""
+    if CIRCUIT_BREAKER is None:
+        return fn()
+    return CIRCUIT_BREAKER.call(iri, fn)
+
+
+class _InlineExecutor(object):
+    """Mimics `ThreadPoolExecutor.map` in the current thread, when spawning threads is not worth it."""
+
+    def map(self, fn, items):
+        return map(fn, items)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+
+def resolver_pool(size: int) -> Any:
+    """Returns an executor for running `size` requests concurrently (inline if there's only one)."""
+    if size <= 1 or RESOLVER_MAX_WORKERS <= 1:
+        return _InlineExecutor()
+    return ThreadPoolExecutor(max_workers=min(size, RESOLVER_MAX_WORKERS))
@@ -0,0 +1,323 @@
+"""Concurrent fan-out delivery of activities to remote inboxes."""
+import logging
+import threading
+import time
+from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from urllib.parse import urlparse
+
+from .routing import Route
+from .routing import RoutingIndex
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryPlan(object):
+    """Inboxes an activity must be delivered to, grouped by host, along with the actors each inbox covers.
+
+    Inboxes are deduplicated and kept in the order they were added.
+    """
+
+    def __init__(self) -> None:
+        self._hosts: Dict[str, Dict[str, None]] = {}
+        self._covered: Dict[str, Dict[str, None]] = {}
+
+    def add(self, inbox: str, actor_id: Optional[str] = None) -> None:
+        if inbox not in self._covered:
+            self._covered[inbox] = {}
+            self._hosts.setdefault(urlparse(inbox).netloc, {})[inbox] = None
+        if actor_id is not None:
+            self._covered[inbox][actor_id] = None
+
+    def inboxes(self) -> List[str]:
+        return list(self._covered)
+
+    def by_host(self) -> Dict[str, List[str]]:
+        return {host: list(inboxes) for host, inboxes in self._hosts.items()}
+
+    def covered_actors(self, inbox: str) -> List[str]:
+        return list(self._covered.get(inbox, []))
+
+    def compact(self) -> Dict[str, Dict[str, List[str]]]:
+        """Returns the plan as host -> inbox -> covered actors."""
+        return {
+            host: {inbox: list(self._covered[inbox]) for inbox in inboxes}
+            for host, inboxes in self._hosts.items()
+        }
+
+    def actors_count(self) -> int:
+        """Returns the number of actors reached by the plan (vs `len(plan)` POSTs)."""
+        return sum(len(actors) for actors in self._covered.values())
+
+    def __contains__(self, inbox: str) -> bool:
+        return inbox in self._covered
+
+    def __len__(self) -> int:
+        return len(self._covered)
+
+    def __repr__(self) -> str:
+        return (
+            f"DeliveryPlan(hosts={len(self._hosts)}, inboxes={len(self._covered)}, "
+            f"actors={self.actors_count()})"
+        )
+
+
+def _served_by(inbox: str, host: str) -> bool:
+    return urlparse(inbox).netloc == host
+
+
+class DeliveryPlanner(object):
+    """Build a `DeliveryPlan` from all the resolved targets at once, grouping them by host.
+
+    A single copy is sent per shared inbox: the actors of a host that don't advertise a shared inbox are delivered
+    to the shared inbox of the other actors of this host (from the same plan, or learned from the routing index).
+    Only the shared inboxes served by the host itself are learned this way.
+
+    Args:
+        learn_shared_inboxes: set it to False to only use the shared inbox advertised by each actor
+    """
+
+    def __init__(self, learn_shared_inboxes: bool = True) -> None:
+        self.learn_shared_inboxes = learn_shared_inboxes
+
+    def plan(
+        self,
+        targets: Iterable[Tuple[str, Optional[Route]]],
+        routing_index: Optional[RoutingIndex] = None,
+    ) -> DeliveryPlan:
+        """Build the plan for the `(actor ID, route)` targets (the ones without route are skipped)."""
+        routes = [
+            (actor_id, route)
+            for actor_id, route in targets
+            if route is not None and route.delivery_inbox
+        ]
+
+        shared: Dict[str, str] = {}
+        if self.learn_shared_inboxes:
+            for _, route in routes:
+                if route.shared_inbox and _served_by(route.shared_inbox, route.host):
+                    shared.setdefault(route.host, route.shared_inbox)
+            unknown = {route.host for _, route in routes if route.host not in shared}
+            if unknown and routing_index is not None:
+                for host, inbox in routing_index.shared_inboxes(unknown).items():
+                    if _served_by(inbox, host):
+                        shared[host] = inbox
+
+        plan = DeliveryPlan()
+        for actor_id, route in routes:
+            # The routes without any inbox were filtered out above
+            target = route.shared_inbox or shared.get(route.host) or route.inbox
+            if target is None:
+                continue
+            plan.add(target, actor_id)
+        return plan
+
+
+class DeliveryTimeoutError(Exception):
+    """Raised/recorded when a delivery took longer than the engine timeout."""
+
+
+class Delivery(object):
+    """A single delivery of a payload to a remote inbox."""
+
+    def __init__(self, recipient: str, post: Callable[[str], None]) -> None:
+        self.recipient = recipient
+        self.host = urlparse(recipient).netloc
+        self.post = post
+        self.started_at: Optional[float] = None
+        self.done = False
+        self.error: Optional[Exception] = None
+
+    def __repr__(self) -> str:
+        return f"Delivery({self.recipient!r}, done={self.done}, error={self.error!r})"
+
+
+class DeliverySummary(object):
+    """Outcome of a fan-out: the inboxes that were reached and the ones that failed (with the error)."""
+
+    def __init__(
+        self, succeeded: List[str], failed: Dict[str, Exception], pending: List[str]
+    ) -> None:
+        self.succeeded = succeeded
+        self.failed = failed
+        self.pending = pending
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed and not self.pending
+
+    def __repr__(self) -> str:
+        return (
+            f"DeliverySummary(succeeded={len(self.succeeded)}, failed={len(self.failed)}, "
+            f"pending={len(self.pending)})"
+        )
+
+
+class DeliveryBatch(object):
+    """Handle on the deliveries of a single payload, returned without waiting for the remote inboxes."""
+
+    def __init__(self, engine: "DeliveryEngine", deliveries: List[Delivery]) -> None:
+        self._engine = engine
+        self.deliveries = deliveries
+
+    def done(self) -> bool:
+        return all(d.done for d in self.deliveries)
+
+    def summary(self) -> DeliverySummary:
+        self._engine._refresh()
+        succeeded = []
+        failed = {}
+        pending = []
+        for d in self.deliveries:
+            if not d.done:
+                pending.append(d.recipient)
+            elif d.error:
+                failed[d.recipient] = d.error
+            else:
+                succeeded.append(d.recipient)
+        return DeliverySummary(succeeded, failed, pending)
+
+    def wait(self, timeout: Optional[float] = None) -> DeliverySummary:
+        """Block until every delivery is done (or timed out), or until `timeout` seconds elapsed."""
+        return self._engine._wait(self, timeout)
+
+
+class DeliveryEngine(object):
+    """Deliver payloads to many inboxes concurrently, using a thread pool.
+
+    Args:
+        max_workers: the maximum number of deliveries in flight (globally)
+        max_per_host: the maximum number of deliveries in flight for a single host
+        timeout: the time (in seconds) after which a delivery is considered failed
+
+    A timed out delivery is reported as failed right away, but the request is not cancelled: it keeps its host slot
+    (and its worker) until `post` returns, so the requests themselves must be bounded (the `HTTPClient` of the
+    backend has default connect/read timeouts).
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 16,
+        max_per_host: int = 2,
+        timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._clock = clock
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._cond = threading.Condition()
+        self._pending: Dict[str, Deque[Delivery]] = defaultdict(deque)
+        self._in_flight: Dict[str, Set[Delivery]] = defaultdict(set)
+
+    def deliver(
+        self, recipients: List[str], post: Callable[[str], None]
+    ) -> DeliveryBatch:
+        """Schedule `post(recipient)` for each recipient and returns immediately."""
+        batch = DeliveryBatch(self, [Delivery(recp, post) for recp in recipients])
+        with self._cond:
+            for d in batch.deliveries:
+                self._pending[d.host].append(d)
+            self._dispatch()
+        return batch
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def _finish(self, d: Delivery, error: Optional[Exception]) -> None:
+        """Must be called with the lock held, once `post` returned."""
+        if not d.done:
+            d.done = True
+            d.error = error
+        self._in_flight[d.host].discard(d)
+        if not self._in_flight[d.host]:
+            del self._in_flight[d.host]
+
+    def _reap(self) -> None:
+        """Mark the deliveries running for too long as failed (they keep their host slot until they return)."""
+        now = self._clock()
+        for deliveries in self._in_flight.values():
+            for d in deliveries:
+                if (
+                    not d.done
+                    and d.started_at is not None
+                    and now - d.started_at > self.timeout
+                ):
+                    logger.warning(f"delivery to {d.recipient} timed out")
+                    d.done = True
+                    d.error = DeliveryTimeoutError(f"timed out after {self.timeout}s")
+
+    def _refresh(self) -> None:
+        with self._cond:
+            self._reap()
+
+    def _dispatch(self) -> None:
+        """Must be called with the lock held."""
+        self._reap()
+        for host in list(self._pending.keys()):
+            queue = self._pending[host]
+            while queue and len(self._in_flight[host]) < self.max_per_host:
+                d = queue.popleft()
+                self._in_flight[host].add(d)
+                self._executor.submit(self._run, d)
+            if not queue:
+                del self._pending[host]
+            if not self._in_flight[host]:
+                del self._in_flight[host]
+
+    def _run(self, d: Delivery) -> None:
+        with self._cond:
+            d.started_at = self._clock()
+
+        error = None
+        try:
+            logger.debug(f"posting to {d.recipient}")
+            d.post(d.recipient)
+        except Exception as exc:
+            logger.exception(f"failed to deliver to {d.recipient}")
+            error = exc
+
+        with self._cond:
+            self._finish(d, error)
+            self._dispatch()
+            self._cond.notify_all()
+
+    def _next_deadline(self, batch: DeliveryBatch) -> Optional[float]:
+        deadlines = [
+            d.started_at + self.timeout
+            for d in batch.deliveries
+            if not d.done and d.started_at is not None
+        ]
+        if not deadlines:
+            return None
+        return min(deadlines)
+
+    def _wait(self, batch: DeliveryBatch, timeout: Optional[float]) -> DeliverySummary:
+        until = None if timeout is None else self._clock() + timeout
+        with self._cond:
+            while not batch.done():
+                self._dispatch()
+                if batch.done():
+                    break
+
+                now = self._clock()
+                if until is not None and now >= until:
+                    break
+
+                deadlines = [
+                    t for t in [self._next_deadline(batch), until] if t is not None
+                ]
+                wait_for = max(min(deadlines) - now, 0.001) if deadlines else None
+                self._cond.wait(wait_for)
+
+        return batch.summary()
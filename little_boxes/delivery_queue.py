@@ -0,0 +1,435 @@
+"""Durable queue of outbound deliveries, retried with an exponential backoff until they succeed or expire.
+
+Posting an activity enqueues a fan-out job with its recipients (the actors/collections IRIs), the `DeliveryWorker`s
+(threads or processes sharing the same SQLite database) resolve them to inboxes and enqueue one delivery per inbox
+(deduplicated on the activity ID and the inbox, the payload is stored once per activity), then do the actual requests.
+"""
+import abc
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+DONE = "done"
+DEAD = "dead"
+FAN_OUT = "fan_out"
+
+
+class QueuedDelivery(NamedTuple):
+    id: int
+    activity_id: str
+    actor_id: str
+    # None for a fan-out job (the recipients of the activity must be resolved)
+    inbox: Optional[str]
+    payload: str
+    attempts: int
+    created_at: float
+    next_attempt_at: float
+    last_error: Optional[str]
+    # The IRIs of the recipients (including the hidden bto/bcc ones) of a fan-out job
+    recipients: Optional[List[str]] = None
+
+
+class RetryPolicy(object):
+    """Exponential backoff with jitter, and the maximum age of a delivery before it's dead-lettered.
+
+    Args:
+        base_delay: the delay (in seconds) before the first retry
+        max_delay: the maximum delay between two attempts
+        max_age: the time (in seconds) after which a delivery is given up (dead-lettered)
+        jitter: the delays are randomized by +/- this ratio, to spread the retries of a failed host
+    """
+
+    def __init__(
+        self,
+        base_delay: float = 30.0,
+        max_delay: float = 6 * 3600.0,
+        max_age: float = 3 * 24 * 3600.0,
+        jitter: float = 0.25,
+        rand: Callable[[], float] = random.random,
+    ) -> None:
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_age = max_age
+        self.jitter = jitter
+        self._rand = rand
+
+    def delay(self, attempts: int) -> float:
+        """Returns the delay before the next attempt, once the delivery failed `attempts` times."""
+        delay = min(self.base_delay * 2 ** max(attempts - 1, 0), self.max_delay)
+        return delay * (1 + self.jitter * (2 * self._rand() - 1))
+
+    def is_permanent(self, error: Exception) -> bool:
+        """Returns True if the error will not go away by retrying (a 4xx response, except timeouts/rate limits)."""
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+        return (
+            isinstance(status_code, int)
+            and 400 <= status_code < 500
+            and status_code not in (408, 429)
+        )
+
+
+class DeliveryQueue(abc.ABC):
+    @abc.abstractmethod
+    def enqueue_fan_out(
+        self, activity_id: str, actor_id: str, payload: str, recipients: Iterable[str]
+    ) -> bool:
+        """Queue the resolution of the recipients of an activity, returns False if it was already queued."""
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def enqueue(
+        self, activity_id: str, actor_id: str, payload: str, inboxes: Iterable[str]
+    ) -> int:
+        """Queue the deliveries of a payload, returns the number of new deliveries (the duplicates are ignored)."""
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def claim(self, limit: int, lease: float, now: float) -> List[QueuedDelivery]:
+        """Returns up to `limit` deliveries due at `now`, hidden from the other workers for `lease` seconds."""
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def ack(self, delivery_id: int) -> None:
+        """Mark a delivery as done."""
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def retry(self, delivery_id: int, error: str, next_attempt_at: float) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def dead_letter(self, delivery_id: int, error: str) -> None:
+        """Give up on a delivery (it's kept for inspection, see `dead_letters`)."""
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def dead_letters(self, limit: int = 100) -> List[QueuedDelivery]:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def requeue(self, delivery_id: int, now: float) -> None:
+        """Schedule a dead-lettered delivery again (like once the remote instance is back)."""
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def purge(self, older_than: float) -> int:
+        """Delete the done and dead deliveries created before `older_than`, returns the number deleted."""
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def stats(self) -> Dict[str, int]:
+        pass  # pragma: no cover
+
+
+class SqliteDeliveryQueue(DeliveryQueue):
+    """Delivery queue stored in a SQLite database, that can be shared by worker processes."""
+
+    _COLUMNS = (
+        "d.id, d.activity_id, a.actor_id, d.inbox, a.payload, d.attempts, d.created_at, d.next_attempt_at, "
+        "d.last_error, d.recipients"
+    )
+    _FROM = "FROM deliveries d JOIN activities a ON a.activity_id = d.activity_id"
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.time) -> None:
+        self._conn = sqlite3.connect(
+            path, timeout=30.0, isolation_level=None, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        self._clock = clock
+        with self._lock:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS activities ("
+                "activity_id TEXT PRIMARY KEY, actor_id TEXT NOT NULL, payload TEXT NOT NULL)"
+            )
+            # The fan-out job of an activity is stored with an empty inbox, and its recipients (JSON encoded)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS deliveries ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, activity_id TEXT NOT NULL, "
+                "inbox TEXT NOT NULL, recipients TEXT, state TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, "
+                "next_attempt_at REAL NOT NULL, locked_until REAL, last_error TEXT, "
+                "UNIQUE (activity_id, inbox))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS deliveries_due_idx "
+                "ON deliveries (state, next_attempt_at)"
+            )
+
+    def _write(self, query: str, args: tuple) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(query, args)
+
+    def _insert(
+        self,
+        activity_id: str,
+        actor_id: str,
+        payload: str,
+        targets: Sequence[Tuple[str, Optional[str]]],
+    ) -> int:
+        now = self._clock()
+        rows = [
+            (activity_id, inbox, recipients, PENDING, now, now)
+            for inbox, recipients in targets
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO activities (activity_id, actor_id, payload) VALUES (?, ?, ?)",
+                    (activity_id, actor_id, payload),
+                )
+                before = self._conn.total_changes
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO deliveries "
+                    "(activity_id, inbox, recipients, state, created_at, next_attempt_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                count = self._conn.total_changes - before
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return count
+
+    def enqueue_fan_out(
+        self, activity_id: str, actor_id: str, payload: str, recipients: Iterable[str]
+    ) -> bool:
+        targets = [("", json.dumps(list(dict.fromkeys(recipients))))]
+        return self._insert(activity_id, actor_id, payload, targets) == 1
+
+    def enqueue(
+        self, activity_id: str, actor_id: str, payload: str, inboxes: Iterable[str]
+    ) -> int:
+        targets = [(inbox, None) for inbox in dict.fromkeys(inboxes) if inbox]
+        return self._insert(activity_id, actor_id, payload, targets)
+
+    @staticmethod
+    def _to_delivery(row: tuple) -> QueuedDelivery:
+        delivery = QueuedDelivery(*row[:-1])
+        if not delivery.inbox:
+            return delivery._replace(inbox=None, recipients=json.loads(row[-1] or "[]"))
+        return delivery
+
+    def claim(self, limit: int, lease: float, now: float) -> List[QueuedDelivery]:
+        with self._lock:
+            # Lock the database, so two processes can't claim the same deliveries
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    f"SELECT {self._COLUMNS} {self._FROM} "
+                    "WHERE d.state = ? AND d.next_attempt_at <= ? "
+                    "AND (d.locked_until IS NULL OR d.locked_until <= ?) "
+                    "ORDER BY d.next_attempt_at LIMIT ?",
+                    (PENDING, now, now, limit),
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE deliveries SET locked_until = ? WHERE id = ?",
+                    [(now + lease, row[0]) for row in rows],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [self._to_delivery(row) for row in rows]
+
+    def ack(self, delivery_id: int) -> None:
+        self._write(
+            "UPDATE deliveries SET state = ?, attempts = attempts + 1, locked_until = NULL, "
+            "last_error = NULL WHERE id = ?",
+            (DONE, delivery_id),
+        )
+
+    def retry(self, delivery_id: int, error: str, next_attempt_at: float) -> None:
+        self._write(
+            "UPDATE deliveries SET attempts = attempts + 1, next_attempt_at = ?, locked_until = NULL, "
+            "last_error = ? WHERE id = ?",
+            (next_attempt_at, error, delivery_id),
+        )
+
+    def dead_letter(self, delivery_id: int, error: str) -> None:
+        self._write(
+            "UPDATE deliveries SET state = ?, attempts = attempts + 1, locked_until = NULL, "
+            "last_error = ? WHERE id = ?",
+            (DEAD, error, delivery_id),
+        )
+
+    def dead_letters(self, limit: int = 100) -> List[QueuedDelivery]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {self._COLUMNS} {self._FROM} WHERE d.state = ? ORDER BY d.id LIMIT ?",
+                (DEAD, limit),
+            ).fetchall()
+        return [self._to_delivery(row) for row in rows]
+
+    def requeue(self, delivery_id: int, now: float) -> None:
+        # The age of the delivery is reset too, or it would expire right away
+        self._write(
+            "UPDATE deliveries SET state = ?, attempts = 0, created_at = ?, next_attempt_at = ?, "
+            "locked_until = NULL WHERE id = ? AND state = ?",
+            (PENDING, now, now, delivery_id, DEAD),
+        )
+
+    def purge(self, older_than: float) -> int:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                count = self._conn.execute(
+                    "DELETE FROM deliveries WHERE state IN (?, ?) AND created_at < ? AND inbox != ''",
+                    (DONE, DEAD, older_than),
+                ).rowcount
+                self._conn.execute(
+                    "DELETE FROM deliveries WHERE state IN (?, ?) AND created_at < ? AND inbox = ''",
+                    (DONE, DEAD, older_than),
+                )
+                self._conn.execute(
+                    "DELETE FROM activities WHERE activity_id NOT IN "
+                    "(SELECT activity_id FROM deliveries)"
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return count
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the number of deliveries by state, and the number of pending fan-out jobs."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) FROM deliveries WHERE inbox != '' GROUP BY state"
+            ).fetchall()
+            (fan_out,) = self._conn.execute(
+                "SELECT COUNT(*) FROM deliveries WHERE inbox = '' AND state = ?",
+                (PENDING,),
+            ).fetchone()
+        out = {PENDING: 0, DONE: 0, DEAD: 0}
+        out.update(rows)
+        out[FAN_OUT] = fan_out
+        return out
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class DeliveryWorker(object):
+    """Deliver the queued payloads, retrying the failed ones with the `RetryPolicy`.
+
+    Several workers (threads or processes) can consume the same queue.
+
+    Args:
+        post: performs a delivery, and raises an exception if it failed (see `activitypub.deliver_queued`)
+        resolve: returns the inboxes of the recipients of a fan-out job (see `activitypub.resolve_queued`)
+        concurrency: the number of deliveries in flight for this worker
+        lease: the time (in seconds) a claimed delivery is hidden from the other workers
+    """
+
+    def __init__(
+        self,
+        queue: DeliveryQueue,
+        post: Callable[[QueuedDelivery], None],
+        resolve: Optional[Callable[[QueuedDelivery], List[str]]] = None,
+        policy: Optional[RetryPolicy] = None,
+        concurrency: int = 8,
+        batch_size: int = 32,
+        lease: float = 300.0,
+        poll_interval: float = 1.0,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.queue = queue
+        self.post = post
+        self.resolve = resolve
+        self.policy = policy or RetryPolicy()
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._clock = clock
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _fan_out(self, delivery: QueuedDelivery) -> None:
+        if self.resolve is None:
+            raise ValueError("no resolve callback to fan out the activity")
+        inboxes = self.resolve(delivery)
+        count = self.queue.enqueue(
+            delivery.activity_id, delivery.actor_id, delivery.payload, inboxes
+        )
+        logger.info(f"{count} deliveries of {delivery.activity_id} enqueued")
+
+    def _attempt(self, delivery: QueuedDelivery) -> None:
+        try:
+            if delivery.inbox is None:
+                self._fan_out(delivery)
+            else:
+                logger.debug(f"posting {delivery.activity_id} to {delivery.inbox}")
+                self.post(delivery)
+        except Exception as exc:
+            self._failed(delivery, exc)
+            return
+        self.queue.ack(delivery.id)
+
+    def _failed(self, delivery: QueuedDelivery, exc: Exception) -> None:
+        error = f"{exc.__class__.__name__}: {exc}"
+        target = delivery.inbox or f"the fan-out of {delivery.activity_id}"
+        now = self._clock()
+        next_attempt_at = now + self.policy.delay(delivery.attempts + 1)
+        if self.policy.is_permanent(exc):
+            logger.warning(f"{target} failed permanently: {error}")
+            self.queue.dead_letter(delivery.id, error)
+        elif next_attempt_at - delivery.created_at > self.policy.max_age:
+            logger.warning(
+                f"giving up the delivery to {target} after {delivery.attempts + 1} attempts: {error}"
+            )
+            self.queue.dead_letter(delivery.id, error)
+        else:
+            logger.info(f"{target} failed, will retry: {error}")
+            self.queue.retry(delivery.id, error, next_attempt_at)
+
+    def run_once(self) -> int:
+        """Process the deliveries that are due, returns the number of attempts."""
+        deliveries = self.queue.claim(self.batch_size, self.lease, self._clock())
+        list(self._executor.map(self._attempt, deliveries))
+        return len(deliveries)
+
+    def run(self) -> None:
+        """Process the queue until `stop` is called."""
+        while not self._stop.is_set():
+            try:
+                count = self.run_once()
+            except Exception:
+                logger.exception("failed to process the delivery queue")
+                count = 0
+            if count < self.batch_size:
+                self._stop.wait(self.poll_interval)
+
+    def start(self) -> None:
+        """Run the worker in a background thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self.run, name="delivery-worker", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, wait: bool = True) -> None:
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,162 @@
+"""Shared HTTP client, with keep-alive connection pools, default timeouts and a response size limit."""
+import logging
+from typing import Any
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.connectionpool import HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError
+
+from . import urlutils
+from .errors import Error
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseTooLargeError(Error):
+    """Raised when a remote server returns a response larger than the configured limit."""
+
+
+class _PinnedConnectionMixin(object):
+    """Connect to the IPs validated by `urlutils` (resolved through its DNS cache), instead of resolving the
+    host again: the addresses that are checked are the ones that are contacted (no DNS rebinding).
+
+    Like urllib3, every address of the host is tried (in order) until a connection succeeds.
+    """
+
+    def _new_conn(self):
+        # Connections through a proxy (tunneled or not) are made to the proxy, that is not validated
+        if (
+            getattr(self, "proxy", None)
+            or getattr(self, "_tunnel_host", None)
+            or urlutils._debug_mode()
+        ):
+            return super()._new_conn()
+
+        ip_addresses = urlutils.validated_ips(self.host, self.port)
+        if not ip_addresses:
+            raise urlutils.InvalidURLError(
+                f"{self.host} resolves to an invalid address"
+            )
+        # urllib3 connects to `_dns_host`, but its `host` (used for the Host header, SNI and the certificate
+        # verification) is read from it too (urllib3 2), so the hostname is restored once connected
+        dns_host = self._dns_host
+        try:
+            for i, ip_address in enumerate(ip_addresses):
+                self._dns_host = ip_address
+                try:
+                    return super()._new_conn()
+                except ConnectTimeoutError:
+                    # Also raised when the connection is refused (`NewConnectionError`)
+                    if i == len(ip_addresses) - 1:
+                        raise
+                    logger.info(f"failed to connect to {ip_address} for {dns_host}")
+        finally:
+            self._dns_host = dns_host
+
+
+class _PinnedHTTPConnection(_PinnedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _PinnedHTTPSConnection(_PinnedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _PinnedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _PinnedHTTPConnection
+
+
+class _PinnedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _PinnedHTTPSConnection
+
+
+class _PinnedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _PinnedHTTPConnectionPool,
+            "https": _PinnedHTTPSConnectionPool,
+        }
+
+
+class HTTPClient(object):
+    """Thin wrapper around a `requests.Session` meant to be shared by the whole process.
+
+    Args:
+        pool_connections: the number of hosts to keep a connection pool for
+        pool_maxsize: the maximum number of keep-alive connections per host
+        timeout: the default (connect, read) timeouts in seconds
+        max_response_size: the maximum size (in bytes, once decompressed) of a response body
+        pin_ips: connect to the IP validated by `urlutils` (and refuse the private ones) instead of resolving the
+            hosts again
+    """
+
+    DEFAULT_TIMEOUT = (5.0, 30.0)
+    DEFAULT_MAX_RESPONSE_SIZE = 10 * 1024 * 1024
+
+    def __init__(
+        self,
+        user_agent: Optional[str] = None,
+        pool_connections: int = 64,
+        pool_maxsize: int = 8,
+        timeout: Union[float, Tuple[float, float]] = DEFAULT_TIMEOUT,
+        max_response_size: int = DEFAULT_MAX_RESPONSE_SIZE,
+        pin_ips: bool = False,
+    ) -> None:
+        self.timeout = timeout
+        self.max_response_size = max_response_size
+        self.session = requests.Session()
+        adapter_cls = _PinnedHTTPAdapter if pin_ips else HTTPAdapter
+        adapter = adapter_cls(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        if user_agent:
+            self.session.headers["User-Agent"] = user_agent
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs["stream"] = True
+        resp = self.session.request(method, url, **kwargs)
+        try:
+            self._read_body(resp)
+        finally:
+            resp.close()
+        return resp
+
+    def _read_body(self, resp: requests.Response) -> None:
+        """Read the body (the connection is released to the pool), enforcing the size limit."""
+        length = resp.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > self.max_response_size:
+            raise ResponseTooLargeError(
+                f"response from {resp.url} is too large ({length} bytes)"
+            )
+
+        chunks = []
+        size = 0
+        for chunk in resp.iter_content(chunk_size=64 * 1024):
+            size += len(chunk)
+            if size > self.max_response_size:
+                raise ResponseTooLargeError(
+                    f"response from {resp.url} is larger than {self.max_response_size} bytes"
+                )
+            chunks.append(chunk)
+        resp._content = b"".join(chunks)
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
@@ -4,23 +4,72 @@ Mastodon instances won't accept requests that are not signed using this scheme.
 
 """
 import base64
+import binascii
+import functools
 import hashlib
 import logging
+import threading
+import time
+import weakref
+from concurrent.futures import Executor
+from concurrent.futures import Future
 from datetime import datetime
 from typing import Any
 from typing import Dict
+from typing import Iterable
+from typing import List
 from typing import Optional
+from typing import Tuple
+from typing import Union
 from urllib.parse import urlparse
 
 from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 from requests.auth import AuthBase
 
 from .activitypub import get_backend
+from .cache import LRUCache
+from .concurrency import guarded
+from .concurrency import resolver_pool
 from .key import Key
 
 logger = logging.getLogger(__name__)
 
+# Cache of the parsed public keys (along with the time they were fetched at), keyed by keyId (`None` to disable it)
+KEY_CACHE: Optional[LRUCache] = LRUCache(maxsize=1024, ttl=3600)
+
+# Minimum time (in seconds) between two fetches of a key, when a signature fails to verify with the cached copy (so
+# forged signatures naming a valid keyId don't trigger a fetch each)
+KEY_REFRESH_INTERVAL = 60.0
+
+_clock = time.monotonic
+
+# keyId -> future of the fetch in progress, so concurrent misses only fetch the key once
+_KEY_FETCHES: Dict[str, Future] = {}
+_KEY_FETCHES_LOCK = threading.Lock()
+
+# Key -> (private key, prepared PKCS#1 v1.5 signer)
+_SIGNERS: "weakref.WeakKeyDictionary[Key, Tuple[Any, Any]]" = (
+    weakref.WeakKeyDictionary()
+)
+_SIGNERS_LOCK = threading.Lock()
+
+# Executor running the RSA verifications of `verify_requests_batch` (`None` to verify in the calling thread)
+VERIFY_EXECUTOR: Optional[Executor] = None
+
+
+def use_key_cache(cache: Optional[LRUCache]) -> None:
+    """Set the cache used for the public keys (`None` to disable it)."""
+    global KEY_CACHE
+    KEY_CACHE = cache
+
+
+def use_verify_executor(executor: Optional[Executor]) -> None:
+    """Set the default executor of `verify_requests_batch`, like a `ProcessPoolExecutor` to use all the cores."""
+    global VERIFY_EXECUTOR
+    VERIFY_EXECUTOR = executor
+
 
 def _build_signed_string(
     signed_headers: str, method: str, path: str, headers: Any, body_digest: str
@@ -53,54 +102,157 @@ def _verify_h(signed_string, signature, pubkey):
     return signer.verify(digest, signature)
 
 
-def _body_digest(body: str) -> str:
+def _body_digest(body: bytes) -> str:
     h = hashlib.new("sha256")
     h.update(body)
     return "SHA-256=" + base64.b64encode(h.digest()).decode("utf-8")
 
 
-def _get_public_key(key_id: str) -> Key:
-    actor = get_backend().fetch_iri(key_id)
+def _fetch_public_key(key_id: str) -> Key:
+    backend = get_backend()
+    actor = guarded(key_id, lambda: backend.fetch_iri(key_id))
     k = Key(actor["id"])
     k.load_pub(actor["publicKey"]["publicKeyPem"])
     return k
 
 
-def verify_request(method: str, path: str, headers: Any, body: str) -> bool:
+def _cached_entry(key_id: str) -> Optional[Tuple[Key, float]]:
+    if KEY_CACHE is None:
+        return None
+    return KEY_CACHE.get(key_id)
+
+
+def _cached_public_key(key_id: str) -> Optional[Key]:
+    entry = _cached_entry(key_id)
+    if entry is None:
+        return None
+    return entry[0]
+
+
+def _get_public_key(key_id: str, refresh: bool = False) -> Key:
+    """Returns the public key for the given keyId.
+
+    `refresh` bypasses the cache (e.g. after a key rotation), unless the key was fetched less than
+    `KEY_REFRESH_INTERVAL` seconds ago.
+    """
+    entry = _cached_entry(key_id)
+    if entry is not None:
+        k, fetched_at = entry
+        if not refresh:
+            return k
+        if _clock() - fetched_at < KEY_REFRESH_INTERVAL:
+            logger.info(f"not refetching {key_id}, it was fetched recently")
+            return k
+
+    with _KEY_FETCHES_LOCK:
+        fetch = _KEY_FETCHES.get(key_id)
+        if fetch is not None:
+            leader = False
+        else:
+            leader = True
+            fetch = _KEY_FETCHES[key_id] = Future()
+
+    # Another thread is already fetching this key
+    if not leader:
+        return fetch.result()
+
+    try:
+        k = _fetch_public_key(key_id)
+        if KEY_CACHE is not None:
+            KEY_CACHE.set(key_id, (k, _clock()))
+        fetch.set_result(k)
+    except Exception as exc:
+        fetch.set_exception(exc)
+        raise
+    finally:
+        with _KEY_FETCHES_LOCK:
+            del _KEY_FETCHES[key_id]
+
+    return k
+
+
+def _verify_with_key(k: Key, hsig: Dict[str, str], signed_string: str) -> bool:
+    if k.key_id() != hsig["keyId"]:
+        return False
+
+    return _verify_h(signed_string, base64.b64decode(hsig["signature"]), k.pubkey)
+
+
+def _prepare(
+    method: str, path: str, headers: Any, body: bytes
+) -> Optional[Tuple[Dict[str, str], str]]:
+    """Returns the parsed signature header and the signed string of a request."""
     hsig = _parse_sig_header(headers.get("Signature"))
     if not hsig:
         logger.debug("no signature in header")
-        return False
+        return None
     logger.debug(f"hsig={hsig}")
     signed_string = _build_signed_string(
         hsig["headers"], method, path, headers, _body_digest(body)
     )
+    return hsig, signed_string
 
-    k = _get_public_key(hsig["keyId"])
-    if k.key_id() != hsig["keyId"]:
+
+def verify_request(method: str, path: str, headers: Any, body: bytes) -> bool:
+    prepared = _prepare(method, path, headers, body)
+    if not prepared:
         return False
+    hsig, signed_string = prepared
 
-    return _verify_h(signed_string, base64.b64decode(hsig["signature"]), k.pubkey)
+    key_id = hsig["keyId"]
+    k = _cached_public_key(key_id)
+    if k is None:
+        return _verify_with_key(_get_public_key(key_id), hsig, signed_string)
+
+    if _verify_with_key(k, hsig, signed_string):
+        return True
+
+    # The cached key may be outdated (the actor may have rotated its key), try again with a fresh copy
+    logger.info(f"failed to verify the signature with the cached key {key_id}")
+    fresh = _get_public_key(key_id, refresh=True)
+    if fresh is k:
+        return False
+    return _verify_with_key(fresh, hsig, signed_string)
+
+
+def _get_signer(key: Key) -> Any:
+    """Returns the PKCS#1 v1.5 signer of the key, prepared once per `Key` (and private key)."""
+    with _SIGNERS_LOCK:
+        privkey = key.privkey
+        if privkey is None:
+            raise ValueError(f"no private key loaded for {key.key_id()}")
+        cached = _SIGNERS.get(key)
+        if cached is not None and cached[0] is privkey:
+            return cached[1]
+        signer = PKCS1_v1_5.new(privkey)
+        _SIGNERS[key] = (privkey, signer)
+        return signer
 
 
 class HTTPSigAuth(AuthBase):
-    """Requests auth plugin for signing requests on the fly."""
+    """Requests auth plugin for signing requests on the fly.
+
+    When delivering the same payload to many inboxes, the body digest is only computed once and only the
+    signing string is built for every recipient.
+    """
 
     def __init__(self, key: Key) -> None:
         self.key = key
+        self._digests = LRUCache(maxsize=16)
+
+    def body_digest(self, body: Union[str, bytes]) -> str:
+        digest = self._digests.get(body)
+        if digest is None:
+            encoded = body.encode("utf-8") if isinstance(body, str) else body
+            digest = _body_digest(encoded)
+            self._digests.set(body, digest)
+        return digest
 
     def __call__(self, r):
         logger.info(f"keyid={self.key.key_id()}")
         host = urlparse(r.url).netloc
 
-        bh = hashlib.new("sha256")
-        body = r.body
-        try:
-            body = r.body.encode("utf-8")
-        except AttributeError:
-            pass
-        bh.update(body)
-        bodydigest = "SHA-256=" + base64.b64encode(bh.digest()).decode("utf-8")
+        bodydigest = self.body_digest(r.body)
 
         date = datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
 
@@ -111,10 +263,9 @@ class HTTPSigAuth(AuthBase):
         to_be_signed = _build_signed_string(
             sigheaders, r.method, r.path_url, r.headers, bodydigest
         )
-        signer = PKCS1_v1_5.new(self.key.privkey)
         digest = SHA256.new()
         digest.update(to_be_signed.encode("utf-8"))
-        sig = base64.b64encode(signer.sign(digest))
+        sig = base64.b64encode(_get_signer(self.key).sign(digest))
         sig = sig.decode("utf-8")
 
         key_id = self.key.key_id()
@@ -126,3 +277,106 @@ class HTTPSigAuth(AuthBase):
         r.headers.update(headers)
 
         return r
+
+
+@functools.lru_cache(maxsize=256)
+def _import_pubkey(pubkey_pem: str) -> Any:
+    return RSA.importKey(pubkey_pem)
+
+
+def _verify_pem(args: Tuple[str, str, bytes]) -> bool:
+    """Verify a signature using the PEM of the public key (picklable, so it can run in a process pool)."""
+    pubkey_pem, signed_string, signature = args
+    return _verify_h(signed_string, signature, _import_pubkey(pubkey_pem))
+
+
+def _resolve_keys(key_ids: List[str], refresh: bool = False) -> Dict[str, Key]:
+    def _resolve(key_id: str) -> Tuple[str, Optional[Key]]:
+        try:
+            return key_id, _get_public_key(key_id, refresh=refresh)
+        except Exception:
+            logger.exception(f"failed to fetch the public key {key_id}")
+            return key_id, None
+
+    with resolver_pool(len(key_ids)) as pool:
+        return {key_id: k for key_id, k in pool.map(_resolve, key_ids) if k}
+
+
+def _verify_batch(
+    prepared: List[Optional[Tuple[Dict[str, str], str]]],
+    keys: Dict[str, Key],
+    executor: Optional[Executor],
+) -> List[bool]:
+    verdicts = [False] * len(prepared)
+    indexes = []
+    todo = []
+    for i, p in enumerate(prepared):
+        if p is None:
+            continue
+        hsig, signed_string = p
+        k = keys.get(hsig["keyId"])
+        if k is None or k.pubkey_pem is None or k.key_id() != hsig["keyId"]:
+            continue
+        try:
+            signature = base64.b64decode(hsig["signature"])
+        except binascii.Error:
+            continue
+        indexes.append(i)
+        todo.append((k.pubkey_pem, signed_string, signature))
+
+    if executor is None:
+        results: Iterable[bool] = map(_verify_pem, todo)
+    else:
+        results = executor.map(_verify_pem, todo, chunksize=8)
+    for i, ok in zip(indexes, results):
+        verdicts[i] = ok
+
+    return verdicts
+
+
+def verify_requests_batch(
+    requests: Iterable[Tuple[str, str, Any, bytes]], executor: Optional[Executor] = None
+) -> List[bool]:
+    """Verify many `(method, path, headers, body)` requests at once, returns the verdicts in the same order.
+
+    Every public key is resolved once for the whole batch, and the RSA verifications are run on `executor`
+    (defaults to `VERIFY_EXECUTOR`).
+    """
+    if executor is None:
+        executor = VERIFY_EXECUTOR
+
+    prepared: List[Optional[Tuple[Dict[str, str], str]]] = []
+    for method, path, headers, body in requests:
+        try:
+            prepared.append(_prepare(method, path, headers, body))
+        except Exception:
+            logger.exception(f"invalid signed request {method} {path}")
+            prepared.append(None)
+
+    # Key ID of the signed requests, by index
+    key_id_at = {i: p[0]["keyId"] for i, p in enumerate(prepared) if p}
+    key_ids = list(dict.fromkeys(key_id_at.values()))
+    cached = {key_id for key_id in key_ids if _cached_public_key(key_id)}
+    keys = _resolve_keys(key_ids)
+    verdicts = _verify_batch(prepared, keys, executor)
+
+    # The cached keys may be outdated (the actors may have rotated their keys), try again with a fresh copy
+    retry = [
+        i for i, key_id in key_id_at.items() if not verdicts[i] and key_id in cached
+    ]
+    if retry:
+        stale = list(dict.fromkeys(key_id_at[i] for i in retry))
+        # The keys fetched recently are not refetched (see `KEY_REFRESH_INTERVAL`)
+        fresh = {
+            key_id: k
+            for key_id, k in _resolve_keys(stale, refresh=True).items()
+            if k is not keys.get(key_id)
+        }
+        keys.update(fresh)
+        retry = [i for i in retry if key_id_at[i] in fresh]
+        for i, ok in zip(
+            retry, _verify_batch([prepared[i] for i in retry], keys, executor)
+        ):
+            verdicts[i] = ok
+
+    return verdicts
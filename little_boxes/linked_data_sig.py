@@ -1,17 +1,145 @@
 import base64
 import hashlib
+import json
+import logging
+import os
+import threading
+import time
 import typing
 from datetime import datetime
 from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import Optional
 
 from Crypto.Hash import SHA256
 from Crypto.Signature import PKCS1_v1_5
 from pyld import jsonld
 
+from . import canonicalization
+from .cache import LRUCache
+
 if typing.TYPE_CHECKING:
     from .key import Key  # noqa: type checking
 
+logger = logging.getLogger(__name__)
+
+_CONTEXTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "contexts")
+
+# Contexts shipped with the package, loaded without touching the network
+BUNDLED_CONTEXTS = {
+    "https://www.w3.org/ns/activitystreams": "activitystreams.jsonld",
+    "http://www.w3.org/ns/activitystreams": "activitystreams.jsonld",
+    "https://w3id.org/security/v1": "security-v1.jsonld",
+    "https://w3c-ccg.github.io/security-vocab/contexts/security-v1.jsonld": "security-v1.jsonld",
+    "https://w3id.org/identity/v1": "identity-v1.jsonld",
+}
+
+
+class ContextCache(object):
+    """On-disk cache for the JSON-LD contexts that are not bundled, shared across processes.
+
+    Args:
+        path: the directory where the contexts are stored
+        max_size: the maximum size (in bytes) of the cache, the oldest entries are evicted first
+        ttl: the number of seconds a context is kept before being fetched again
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_size: int = 10 * 1024 * 1024,
+        ttl: float = 7 * 24 * 3600,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def _path(self, url: str) -> str:
+        return os.path.join(
+            self.path, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json"
+        )
+
+    def get(self, url: str) -> Optional[Dict[str, Any]]:
+        path = self._path(url)
+        try:
+            if os.path.getmtime(path) + self.ttl <= self._clock():
+                os.remove(path)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, url: str, remote_doc: Dict[str, Any]) -> None:
+        path = self._path(url)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self._lock:
+            with open(tmp, "w") as f:
+                json.dump(remote_doc, f)
+            os.replace(tmp, path)
+            os.utime(path, (self._clock(), self._clock()))
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+
+# Optional on-disk cache for the contexts that are not bundled
+CONTEXT_CACHE: Optional[ContextCache] = None
+
+# Never fetch contexts from the network (only the bundled/cached contexts can be used)
+STRICT_OFFLINE = False
+
+
+def use_context_cache(cache: Optional[ContextCache]) -> None:
+    """Set the on-disk cache for the remote contexts (`None` to disable it)."""
+    global CONTEXT_CACHE
+    CONTEXT_CACHE = cache
+
+
+def use_strict_offline(strict: bool = True) -> None:
+    """Forbid (or allow again) fetching the contexts from the network."""
+    global STRICT_OFFLINE
+    STRICT_OFFLINE = strict
+
+
+def _load_bundled(url: str) -> Optional[Dict[str, Any]]:
+    name = BUNDLED_CONTEXTS.get(url)
+    if name is None:
+        return None
+    with open(os.path.join(_CONTEXTS_DIR, name)) as f:
+        return {"contextUrl": None, "documentUrl": url, "document": json.load(f)}
+
+
+def _load_bundled_context(url: str) -> Optional[Dict[str, Any]]:
+    resp = _load_bundled(url)
+    if resp is None:
+        return None
+    return resp["document"]
+
 
 # cache the downloaded "schemas", otherwise the library is super slow
 # (https://github.com/digitalbazaar/pyld/issues/70)
@@ -19,16 +147,85 @@ _CACHE: Dict[str, Any] = {}
 LOADER = jsonld.requests_document_loader()
 
 
-def _caching_document_loader(url: str) -> Any:
+def _caching_document_loader(url: str, options: Any = None) -> Any:
     if url in _CACHE:
         return _CACHE[url]
-    resp = LOADER(url)
+
+    resp = _load_bundled(url)
+    if resp is None and CONTEXT_CACHE is not None:
+        resp = CONTEXT_CACHE.get(url)
+    if resp is None:
+        if STRICT_OFFLINE:
+            raise jsonld.JsonLdError(
+                f"refusing to fetch {url} (strict offline mode)",
+                "jsonld.LoadDocumentError",
+                {"url": url},
+                code="loading document failed",
+            )
+        logger.info(f"fetching the JSON-LD document {url}")
+        resp = LOADER(url)
+        if CONTEXT_CACHE is not None:
+            CONTEXT_CACHE.set(url, resp)
+
     _CACHE[url] = resp
     return resp
 
 
 jsonld.set_document_loader(_caching_document_loader)
 
+# Cache of the hashes of the normalized documents, keyed by a hash of their content (`None` to disable it)
+CANONICALIZATION_CACHE: Optional[LRUCache] = LRUCache(maxsize=4096)
+
+
+# Use the fast path canonicalizer for the documents it supports (falling back to pyld)
+FAST_CANONICALIZATION = True
+
+
+def use_canonicalization_cache(cache: Optional[LRUCache]) -> None:
+    """Set the cache used for the normalized documents hashes (`None` to disable it)."""
+    global CANONICALIZATION_CACHE
+    CANONICALIZATION_CACHE = cache
+
+
+def use_fast_canonicalization(enabled: bool = True) -> None:
+    global FAST_CANONICALIZATION
+    FAST_CANONICALIZATION = enabled
+
+
+def _normalize(doc: Dict[str, Any]) -> str:
+    if FAST_CANONICALIZATION:
+        normalized = canonicalization.canonicalize(doc, _load_bundled_context)
+        if normalized is not None:
+            return normalized
+
+    return jsonld.normalize(
+        doc, {"algorithm": "URDNA2015", "format": "application/nquads"}
+    )
+
+
+def _content_hash(doc: Dict[str, Any]) -> str:
+    """Returns a stable hash of the document (independent of the keys order)."""
+    encoded = json.dumps(doc, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def _normalized_hash(doc: Dict[str, Any]) -> str:
+    """Returns the SHA-256 hex digest of the URDNA2015 normalization of the document."""
+    key = None
+    if CANONICALIZATION_CACHE is not None:
+        key = _content_hash(doc)
+        cached = CANONICALIZATION_CACHE.get(key)
+        if cached is not None:
+            return cached
+
+    h = hashlib.new("sha256")
+    h.update(_normalize(doc).encode("utf-8"))
+    out = h.hexdigest()
+
+    if CANONICALIZATION_CACHE is not None:
+        CANONICALIZATION_CACHE.set(key, out)
+    return out
+
 
 def _options_hash(doc):
     doc = dict(doc["signature"])
@@ -36,24 +233,14 @@ def _options_hash(doc):
         if k in doc:
             del doc[k]
     doc["@context"] = "https://w3id.org/identity/v1"
-    normalized = jsonld.normalize(
-        doc, {"algorithm": "URDNA2015", "format": "application/nquads"}
-    )
-    h = hashlib.new("sha256")
-    h.update(normalized.encode("utf-8"))
-    return h.hexdigest()
+    return _normalized_hash(doc)
 
 
 def _doc_hash(doc):
     doc = dict(doc)
     if "signature" in doc:
         del doc["signature"]
-    normalized = jsonld.normalize(
-        doc, {"algorithm": "URDNA2015", "format": "application/nquads"}
-    )
-    h = hashlib.new("sha256")
-    h.update(normalized.encode("utf-8"))
-    return h.hexdigest()
+    return _normalized_hash(doc)
 
 
 def verify_signature(doc, key: "Key"):
@@ -0,0 +1,188 @@
+"""Actor routing index, to find where to deliver activities without fetching the actors."""
+import abc
+import sqlite3
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Mapping
+from typing import NamedTuple
+from typing import Optional
+from urllib.parse import urlparse
+
+# Actor types that have an inbox
+ACTOR_TYPES = ["Person", "Service", "Application", "Group", "Organization"]
+
+
+class Route(NamedTuple):
+    inbox: Optional[str]
+    shared_inbox: Optional[str]
+    host: str
+
+    @property
+    def delivery_inbox(self) -> Optional[str]:
+        """Returns the inbox to deliver to (the shared inbox is preferred)."""
+        return self.shared_inbox or self.inbox
+
+
+def route_from_actor(actor: Mapping[str, Any]) -> Optional[Route]:
+    """Build the `Route` for the given actor, returns None if it's not an actor with an inbox."""
+    if actor.get("type") not in ACTOR_TYPES or "id" not in actor:
+        return None
+
+    inbox = actor.get("inbox")
+    shared_inbox = None
+    if isinstance(actor.get("endpoints"), dict):
+        shared_inbox = actor["endpoints"].get("sharedInbox")
+    if not inbox and not shared_inbox:
+        return None
+
+    return Route(inbox, shared_inbox, urlparse(actor["id"]).netloc)
+
+
+class RoutingIndex(abc.ABC):
+    """Maps actor IRIs to their `Route`."""
+
+    @abc.abstractmethod
+    def get(self, actor_id: str) -> Optional[Route]:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def set(self, actor_id: str, route: Route) -> None:
+        pass  # pragma: no cover
+
+    @abc.abstractmethod
+    def delete(self, actor_id: str) -> None:
+        pass  # pragma: no cover
+
+    def get_many(self, actor_ids: Iterable[str]) -> Dict[str, Route]:
+        """Returns the known routes for the given actors (unknown actors are left out)."""
+        out = {}
+        for actor_id in actor_ids:
+            route = self.get(actor_id)
+            if route is not None:
+                out[actor_id] = route
+        return out
+
+    def shared_inboxes(self, hosts: Iterable[str]) -> Dict[str, str]:
+        """Returns the shared inbox advertised by an actor of each of the given hosts (if any is known).
+
+        Not supported by default, the index implementations may override it.
+        """
+        return {}
+
+    def update_from_actor(
+        self, actor: Dict[str, Any], fetched_iri: Optional[str] = None
+    ) -> Optional[Route]:
+        """Index the route of an actor.
+
+        `fetched_iri` is the IRI the actor was fetched from: the actor is only indexed if its ID matches it, so a
+        remote server can't overwrite the route of an actor it doesn't host.
+        """
+        if fetched_iri is not None and actor.get("id") != fetched_iri:
+            return None
+        route = route_from_actor(actor)
+        if route is not None:
+            self.set(actor["id"], route)
+        return route
+
+
+class InMemoryRoutingIndex(RoutingIndex):
+    def __init__(self) -> None:
+        self._routes: Dict[str, Route] = {}
+        self._shared_inboxes: Dict[str, str] = {}
+
+    def get(self, actor_id: str) -> Optional[Route]:
+        return self._routes.get(actor_id)
+
+    def set(self, actor_id: str, route: Route) -> None:
+        self._routes[actor_id] = route
+        if route.shared_inbox:
+            self._shared_inboxes[route.host] = route.shared_inbox
+
+    def shared_inboxes(self, hosts: Iterable[str]) -> Dict[str, str]:
+        return {
+            host: self._shared_inboxes[host]
+            for host in hosts
+            if host in self._shared_inboxes
+        }
+
+    def delete(self, actor_id: str) -> None:
+        self._routes.pop(actor_id, None)
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+
+class SqliteRoutingIndex(RoutingIndex):
+    """Persistent routing index stored in a SQLite database."""
+
+    # Max number of variables in a single query
+    _CHUNK_SIZE = 500
+
+    def __init__(self, path: str) -> None:
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS routes ("
+                "actor_id TEXT PRIMARY KEY, inbox TEXT, shared_inbox TEXT, host TEXT NOT NULL, "
+                "updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS routes_host_idx ON routes (host)"
+            )
+
+    def get(self, actor_id: str) -> Optional[Route]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT inbox, shared_inbox, host FROM routes WHERE actor_id = ?",
+                (actor_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return Route(*row)
+
+    def get_many(self, actor_ids: Iterable[str]) -> Dict[str, Route]:
+        ids = list(actor_ids)
+        out = {}
+        for i in range(0, len(ids), self._CHUNK_SIZE):
+            chunk = ids[i : i + self._CHUNK_SIZE]  # noqa: E203
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT actor_id, inbox, shared_inbox, host FROM routes "
+                    f"WHERE actor_id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+            for actor_id, *route in rows:
+                out[actor_id] = Route(*route)
+        return out
+
+    def shared_inboxes(self, hosts: Iterable[str]) -> Dict[str, str]:
+        out = {}
+        for host in dict.fromkeys(hosts):
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT shared_inbox FROM routes WHERE host = ? AND shared_inbox IS NOT NULL "
+                    "ORDER BY updated_at DESC LIMIT 1",
+                    (host,),
+                ).fetchone()
+            if row is not None:
+                out[host] = row[0]
+        return out
+
+    def set(self, actor_id: str, route: Route) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO routes (actor_id, inbox, shared_inbox, host, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (actor_id, route.inbox, route.shared_inbox, route.host, time.time()),
+            )
+
+    def delete(self, actor_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM routes WHERE actor_id = ?", (actor_id,))
+
+    def close(self) -> None:
+        self._conn.close()
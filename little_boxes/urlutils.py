@@ -2,9 +2,15 @@ import ipaddress
 import logging
 import os
 import socket
+import time
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
 from urllib.parse import urlparse
 
 from . import strtobool
+from .cache import LRUCache
 from .errors import Error
 
 logger = logging.getLogger(__name__)
@@ -14,36 +20,96 @@ class InvalidURLError(Error):
     pass
 
 
-def is_url_valid(url: str) -> bool:
-    parsed = urlparse(url)
-    if parsed.scheme not in ["http", "https"]:
-        return False
+class DNSCache(object):
+    """TTL-bounded cache of the DNS lookups (the failed lookups are cached for `negative_ttl`)."""
+
+    def __init__(
+        self,
+        maxsize: int = 4096,
+        ttl: float = 300.0,
+        negative_ttl: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.negative_ttl = negative_ttl
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl, clock=clock)
+
+    def resolve(self, hostname: str, port: int) -> List[str]:
+        key = hostname.lower()
+        ip_addresses = self._cache.get(key, _MISSING)
+        if ip_addresses is _MISSING:
+            ip_addresses = _lookup(hostname, port)
+            self._cache.set(
+                key, ip_addresses, ttl=None if ip_addresses else self.negative_ttl
+            )
+        return ip_addresses
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return self._cache.stats()
+
+
+_MISSING = object()
+
+# Cache of the lookups made to validate the URLs (and to connect to the validated IP), `None` to disable it
+DNS_CACHE: Optional[DNSCache] = DNSCache()
+
+
+def use_dns_cache(cache: Optional[DNSCache]) -> None:
+    global DNS_CACHE
+    DNS_CACHE = cache
+
 
+def _debug_mode() -> bool:
     # XXX in debug mode, we want to allow requests to localhost to test the federation with local instances
-    debug_mode = strtobool(os.getenv("MICROBLOGPUB_DEBUG", "false"))
-    if debug_mode:  # pragma: no cover
-        return True
+    return strtobool(os.getenv("MICROBLOGPUB_DEBUG", "false"))
 
-    if parsed.hostname in ["localhost"]:
-        return False
 
+def _lookup(hostname: str, port: int) -> List[str]:
+    """Returns the addresses of the host, in the order they should be tried."""
     try:
-        ip_address = ipaddress.ip_address(parsed.hostname)
+        infos = socket.getaddrinfo(hostname, port)
+    except socket.gaierror:
+        logger.exception(f"failed to lookup {hostname}")
+        return []
+    ip_addresses = list(dict.fromkeys(str(info[4][0]) for info in infos))
+    logger.debug(f"dns lookup: {hostname} -> {ip_addresses}")
+    return ip_addresses
+
+
+def validated_ips(hostname: Optional[str], port: Optional[int] = None) -> List[str]:
+    """Returns the IP addresses to connect to for the host (in order), or an empty list if it can't be resolved or
+    one of its addresses is private."""
+    if not hostname or hostname in ["localhost"]:
+        return []
+
+    try:
+        ip_addresses = [ipaddress.ip_address(hostname)]
     except ValueError:
-        try:
-            ip_address = socket.getaddrinfo(parsed.hostname, parsed.port or 80)[0][4][0]
-            logger.debug(f"dns lookup: {parsed.hostname} -> {ip_address}")
-        except socket.gaierror:
-            logger.exception(f"failed to lookup url {url}")
-            return False
+        if DNS_CACHE is not None:
+            resolved = DNS_CACHE.resolve(hostname, port or 80)
+        else:
+            resolved = _lookup(hostname, port or 80)
+        ip_addresses = [ipaddress.ip_address(ip) for ip in resolved]
+
+    for ip_address in ip_addresses:
+        if ip_address.is_private:
+            logger.info(f"rejecting private address {ip_address} for {hostname}")
+            return []
 
-    logger.debug(f"{ip_address}")
+    return [str(ip_address) for ip_address in ip_addresses]
 
-    if ipaddress.ip_address(ip_address).is_private:
-        logger.info(f"rejecting private URL {url}")
+
+def is_url_valid(url: str) -> bool:
+    parsed = urlparse(url)
+    if parsed.scheme not in ["http", "https"]:
         return False
 
-    return True
+    if _debug_mode():  # pragma: no cover
+        return True
+
+    return bool(validated_ips(parsed.hostname, parsed.port))
 
 
 def check_url(url: str) -> None:
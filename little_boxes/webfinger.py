@@ -1,52 +1,244 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 from typing import Dict
+from typing import Iterable
+from typing import List
 from typing import Optional
+from typing import Tuple
 from urllib.parse import urlparse
 
 import requests
 
 from .activitypub import get_backend
+from .cache import LRUCache
+from .urlutils import InvalidURLError
 from .urlutils import check_url
 
 logger = logging.getLogger(__name__)
 
+# Optional cache of the resolutions (normalized resource -> JRD document, or None if it didn't resolve)
+WEBFINGER_CACHE: Optional[LRUCache] = None
+
+# TTL (in seconds) of the negative entries (404s and unreachable hosts), shorter than the default TTL of the cache
+NEGATIVE_TTL = 300.0
+
+_MISSING = object()
+
+
+def use_webfinger_cache(cache: Optional[LRUCache]) -> None:
+    """Set the cache used to avoid repeating the WebFinger resolutions (`None` to disable it)."""
+    global WEBFINGER_CACHE
+    WEBFINGER_CACHE = cache
+
+
+def normalize_resource(resource: str) -> Tuple[str, str]:
+    """Returns the normalized resource and its host.
+
+    `acct:dev@microblog.pub`, `@dev@microblog.pub` and `dev@Microblog.pub` are all normalized to
+    `acct:dev@microblog.pub`, URLs are kept as is.
+    """
+    if resource.startswith(("http://", "https://")):
+        return resource, urlparse(resource).netloc
+
+    if resource.startswith("acct:"):
+        resource = resource[5:]
+    if resource.startswith("@"):
+        resource = resource[1:]
+    username, host = resource.split("@", 1)
+    host = host.lower()
+    return f"acct:{username}@{host}", host
+
+
+def _protos(resource: str, known: Optional[str] = None) -> List[str]:
+    protos = ["http", "https"] if resource.startswith("http://") else ["https", "http"]
+    if known in protos:
+        protos.remove(known)
+        protos.insert(0, known)
+    return protos
+
+
+def _proto_key(host: str) -> str:
+    return f"proto:{host}"
+
+
+def _known_proto(host: str) -> Optional[str]:
+    """Returns the protocol the host answered on the last time, if it's still in the cache."""
+    if WEBFINGER_CACHE is None:
+        return None
+    return WEBFINGER_CACHE.get(_proto_key(host))
+
+
+def _remember_proto(host: str, proto: str) -> None:
+    # Only kept for `NEGATIVE_TTL`, so a failed https connection can't downgrade the host for long
+    if WEBFINGER_CACHE is not None:
+        WEBFINGER_CACHE.set(_proto_key(host), proto, ttl=NEGATIVE_TTL)
+
+
+def _fetch(resource: str, host: str, protos: List[str]) -> Tuple[Optional[Dict[str, Any]], str]:
+    """Returns the JRD document (or None) and the protocol the host answered on.
+
+    Raises `requests.ConnectionError` if the host can't be reached with any of the protocols.
+    """
+    error = None
+    for proto in protos:
+        try:
+            url = f"{proto}://{host}/.well-known/webfinger"
+            resp = get_backend().fetch_json(url, params={"resource": resource})
+        except requests.ConnectionError as exc:
+            # If we tried https first and the domain is "http only"
+            logger.info(f"failed to connect to {host} over {proto}")
+            error = exc
+            continue
+
+        if proto != protos[0]:
+            _remember_proto(host, proto)
+        if resp.status_code == 404:
+            return None, proto
+        resp.raise_for_status()
+        return resp.json(), proto
+
+    raise error  # type: ignore
+
+
+def _cache(resource: str, data: Optional[Dict[str, Any]]) -> None:
+    if WEBFINGER_CACHE is not None:
+        WEBFINGER_CACHE.set(resource, data, ttl=NEGATIVE_TTL if data is None else None)
+
 
 def webfinger(resource: str) -> Optional[Dict[str, Any]]:
     """Mastodon-like WebFinger resolution to retrieve the activity stream Actor URL.
+
+    Returns None if the resource is not found or the host is unreachable (both cached for `NEGATIVE_TTL`).
     """
-    logger.info(f"performing webfinger resolution for {resource}")
-    protos = ["https", "http"]
-    if resource.startswith("http://"):
-        protos.reverse()
-        host = urlparse(resource).netloc
-    elif resource.startswith("https://"):
-        host = urlparse(resource).netloc
-    else:
-        if resource.startswith("acct:"):
-            resource = resource[5:]
-        if resource.startswith("@"):
-            resource = resource[1:]
-        _, host = resource.split("@", 1)
-        resource = "acct:" + resource
+    resource, host = normalize_resource(resource)
+
+    if WEBFINGER_CACHE is not None:
+        cached = WEBFINGER_CACHE.get(resource, _MISSING)
+        if cached is not _MISSING:
+            return cached
 
+    logger.info(f"performing webfinger resolution for {resource}")
     # Security check on the url (like not calling localhost)
     check_url(f"https://{host}")
 
-    for i, proto in enumerate(protos):
+    try:
+        data, _ = _fetch(resource, host, _protos(resource, _known_proto(host)))
+    except requests.ConnectionError:
+        data = None
+    _cache(resource, data)
+    return data
+
+
+class WebfingerResults(object):
+    """Outcome of `resolve_many`, by resource (as given): the JRD documents found, the resources that don't exist,
+    and the ones that failed (with the error)."""
+
+    def __init__(self) -> None:
+        self.found: Dict[str, Dict[str, Any]] = {}
+        self.not_found: List[str] = []
+        self.failed: Dict[str, Exception] = {}
+
+    def _add(
+        self,
+        resources: List[str],
+        data: Optional[Dict[str, Any]],
+        error: Optional[Exception] = None,
+    ) -> None:
+        for resource in resources:
+            if error is not None:
+                self.failed[resource] = error
+            elif data is None:
+                self.not_found.append(resource)
+            else:
+                self.found[resource] = data
+
+    def __repr__(self) -> str:
+        return (
+            f"WebfingerResults(found={len(self.found)}, not_found={len(self.not_found)}, "
+            f"failed={len(self.failed)})"
+        )
+
+
+_Outcome = Tuple[str, Optional[Dict[str, Any]], Optional[Exception], Optional[str]]
+
+
+def resolve_many(
+    resources: Iterable[str], max_workers: int = 16, per_host: int = 2
+) -> WebfingerResults:
+    """Resolve many resources concurrently, with at most `per_host` requests in flight for a given host.
+
+    The first resource of each host is resolved on its own, to find out the protocol the host answers on (and if
+    it's reachable at all), the others are then resolved with this protocol first. The resources of an unreachable
+    (or invalid) host are failed without contacting it again, without affecting the other hosts.
+    """
+    results = WebfingerResults()
+    # Host -> normalized resource -> the resources as given
+    by_host: Dict[str, Dict[str, List[str]]] = {}
+    for original in resources:
         try:
-            url = f"{proto}://{host}/.well-known/webfinger"
-            # FIXME(tsileo): BACKEND.fetch_json so we can set a UserAgent
-            resp = get_backend().fetch_json(url, params={"resource": resource})
-        except requests.ConnectionError:
-            # If we tried https first and the domain is "http only"
-            if i == 0:
+            resource, host = normalize_resource(original)
+        except ValueError as exc:
+            results.failed[original] = exc
+            continue
+        if WEBFINGER_CACHE is not None:
+            cached = WEBFINGER_CACHE.get(resource, _MISSING)
+            if cached is not _MISSING:
+                results._add([original], cached)
                 continue
-            break
-    if resp.status_code == 404:
-        return None
-    resp.raise_for_status()
-    return resp.json()
+        by_host.setdefault(host, {}).setdefault(resource, []).append(original)
+
+    if not by_host:
+        return results
+
+    def _resolve(host: str, resource: str, known: Optional[str]) -> _Outcome:
+        try:
+            data, proto = _fetch(resource, host, _protos(resource, known))
+        except requests.ConnectionError as exc:
+            _cache(resource, None)
+            return resource, None, exc, None
+        except Exception as exc:
+            return resource, None, exc, None
+        _cache(resource, data)
+        return resource, data, None, proto
+
+    def _probe(host: str) -> _Outcome:
+        try:
+            check_url(f"https://{host}")
+        except Exception as exc:
+            return next(iter(by_host[host])), None, exc, None
+        return _resolve(host, next(iter(by_host[host])), _known_proto(host))
+
+    def _resolve_lane(host: str, lane: List[str], known: Optional[str]) -> List[_Outcome]:
+        return [_resolve(host, resource, known) for resource in lane]
+
+    hosts = list(by_host)
+    lanes: List[Tuple[str, List[str], Optional[str]]] = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(hosts))) as pool:
+        for host, (resource, data, error, proto) in zip(hosts, pool.map(_probe, hosts)):
+            results._add(by_host[host][resource], data, error)
+            rest = list(by_host[host])[1:]
+            if isinstance(error, (requests.ConnectionError, InvalidURLError)):
+                # The host is unreachable/invalid, no need to try again
+                for other in rest:
+                    results._add(by_host[host][other], None, error)
+                continue
+            lanes.extend(
+                (host, rest[i::per_host], proto)
+                for i in range(per_host)
+                if rest[i::per_host]
+            )
+
+    if lanes:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(lanes))) as pool:
+            for (host, _, _), outcomes in zip(
+                lanes, pool.map(lambda lane: _resolve_lane(*lane), lanes)
+            ):
+                for resource, data, error, _ in outcomes:
+                    results._add(by_host[host][resource], data, error)
+
+    logger.info(f"resolved {results!r}")
+    return results
 
 
 def get_remote_follow_template(resource: str) -> Optional[str]:
@@ -21,7 +21,7 @@ REQUIRES_PYTHON = ">=3.6.0"
 VERSION = None
 
 
-REQUIRED = ["requests", "markdown", "bleach", "pyld", "pycryptodome", "html2text"]
+REQUIRED = ["requests", "markdown", "bleach", "pyld>=2", "pycryptodome", "html2text"]
 
 DEPENDENCY_LINKS = []
 
@@ -51,6 +51,7 @@ setup(
     python_requires=REQUIRES_PYTHON,
     url=URL,
     packages=find_packages(),
+    package_data={"little_boxes": ["contexts/*.jsonld"]},
     install_requires=REQUIRED,
     dependency_links=DEPENDENCY_LINKS,
     license="ISC",
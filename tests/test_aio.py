@@ -0,0 +1,290 @@
+import asyncio
+import functools
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from little_boxes import activitypub as ap
+from little_boxes import aio
+from little_boxes.delivery_queue import SqliteDeliveryQueue
+from test_backend import InMemBackend
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+def _hook(name):
+    """Wraps a hook of the in-memory backend, running it out of the event loop as it may call the sync API."""
+
+    async def hook(self, *args):
+        return await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(getattr(self.back, name), *args)
+        )
+
+    return hook
+
+
+class InMemAsyncBackend(aio.AsyncBackend):
+    """Async wrapper around the in-memory test backend."""
+
+    def __init__(self, back: InMemBackend) -> None:
+        self.back = back
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def base_url(self):
+        return self.back.base_url()
+
+    def activity_url(self, obj_id):
+        return self.back.activity_url(obj_id)
+
+    def random_object_id(self):
+        return self.back.random_object_id()
+
+    async def fetch_iri(self, iri):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return self.back.fetch_iri(iri)
+
+    async def post_to_remote_inbox(self, as_actor, payload_encoded, recp):
+        self.back._METHOD_CALLS[as_actor.id].append(
+            ("post_to_remote_inbox", (self, as_actor, payload_encoded, recp), {})
+        )
+        as_actor = ap.Person(**self.back.fetch_iri(recp.replace("/inbox", "")))
+        await aio.process_from_inbox(json.loads(payload_encoded), as_actor)
+
+    is_from_outbox = _hook("is_from_outbox")
+    inbox_get_by_iri = _hook("inbox_get_by_iri")
+    outbox_create = _hook("outbox_create")
+    outbox_delete = _hook("outbox_delete")
+    inbox_create = _hook("inbox_create")
+    inbox_delete = _hook("inbox_delete")
+    outbox_is_blocked = _hook("outbox_is_blocked")
+    inbox_new = _hook("inbox_new")
+    outbox_new = _hook("outbox_new")
+    new_follower = _hook("new_follower")
+    new_following = _hook("new_following")
+    undo_new_follower = _hook("undo_new_follower")
+    undo_new_following = _hook("undo_new_following")
+    inbox_update = _hook("inbox_update")
+    outbox_update = _hook("outbox_update")
+    inbox_like = _hook("inbox_like")
+    inbox_undo_like = _hook("inbox_undo_like")
+    outbox_like = _hook("outbox_like")
+    outbox_undo_like = _hook("outbox_undo_like")
+    inbox_announce = _hook("inbox_announce")
+    inbox_undo_announce = _hook("inbox_undo_announce")
+    outbox_announce = _hook("outbox_announce")
+    outbox_undo_announce = _hook("outbox_undo_announce")
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def _setup():
+    back = InMemBackend()
+    aback = InMemAsyncBackend(back)
+    aio.use_backend(aback)
+    return back, aback
+
+
+def test_aio_follow():
+    back, _ = _setup()
+    me = back.setup_actor("Thomas", "tom")
+    other = back.setup_actor("Thomas", "tom2")
+
+    async def _follow():
+        follow = await aio.run_sync(ap.Follow, actor=me.id, object=other.id)
+        return await aio.post_to_outbox(follow)
+
+    summary = _run(_follow())
+
+    assert summary.ok
+    assert summary.succeeded == [other.inbox]
+    assert back.followers(other) == [me.id]
+    assert back.following(me) == [other.id]
+
+
+def test_aio_recipients_fetched_concurrently():
+    back, aback = _setup()
+    me = back.setup_actor("Thomas", "tom")
+    followers = [back.setup_actor("Follower", f"follower{i}").id for i in range(20)]
+    back.FOLLOWERS[me.id] = followers
+
+    async def _recipients():
+        create = await aio.parse_activity(
+            {
+                "type": "Create",
+                "actor": me.id,
+                "to": [ap.AS_PUBLIC],
+                "cc": [me.followers],
+                "object": {"type": "Note", "attributedTo": me.id, "content": "Hello"},
+            }
+        )
+        aback.max_in_flight = 0
+        return await aio.recipients(create)
+
+    out = _run(_recipients())
+
+    assert out == [f"{follower}/inbox" for follower in followers]
+    assert aback.max_in_flight > 1
+
+
+def test_aio_post_to_outbox_enqueues(tmp_path):
+    back, aback = _setup()
+    me = back.setup_actor("Thomas", "tom")
+    back.FOLLOWERS[me.id] = [back.setup_actor("Follower", "follower").id]
+    queue = SqliteDeliveryQueue(str(tmp_path / "queue.db"))
+
+    async def _post():
+        create = await aio.parse_activity(
+            {
+                "type": "Create",
+                "actor": me.id,
+                "cc": [me.followers],
+                "object": {"type": "Note", "attributedTo": me.id, "content": "Hello"},
+            }
+        )
+        return await aio.post_to_outbox(create)
+
+    fetched = []
+    fetch_iri = aback.fetch_iri
+
+    async def _fetch_iri(iri):
+        fetched.append(iri)
+        return await fetch_iri(iri)
+
+    aback.fetch_iri = _fetch_iri
+    ap.use_delivery_queue(queue)
+    try:
+        summary = _run(_post())
+    finally:
+        ap.use_delivery_queue(None)
+
+    # The followers are resolved by the workers of the queue
+    assert me.followers not in fetched
+    assert summary.pending == [me.followers]
+    assert queue.stats()["fan_out"] == 1
+    queue.close()
+
+
+def test_aio_process_from_inbox_payload():
+    back, _ = _setup()
+    me = back.setup_actor("Thomas", "tom")
+    other = back.setup_actor("Thomas", "tom2")
+
+    payload = {
+        "type": "Create",
+        "id": "https://lol.com/note/activity",
+        "actor": other.id,
+        "to": [me.id],
+        "object": {
+            "type": "Note",
+            "id": "https://lol.com/note",
+            "attributedTo": other.id,
+            "content": "Hello",
+        },
+    }
+
+    _run(aio.process_from_inbox(payload, me))
+
+    assert back.inbox_get_by_iri(me, "https://lol.com/note/activity") is not None
+
+
+def test_aio_sync_call_from_loop_fails():
+    back = InMemBackend()
+    me = back.setup_actor("Thomas", "tom")
+    loop = asyncio.new_event_loop()
+    aio.use_backend(InMemAsyncBackend(back), loop)
+
+    async def _call():
+        ap.get_backend().fetch_iri(me.id)
+
+    try:
+        with pytest.raises(ap.Error) as exc:
+            loop.run_until_complete(_call())
+        assert "from the event loop" in exc.value.message
+
+        # It still works from another thread
+        async def _fetch():
+            return await loop.run_in_executor(None, ap.get_backend().fetch_iri, me.id)
+
+        assert loop.run_until_complete(_fetch())["id"] == me.id
+    finally:
+        loop.close()
+
+    # The loop thread is also known once it's used by an operation
+    back, _ = _setup()
+    me = back.setup_actor("Thomas", "tom")
+    other = back.setup_actor("Thomas", "tom2")
+
+    async def _follow_and_call():
+        await aio.run_sync(ap.Follow, actor=me.id, object=other.id)
+        ap.get_backend().fetch_iri(me.id)
+
+    with pytest.raises(ap.Error) as exc:
+        _run(_follow_and_call())
+    assert "from the event loop" in exc.value.message
+
+
+def test_aio_run_sync_with_blocking_fetches():
+    back, aback = _setup()
+    me = back.setup_actor("Thomas", "tom")
+
+    async def fetch_iri(iri):
+        # Blocking I/O in the default executor, like the default `fetch_json`
+        return await asyncio.get_event_loop().run_in_executor(None, back.fetch_iri, iri)
+
+    aback.fetch_iri = fetch_iri
+
+    async def _fetch_all():
+        fetches = [aio.run_sync(ap.get_backend().fetch_iri, me.id) for _ in range(2)]
+        return await asyncio.wait_for(asyncio.gather(*fetches), 5)
+
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=2))
+    try:
+        out = loop.run_until_complete(_fetch_all())
+    finally:
+        loop.close()
+
+    assert [raw["id"] for raw in out] == [me.id, me.id]
+
+
+def test_aio_process_from_inbox_triage():
+    back, _ = _setup()
+    me = back.setup_actor("Thomas", "tom")
+    other = back.setup_actor("Thomas", "tom2")
+    triage = ap.InboxTriage()
+    ap.use_inbox_triage(triage)
+
+    payload = {
+        "type": "Like",
+        "id": "https://lol.com/likes/1",
+        "actor": other.id,
+        "object": "https://lol.com/note",
+    }
+
+    async def _process():
+        await aio.process_from_inbox(payload, me)
+        await aio.process_from_inbox(payload, me)
+        await aio.process_from_inbox(dict(payload, type="Lol"), me)
+
+    try:
+        _run(_process())
+    finally:
+        ap.use_inbox_triage(ap.InboxTriage())
+
+    stats = triage.stats()
+    assert stats["accepted"] == 1
+    assert stats["duplicate"] == 1
+    assert stats["unsupported_type"] == 1
+    assert len(back.DB[me.id]["inbox"]) == 1
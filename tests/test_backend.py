@@ -33,6 +33,9 @@ class InMemBackend(Backend):
     # For tests purposes only
     _METHOD_CALLS = {}
 
+    # httpretty fakes the DNS resolution
+    PIN_IPS = False
+
     def called_methods(self, p: ap.Person) -> List[str]:
         data = list(self._METHOD_CALLS[p.id])
         self._METHOD_CALLS[p.id] = []
@@ -0,0 +1,163 @@
+import logging
+from unittest import mock
+
+import pytest
+
+from little_boxes import activitypub as ap
+from little_boxes.blocklist import InMemoryBlocklist
+from little_boxes.blocklist import SqliteBlocklist
+from little_boxes.blocklist import iri_domain
+from test_backend import InMemBackend
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def blocklist(request):
+    if request.param == "memory":
+        yield InMemoryBlocklist()
+    else:
+        bl = SqliteBlocklist(":memory:")
+        yield bl
+        bl.close()
+
+
+def test_iri_domain():
+    assert iri_domain("https://Lol.com/users/tom") == "lol.com"
+    assert iri_domain("https://user@lol.com:8443/tom") == "lol.com"
+    assert iri_domain("https://[::1]:8443/tom") == "[::1]"
+    assert iri_domain("lol.com/tom") == ""
+
+
+def test_blocklist(blocklist):
+    me = "https://lol.com/tom"
+    assert not blocklist.is_blocked(me, "https://bad.com/bob")
+
+    blocklist.block_actor(me, "https://bad.com/bob")
+    assert blocklist.is_blocked(me, "https://bad.com/bob")
+    assert not blocklist.is_blocked("https://lol.com/other", "https://bad.com/bob")
+    assert not blocklist.is_blocked(me, "https://bad.com/alice")
+
+    blocklist.unblock_actor(me, "https://bad.com/bob")
+    assert not blocklist.is_blocked(me, "https://bad.com/bob")
+
+    # Instance-wide domain block, that also blocks the subdomains
+    blocklist.block_domain("Spam.com")
+    assert blocklist.is_blocked(me, "https://spam.com/bob")
+    assert blocklist.is_blocked("https://lol.com/other", "https://a.spam.com/bob")
+    assert not blocklist.is_blocked(me, "https://notspam.com/bob")
+    assert blocklist.blocked_among(
+        me, ["https://spam.com/bob", "https://lol.com/alice"]
+    ) == {"https://spam.com/bob"}
+    blocklist.unblock_domain("spam.com")
+    assert not blocklist.is_blocked(me, "https://spam.com/bob")
+
+    # Domain blocked by a single actor
+    blocklist.block_domain("spam.com", owner=me)
+    assert blocklist.is_blocked(me, "https://spam.com/bob")
+    assert not blocklist.is_blocked("https://lol.com/other", "https://spam.com/bob")
+
+
+def test_sqlite_blocklist_persistence(tmp_path):
+    path = str(tmp_path / "blocks.db")
+    bl = SqliteBlocklist(path)
+    bl.block_actor("https://lol.com/tom", "https://bad.com/bob")
+    bl.block_domain("spam.com")
+    bl.block_domain("evil.com", owner="https://lol.com/tom")
+    bl.close()
+
+    bl = SqliteBlocklist(path)
+    assert bl.is_blocked("https://lol.com/tom", "https://bad.com/bob")
+    assert bl.is_blocked("https://lol.com/other", "https://spam.com/bob")
+    assert bl.is_blocked("https://lol.com/tom", "https://evil.com/bob")
+    assert not bl.is_blocked("https://lol.com/other", "https://evil.com/bob")
+    bl.close()
+
+
+def test_blocklist_outbox_block_and_undo():
+    back = InMemBackend()
+    ap.use_backend(back)
+    ap.use_blocklist(InMemoryBlocklist(), authoritative=True)
+    try:
+        me = back.setup_actor("Thomas", "tom")
+        other = back.setup_actor("Thomas", "tom2")
+        like = ap.Like(actor=other.id, object="https://lol.com/notes/1")
+        like.outbox_set_id("https://lol.com/tom2/likes/1", "1")
+
+        block = ap.Block(actor=me.id, object=other.id)
+        ap.Outbox(me).post(block)
+        assert ap.BLOCKLIST.is_blocked(me.id, other.id)
+        back.called_methods(me)
+
+        # Dropped without fetching the actor nor asking the backend
+        with mock.patch.object(back, "fetch_iri", side_effect=Exception("no fetch")):
+            ap.Inbox(me).post(like)
+        assert back.called_methods(me) == []
+
+        undo = ap.Undo(actor=me.id, object=block.to_dict(embed=True))
+        assert block.recipients() == []
+        assert undo.recipients() == []
+        with mock.patch.object(back, "post_to_remote_inbox") as post:
+            ap.Outbox(me).post(undo)
+        post.assert_not_called()
+        assert not ap.BLOCKLIST.is_blocked(me.id, other.id)
+
+        back.called_methods(me)
+        ap.Inbox(me).post(like)
+        assert [name for name, *_ in back.called_methods(me)] == [
+            "inbox_new",
+            "inbox_like",
+        ]
+    finally:
+        ap.use_blocklist(None)
+
+
+def test_blocklist_existing_backend_blocks():
+    back = InMemBackend()
+    ap.use_backend(back)
+    me = back.setup_actor("Thomas", "tom")
+    other = back.setup_actor("Thomas", "tom2")
+    # Blocked before the blocklist is set
+    ap.Outbox(me).post(ap.Block(actor=me.id, object=other.id))
+
+    ap.use_blocklist(InMemoryBlocklist())
+    try:
+        assert not ap.BLOCKLIST.is_blocked(me.id, other.id)
+        assert ap.is_blocked(me, other.id)
+        assert ap._blocked_actors(me, [other.id]) == {other.id}
+
+        # Once seeded with the existing blocks, the backend is not asked anymore
+        ap.BLOCKLIST.block_actor(me.id, other.id)
+        ap.use_blocklist(ap.BLOCKLIST, authoritative=True)
+        back.called_methods(me)
+        assert ap.is_blocked(me, other.id)
+        assert not ap.is_blocked(me, "https://lol.com/alice")
+        assert back.called_methods(me) == []
+    finally:
+        ap.use_blocklist(None)
+    assert not ap.BLOCKLIST_AUTHORITATIVE
+
+
+def test_blocklist_domain_dropped_before_fetch():
+    back = InMemBackend()
+    ap.use_backend(back)
+    bl = InMemoryBlocklist()
+    bl.block_domain("spam.com")
+    ap.use_blocklist(bl)
+    try:
+        me = back.setup_actor("Thomas", "tom")
+        payload = {
+            "type": "Like",
+            "id": "https://spam.com/likes/1",
+            "actor": "https://spam.com/bob",
+            "object": "https://lol.com/notes/1",
+        }
+        assert ap.is_blocked(me, ap._payload_actor_iri(payload))
+
+        likes = [dict(payload, id=f"https://spam.com/likes/{i}") for i in range(2)]
+        with mock.patch.object(back, "fetch_iri", side_effect=Exception("no fetch")):
+            res = ap.Inbox(me).post_many(likes)
+        assert res.blocked == likes
+        assert not res.saved and not res.failed
+    finally:
+        ap.use_blocklist(None)
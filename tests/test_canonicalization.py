@@ -0,0 +1,381 @@
+import copy
+import json
+import logging
+import random
+
+import pytest
+from pyld import jsonld
+
+from little_boxes import canonicalization
+from little_boxes import linked_data_sig
+from little_boxes.cache import LRUCache
+from little_boxes.key import Key
+from test_linked_data_sig import DOC
+
+logging.basicConfig(level=logging.DEBUG)
+
+MASTODON_CONTEXT = [
+    "https://www.w3.org/ns/activitystreams",
+    "https://w3id.org/security/v1",
+    {
+        "manuallyApprovesFollowers": "as:manuallyApprovesFollowers",
+        "sensitive": "as:sensitive",
+        "movedTo": {"@id": "as:movedTo", "@type": "@id"},
+        "Hashtag": "as:Hashtag",
+        "ostatus": "http://ostatus.org#",
+        "atomUri": "ostatus:atomUri",
+        "inReplyToAtomUri": "ostatus:inReplyToAtomUri",
+        "conversation": "ostatus:conversation",
+        "toot": "http://joinmastodon.org/ns#",
+        "Emoji": "toot:Emoji",
+        "focalPoint": {"@container": "@list", "@id": "toot:focalPoint"},
+        "featured": {"@id": "toot:featured", "@type": "@id"},
+        "schema": "http://schema.org#",
+        "PropertyValue": "schema:PropertyValue",
+        "value": "schema:value",
+    },
+]
+
+NOTE = {
+    "id": "https://mastodon.social/users/lol/statuses/1",
+    "type": "Note",
+    "summary": None,
+    "inReplyTo": None,
+    "published": "2018-05-21T15:51:59Z",
+    "url": "https://mastodon.social/@lol/1",
+    "attributedTo": "https://mastodon.social/users/lol",
+    "to": ["https://www.w3.org/ns/activitystreams#Public"],
+    "cc": [
+        "https://mastodon.social/users/lol/followers",
+        "https://lol.com/users/hello",
+    ],
+    "sensitive": False,
+    "atomUri": "https://mastodon.social/users/lol/statuses/1",
+    "inReplyToAtomUri": None,
+    "conversation": "tag:mastodon.social,2018-05-21:objectId=1:objectType=Conversation",
+    "content": '<p>Hello "world"\\ #<a href="https://mastodon.social/tags/lol">lol</a></p>\n\tnew line',
+    "contentMap": {"en": "<p>Hello</p>", "FR": ["<p>Bonjour</p>"]},
+    "attachment": [
+        {
+            "type": "Document",
+            "mediaType": "image/png",
+            "url": "https://files.mastodon.social/1.png",
+            "name": None,
+            "width": 400,
+            "height": 300,
+        }
+    ],
+    "tag": [
+        {
+            "type": "Mention",
+            "href": "https://lol.com/users/hello",
+            "name": "@hello@lol.com",
+        },
+        {
+            "type": "Hashtag",
+            "href": "https://mastodon.social/tags/lol",
+            "name": "#lol",
+        },
+    ],
+}
+
+DOCS = [
+    json.loads(DOC),
+    {
+        "@context": MASTODON_CONTEXT,
+        "id": "https://mastodon.social/users/lol/statuses/1/activity",
+        "type": "Create",
+        "actor": "https://mastodon.social/users/lol",
+        "published": "2018-05-21T15:51:59Z",
+        "to": ["https://www.w3.org/ns/activitystreams#Public"],
+        "cc": ["https://mastodon.social/users/lol/followers"],
+        "object": NOTE,
+    },
+    {
+        "@context": MASTODON_CONTEXT,
+        "id": "https://mastodon.social/users/lol#delete",
+        "type": "Delete",
+        "actor": "https://mastodon.social/users/lol",
+        "to": ["https://www.w3.org/ns/activitystreams#Public"],
+        "object": {
+            "id": "https://mastodon.social/users/lol/statuses/1",
+            "type": "Tombstone",
+            "atomUri": "https://mastodon.social/users/lol/statuses/1",
+        },
+    },
+    {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://mastodon.social/users/lol/statuses/2/activity",
+        "type": "Announce",
+        "actor": "https://mastodon.social/users/lol",
+        "published": "2018-05-21T15:51:59Z",
+        "to": "as:Public",
+        "object": "https://lol.com/notes/1",
+    },
+    {
+        "@context": MASTODON_CONTEXT,
+        "id": "https://mastodon.social/users/lol",
+        "type": "Person",
+        "following": "https://mastodon.social/users/lol/following",
+        "followers": "https://mastodon.social/users/lol/followers",
+        "inbox": "https://mastodon.social/users/lol/inbox",
+        "outbox": "https://mastodon.social/users/lol/outbox",
+        "featured": "https://mastodon.social/users/lol/collections/featured",
+        "preferredUsername": "lol",
+        "name": "Lol ☃",
+        "summary": "<p>Hello</p>",
+        "manuallyApprovesFollowers": True,
+        "publicKey": {
+            "id": "https://mastodon.social/users/lol#main-key",
+            "owner": "https://mastodon.social/users/lol",
+            "publicKeyPem": "-----BEGIN PUBLIC KEY-----\nMIIBIjANBgkqhkiG9w0BAQEFAA\n-----END PUBLIC KEY-----\n",
+        },
+        "attachment": [
+            {"type": "PropertyValue", "name": "Website", "value": "lol.com"}
+        ],
+        "endpoints": {"sharedInbox": "https://mastodon.social/inbox"},
+        "icon": {
+            "type": "Image",
+            "mediaType": "image/png",
+            "url": "https://files.mastodon.social/avatar.png",
+        },
+    },
+    # Signature options
+    {
+        "@context": "https://w3id.org/identity/v1",
+        "creator": "https://mastodon.social/users/lol#main-key",
+        "created": "2018-05-21T15:51:59Z",
+        "nonce": "abc",
+    },
+    # Vocabulary-relative values
+    {
+        "@context": "https://w3id.org/identity/v1",
+        "id": "https://lol.com/users/lol",
+        "type": "Person",
+        "preferences": ["Identity", "https://lol.com/pref"],
+    },
+    # Unknown properties (expanded to blank nodes by @vocab) are dropped, not their nodes
+    {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://lol.com/notes/1",
+        "type": "Note",
+        "unknown": {"id": "https://lol.com/other", "type": "Note", "name": "lol"},
+        "other": {"type": "Note", "content": "dangling"},
+        "http://example.com/prop": {"name": "full IRI"},
+        "totalItems": 3,
+        "accuracy": 1.5,
+        "latitude": 2,
+    },
+    {
+        "@context": {"name": "http://schema.org/name", "ex": "http://example.com/"},
+        "@id": "https://lol.com/thing",
+        "name": ["a", "b", "a"],
+        "ex:score": [1.25, -1.25e-07, 10, True, 1e21],
+        "ex:nested": [{}, {"ex:x": 1}],
+    },
+    # Only the prefix terms are expanded in compact IRIs
+    {
+        "@context": MASTODON_CONTEXT,
+        "id": "https://lol.com/notes/1",
+        "type": ["Note", "Hashtag:foo"],
+        "url": ["Hashtag:foo", "toot:lol", "movedTo:lol"],
+    },
+    {
+        "@context": [
+            "https://www.w3.org/ns/activitystreams",
+            {
+                "ex": {"@id": "http://example.com/"},
+                "ex2": "http://example.com/ns",
+                "ex3": "http://example.com/ns#",
+            },
+        ],
+        "id": "https://lol.com/notes/1",
+        "url": ["ex:a", "ex2:b", "ex3:c"],
+        "ex3:prop": 1,
+    },
+]
+
+# Documents that must go through pyld
+UNSUPPORTED = [
+    # Lists
+    {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://lol.com/outbox",
+        "type": "OrderedCollection",
+        "orderedItems": ["https://lol.com/1", "https://lol.com/2"],
+    },
+    # Blank nodes that can't be told apart with their first degree quads
+    {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://lol.com/notes/1",
+        "type": "Note",
+        "tag": [{"type": "Mention", "name": "a"}, {"type": "Mention", "name": "a"}],
+    },
+    # Unknown type (blank node via @vocab)
+    {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://lol.com/notes/1",
+        "type": "Hashtag",
+    },
+    # Relative IRI
+    {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "notes/1",
+        "type": "Note",
+    },
+    # Relative IRI that looks like a compact IRI
+    {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://lol.com/notes/1",
+        "type": "Note",
+        "attributedTo": "2018-05-21T15:51:59Z",
+    },
+    # Not bundled
+    {"@context": "https://lol.com/context", "id": "https://lol.com/notes/1"},
+    # Nested context
+    {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://lol.com/notes/1",
+        "object": {"@context": {"lol": "https://lol.com/ns#"}, "lol": 1},
+    },
+    # Integers serialized as doubles
+    {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://lol.com/notes/1",
+        "totalItems": 10 ** 21,
+    },
+    # Invalid IRIs
+    {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://lol.com/notes/1",
+        "url": "https://lol.com/a b",
+    },
+    {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": "https://lol.com/notes/<1>",
+        "type": "Note",
+    },
+    # Default language
+    {
+        "@context": ["https://www.w3.org/ns/activitystreams", {"@language": "en"}],
+        "id": "https://lol.com/notes/1",
+        "name": "lol",
+    },
+]
+
+
+def _pyld(doc):
+    return jsonld.normalize(
+        copy.deepcopy(doc), {"algorithm": "URDNA2015", "format": "application/nquads"}
+    )
+
+
+def _fast(doc):
+    return canonicalization.canonicalize(doc, linked_data_sig._load_bundled_context)
+
+
+@pytest.mark.parametrize("doc", DOCS)
+def test_canonicalize_same_as_pyld(doc):
+    out = _fast(doc)
+    assert out is not None
+    assert out == _pyld(doc)
+
+
+@pytest.mark.parametrize("doc", UNSUPPORTED)
+def test_canonicalize_unsupported(doc):
+    assert _fast(doc) is None
+
+
+def _random_value(rand, depth):
+    kind = rand.randrange(10 if depth < 2 else 7)
+    if kind == 0:
+        return rand.choice(["lol", 'a"b\\c\nd', "", "☃", "as:Public", "Hashtag:lol"])
+    if kind == 1:
+        return rand.choice([0, 1, -12, 10**20, 10**21, True, False, 0.5, -1.25e-7])
+    if kind == 2:
+        return rand.choice(
+            [
+                "https://lol.com/a",
+                "https://lol.com/b",
+                "https://lol.com/b c",
+                "http://example.com/#c",
+            ]
+        )
+    if kind == 3:
+        return None
+    if kind == 4:
+        return "2018-05-21T15:51:59Z"
+    if kind in (5, 6):
+        return [_random_value(rand, depth + 1) for _ in range(rand.randrange(3))]
+    return _random_node(rand, depth + 1)
+
+
+_PROPS = [
+    "name",
+    "content",
+    "summary",
+    "url",
+    "href",
+    "to",
+    "cc",
+    "actor",
+    "object",
+    "attributedTo",
+    "tag",
+    "published",
+    "totalItems",
+    "width",
+    "accuracy",
+    "sensitive",
+    "source",
+    "mediaType",
+    "unknownProperty",
+    "as:name",
+    "toot:featured",
+    "contentMap",
+]
+
+
+def _random_node(rand, depth):
+    node = {}
+    if rand.random() < 0.5:
+        node["id"] = f"https://lol.com/{rand.randrange(5)}"
+    if rand.random() < 0.8:
+        node["type"] = rand.choice(["Note", "Create", "Person", "Image", "Hashtag", "Hashtag:lol"])
+    for prop in rand.sample(_PROPS, rand.randrange(4)):
+        if prop == "contentMap":
+            node[prop] = {"en": "lol", "fr": ["a", "b"]}
+        else:
+            node[prop] = _random_value(rand, depth)
+    return node
+
+
+def test_canonicalize_random_documents():
+    rand = random.Random(42)
+    supported = 0
+    for _ in range(300):
+        doc = _random_node(rand, 0)
+        doc["@context"] = MASTODON_CONTEXT
+        out = _fast(doc)
+        if out is None:
+            continue
+        supported += 1
+        assert out == _pyld(doc), json.dumps(doc)
+
+    # Make sure the fast path is actually exercised
+    assert supported > 100
+
+
+def test_linked_data_sig_fast_path():
+    doc = copy.deepcopy(DOCS[1])
+    key = Key("https://mastodon.social/users/lol")
+    key.new()
+
+    linked_data_sig.use_canonicalization_cache(None)
+    try:
+        linked_data_sig.generate_signature(doc, key)
+        linked_data_sig.use_fast_canonicalization(False)
+        assert linked_data_sig.verify_signature(doc, key)
+    finally:
+        linked_data_sig.use_fast_canonicalization(True)
+        linked_data_sig.use_canonicalization_cache(LRUCache(maxsize=4096))
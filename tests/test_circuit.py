@@ -0,0 +1,210 @@
+import logging
+from unittest import mock
+
+import pytest
+import requests
+
+from little_boxes import activitypub as ap
+from little_boxes import httpsig
+from little_boxes.circuit import CLOSED
+from little_boxes.circuit import HALF_OPEN
+from little_boxes.circuit import OPEN
+from little_boxes.circuit import CircuitBreaker
+from little_boxes.circuit import HostUnavailableError
+from little_boxes.circuit import is_host_failure
+from little_boxes.delivery_queue import QueuedDelivery
+from little_boxes.delivery_queue import RetryPolicy
+from test_backend import InMemBackend
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class FakeClock(object):
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def _down():
+    raise requests.ConnectionError("down")
+
+
+def test_circuit_breaker_states(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10, clock=clock)
+    iri = "https://down.com/users/bob"
+
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            breaker.call(iri, _down)
+    assert breaker.state("down.com") == CLOSED
+
+    # A 4xx means the host is alive, and resets the failures count
+    resp = requests.Response()
+    resp.status_code = 404
+    with pytest.raises(requests.HTTPError):
+        breaker.call(iri, mock.Mock(side_effect=requests.HTTPError(response=resp)))
+    for _ in range(3):
+        with pytest.raises(requests.ConnectionError):
+            breaker.call(iri, _down)
+    assert breaker.state("down.com") == OPEN
+    assert breaker.open_hosts() == ["down.com"]
+
+    fn = mock.Mock(return_value=1)
+    with pytest.raises(HostUnavailableError) as exc:
+        breaker.call(iri, fn)
+    assert exc.value.status_code == 503
+    fn.assert_not_called()
+    # The other hosts are not affected
+    assert breaker.call("https://up.com/users/alice", fn) == 1
+
+    # Half-open: a single trial is let through, it fails and the circuit opens twice as long
+    clock.now += 10
+    assert breaker.state("down.com") == HALF_OPEN
+    assert breaker.allow("down.com")
+    assert not breaker.allow("down.com")
+    breaker.record_failure("down.com")
+    assert breaker.state("down.com") == OPEN
+    clock.now += 10
+    assert breaker.state("down.com") == OPEN
+    clock.now += 10
+
+    assert breaker.call(iri, fn) == 1
+    assert breaker.state("down.com") == CLOSED
+    assert breaker.open_hosts() == []
+
+
+def test_circuit_breaker_persistence(tmp_path, clock):
+    path = str(tmp_path / "circuits.db")
+    breaker = CircuitBreaker(
+        failure_threshold=1, reset_timeout=10, path=path, clock=clock
+    )
+    with pytest.raises(requests.ConnectionError):
+        breaker.call("https://down.com/inbox", _down)
+    breaker.close()
+
+    breaker = CircuitBreaker(
+        failure_threshold=1, reset_timeout=10, path=path, clock=clock
+    )
+    assert breaker.state("down.com") == OPEN
+    clock.now += 10
+    breaker.record_success("down.com")
+    breaker.close()
+
+    breaker = CircuitBreaker(path=path, clock=clock)
+    assert breaker.open_hosts() == []
+    breaker.close()
+
+
+def test_circuit_breaker_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.record_failure("a.com")
+    breaker.record_failure("b.com")
+
+    check = mock.Mock(side_effect=lambda origin: origin == "https://a.com")
+    breaker.probe(check)
+    # Still open
+    check.assert_not_called()
+
+    clock.now += 10
+    breaker.probe(check)
+    assert check.call_count == 2
+    assert breaker.open_hosts() == ["b.com"]
+    assert breaker.state("b.com") == OPEN
+
+
+def test_circuit_breaker_fetch_and_delivery(clock):
+    back = InMemBackend()
+    ap.use_backend(back)
+    me = back.setup_actor("Thomas", "tom")
+    alice = back.setup_actor("Alice", "alice")
+    bob_id = "https://down.com/users/bob"
+
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.record_failure("down.com")
+    ap.use_circuit_breaker(breaker)
+    try:
+        note = ap.Note(
+            to=[ap.AS_PUBLIC],
+            cc=[alice.id, bob_id],
+            attributedTo=me.id,
+            content="Hello",
+        )
+        with mock.patch.object(back, "fetch_iri", wraps=back.fetch_iri) as fetch:
+            plan = note.build_create().delivery_plan()
+        assert bob_id not in [c[0][0] for c in fetch.call_args_list]
+        assert plan.inboxes() == [alice.inbox]
+
+        delivery = QueuedDelivery(
+            1, "https://lol.com/1", me.id, "https://down.com/inbox", "{}", 0, 0, 0, None
+        )
+        with mock.patch.object(back, "post_to_remote_inbox") as post:
+            with pytest.raises(HostUnavailableError) as exc:
+                ap.deliver_queued(delivery)
+        post.assert_not_called()
+        # The queue will retry it later
+        assert not RetryPolicy().is_permanent(exc.value)
+    finally:
+        ap.use_circuit_breaker(None)
+
+
+def test_is_host_failure():
+    resp = requests.Response()
+    resp.status_code = 503
+    assert is_host_failure(requests.HTTPError(response=resp))
+    resp.status_code = 404
+    assert not is_host_failure(requests.HTTPError(response=resp))
+    assert is_host_failure(requests.ConnectionError("down"))
+    assert is_host_failure(requests.ReadTimeout("slow"))
+    assert is_host_failure(ConnectionRefusedError())
+    # A malformed body doesn't mean the host is down
+    assert not is_host_failure(requests.JSONDecodeError("invalid", "{", 0))
+    assert not is_host_failure(requests.TooManyRedirects("loop"))
+
+
+def test_circuit_breaker_public_key_fetch(clock):
+    back = InMemBackend()
+    ap.use_backend(back)
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.record_failure("down.com")
+    ap.use_circuit_breaker(breaker)
+    try:
+        with mock.patch.object(back, "fetch_iri") as fetch:
+            with pytest.raises(HostUnavailableError):
+                httpsig._fetch_public_key("https://down.com/users/bob#main-key")
+        fetch.assert_not_called()
+    finally:
+        ap.use_circuit_breaker(None)
+
+
+@mock.patch("little_boxes.circuit.check_url", return_value=None)
+def test_circuit_breaker_http_probe(check_url, clock):
+    back = InMemBackend()
+    ap.use_backend(back)
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    with pytest.raises(requests.ConnectionError):
+        breaker.call("http://dead.com:8080/inbox", _down)
+    clock.now += 10
+
+    client = back.http_client()
+    with mock.patch.object(client, "request", return_value=mock.Mock(status_code=502)):
+        breaker.probe()
+    # A 502 from a proxy in front of a dead instance
+    assert breaker.state("dead.com") == OPEN
+    check_url.assert_called_with("http://dead.com:8080")
+
+    clock.now += 20
+    with mock.patch.object(
+        client, "request", return_value=mock.Mock(status_code=404)
+    ) as request:
+        breaker.probe()
+    request.assert_called_once_with(
+        "HEAD", "http://dead.com:8080/", allow_redirects=False
+    )
+    assert breaker.state("dead.com") == CLOSED
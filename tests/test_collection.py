@@ -1,8 +1,10 @@
 import logging
+from unittest import mock
 
 import pytest
 
 from little_boxes import activitypub as ap
+from little_boxes.collection import iter_collection
 from little_boxes.collection import parse_collection
 from little_boxes.errors import RecursionLimitExceededError
 from little_boxes.errors import UnexpectedActivityTypeError
@@ -90,3 +92,85 @@ def test_ordered_collection():
 
     out = parse_collection(url="https://lol.com", fetcher=back.fetch_iri)
     assert out == [1, 2, 3, 4, 5, 6]
+
+
+def _setup_paged_collection(back, pages):
+    back.FETCH_MOCK["https://lol.com"] = {
+        "type": "OrderedCollection",
+        "first": "https://lol.com/page0",
+        "id": "https://lol.com",
+    }
+    for i in range(pages):
+        page = {
+            "type": "OrderedCollectionPage",
+            "id": f"https://lol.com/page{i}",
+            "orderedItems": [i * 3, i * 3 + 1, i * 3 + 2],
+        }
+        if i < pages - 1:
+            page["next"] = f"https://lol.com/page{i + 1}"
+        back.FETCH_MOCK[page["id"]] = page
+
+
+def test_iter_collection():
+    back = InMemBackend()
+    ap.use_backend(back)
+    _setup_paged_collection(back, 10)
+
+    out = iter_collection(url="https://lol.com", fetcher=back.fetch_iri)
+    assert list(out) == list(range(30))
+
+
+def test_iter_collection_budgets():
+    back = InMemBackend()
+    ap.use_backend(back)
+    _setup_paged_collection(back, 10)
+
+    out = iter_collection(url="https://lol.com", fetcher=back.fetch_iri, max_items=4)
+    assert list(out) == [0, 1, 2, 3]
+
+    out = iter_collection(url="https://lol.com", fetcher=back.fetch_iri, max_pages=2)
+    assert list(out) == [0, 1, 2, 3, 4, 5]
+
+
+def test_iter_collection_stop_early():
+    back = InMemBackend()
+    ap.use_backend(back)
+    _setup_paged_collection(back, 10)
+
+    with mock.patch.object(back, "fetch_iri", wraps=back.fetch_iri) as fetch_iri:
+        out = iter_collection(url="https://lol.com", fetcher=fetch_iri, prefetch=False)
+        assert next(out) == 0
+        out.close()
+
+        # Only the collection and its first page were fetched
+        assert fetch_iri.call_count == 2
+
+
+def test_iter_collection_max_items_no_extra_page():
+    back = InMemBackend()
+    ap.use_backend(back)
+    _setup_paged_collection(back, 10)
+
+    for max_items, fetches in [(0, 0), (3, 2), (4, 3), (6, 3)]:
+        with mock.patch.object(back, "fetch_iri", wraps=back.fetch_iri) as fetch_iri:
+            out = iter_collection(
+                url="https://lol.com", fetcher=fetch_iri, max_items=max_items
+            )
+            assert list(out) == list(range(max_items))
+
+            # The collection and only the pages needed for the items (nothing at all without items)
+            assert fetch_iri.call_count == fetches
+
+
+def test_iter_collection_recursion_limit():
+    back = InMemBackend()
+    ap.use_backend(back)
+
+    back.FETCH_MOCK["https://lol.com"] = {
+        "type": "Collection",
+        "first": "https://lol.com",
+        "id": "https://lol.com",
+    }
+
+    with pytest.raises(RecursionLimitExceededError):
+        list(iter_collection(url="https://lol.com", fetcher=back.fetch_iri))
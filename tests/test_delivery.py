@@ -0,0 +1,201 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from little_boxes import activitypub as ap
+from little_boxes.delivery import DeliveryEngine
+from little_boxes.delivery import DeliveryPlanner
+from little_boxes.delivery import DeliveryTimeoutError
+from little_boxes.routing import InMemoryRoutingIndex
+from little_boxes.routing import Route
+from test_backend import InMemBackend
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+def _route(actor_id, shared_inbox=None):
+    host = actor_id.split("/")[2]
+    return Route(actor_id + "/inbox", shared_inbox, host)
+
+
+def test_delivery_planner():
+    index = InMemoryRoutingIndex()
+    # Learned from an earlier fetch
+    index.set("https://b.com/old", _route("https://b.com/old", "https://b.com/inbox"))
+    # Shared inbox served by another host
+    index.set("https://c.com/old", _route("https://c.com/old", "https://x.com/inbox"))
+
+    targets = [
+        ("https://a.com/1", _route("https://a.com/1")),
+        ("https://a.com/2", _route("https://a.com/2", "https://a.com/inbox")),
+        ("https://b.com/1", _route("https://b.com/1")),
+        ("https://c.com/1", _route("https://c.com/1")),
+        ("https://a.com/3", _route("https://a.com/3")),
+        ("https://d.com/1", None),
+    ]
+    plan = DeliveryPlanner().plan(targets, index)
+
+    assert plan.compact() == {
+        "a.com": {
+            "https://a.com/inbox": [
+                "https://a.com/1",
+                "https://a.com/2",
+                "https://a.com/3",
+            ]
+        },
+        "b.com": {"https://b.com/inbox": ["https://b.com/1"]},
+        "c.com": {"https://c.com/1/inbox": ["https://c.com/1"]},
+    }
+    assert len(plan) == 3
+    assert plan.actors_count() == 5
+
+    # Only the advertised shared inboxes
+    plan = DeliveryPlanner(learn_shared_inboxes=False).plan(targets, index)
+    assert plan.inboxes() == [
+        "https://a.com/1/inbox",
+        "https://a.com/inbox",
+        "https://b.com/1/inbox",
+        "https://c.com/1/inbox",
+        "https://a.com/3/inbox",
+    ]
+
+
+def test_delivery_plan_one_post_per_server():
+    back = InMemBackend()
+    ap.use_backend(back)
+    ap.use_routing_index(InMemoryRoutingIndex())
+    try:
+        me = back.setup_actor("Thomas", "tom")
+        followers = []
+        for i in range(20):
+            f = back.setup_actor("Follower", f"follower{i}")
+            f_id = f.id.replace("lol.com", f"remote{i % 2}.com")
+            data = dict(back.FETCH_MOCK.pop(f.id), id=f_id)
+            data["inbox"] = f_id + "/inbox"
+            # Only some of the actors advertise the shared inbox
+            if i < 2:
+                data["endpoints"] = {"sharedInbox": f"https://remote{i}.com/inbox"}
+            back.FETCH_MOCK[f_id] = data
+            followers.append(f_id)
+        back.FOLLOWERS[me.id] = followers
+
+        note = ap.Note(
+            to=[ap.AS_PUBLIC], cc=[me.followers], attributedTo=me.id, content="Hello"
+        )
+        plan = note.build_create().delivery_plan()
+    finally:
+        ap.use_routing_index(None)
+
+    assert plan.by_host() == {
+        "remote0.com": ["https://remote0.com/inbox"],
+        "remote1.com": ["https://remote1.com/inbox"],
+    }
+    assert plan.actors_count() == 20
+
+
+def test_delivery_engine_summary():
+    engine = DeliveryEngine(max_workers=4)
+
+    def post(recp):
+        if "fail" in recp:
+            raise ValueError("boom")
+
+    batch = engine.deliver(
+        ["https://a.com/inbox", "https://b.com/inbox", "https://fail.com/inbox"], post
+    )
+    summary = batch.wait()
+    engine.shutdown()
+
+    assert batch.done()
+    assert not summary.ok
+    assert sorted(summary.succeeded) == ["https://a.com/inbox", "https://b.com/inbox"]
+    assert list(summary.failed) == ["https://fail.com/inbox"]
+    assert isinstance(summary.failed["https://fail.com/inbox"], ValueError)
+
+
+def test_delivery_engine_per_host_limit():
+    engine = DeliveryEngine(max_workers=8, max_per_host=2)
+    lock = threading.Lock()
+    in_flight = defaultdict(int)
+    max_in_flight = defaultdict(int)
+
+    def post(recp):
+        host = recp.split("/")[2]
+        with lock:
+            in_flight[host] += 1
+            max_in_flight[host] = max(max_in_flight[host], in_flight[host])
+        time.sleep(0.01)
+        with lock:
+            in_flight[host] -= 1
+
+    recipients = [f"https://a.com/users/{i}/inbox" for i in range(10)]
+    recipients.extend(f"https://b.com/users/{i}/inbox" for i in range(10))
+    summary = engine.deliver(recipients, post).wait()
+    engine.shutdown()
+
+    assert summary.ok
+    assert len(summary.succeeded) == 20
+    assert max_in_flight["a.com"] <= 2
+    assert max_in_flight["b.com"] <= 2
+
+
+def test_delivery_engine_timeout():
+    engine = DeliveryEngine(max_workers=2, timeout=0.05)
+    release = threading.Event()
+
+    def post(recp):
+        if "slow" in recp:
+            release.wait(5)
+
+    batch = engine.deliver(["https://slow.com/inbox", "https://fast.com/inbox"], post)
+    summary = batch.wait()
+    release.set()
+    engine.shutdown()
+
+    assert summary.succeeded == ["https://fast.com/inbox"]
+    assert isinstance(summary.failed["https://slow.com/inbox"], DeliveryTimeoutError)
+
+
+def test_delivery_engine_timeout_keeps_host_slot():
+    engine = DeliveryEngine(max_workers=4, max_per_host=1, timeout=0.05)
+    release = threading.Event()
+    started = []
+
+    def post(recp):
+        started.append(recp)
+        release.wait(5)
+
+    batch = engine.deliver(["https://slow.com/1", "https://slow.com/2"], post)
+    summary = batch.wait(0.2)
+    # The first request timed out but is still running, the second one waits for its slot
+    assert list(summary.failed) == ["https://slow.com/1"]
+    assert summary.pending == ["https://slow.com/2"]
+    assert started == ["https://slow.com/1"]
+
+    release.set()
+    summary = batch.wait()
+    engine.shutdown()
+    assert started == ["https://slow.com/1", "https://slow.com/2"]
+    assert summary.succeeded == ["https://slow.com/2"]
+
+
+def test_post_to_outbox_with_delivery_engine():
+    back = InMemBackend()
+    ap.use_backend(back)
+    engine = DeliveryEngine()
+    ap.use_delivery_engine(engine)
+
+    me = back.setup_actor("Thomas", "tom")
+    other = back.setup_actor("Thomas", "tom2")
+
+    try:
+        batch = ap.Outbox(me).post(ap.Follow(actor=me.id, object=other.id))
+        summary = batch.wait()
+    finally:
+        ap.use_delivery_engine(None)
+        engine.shutdown()
+
+    assert summary.ok
+    assert summary.succeeded == [other.inbox]
+    assert back.followers(other) == [me.id]
@@ -0,0 +1,250 @@
+import json
+import logging
+from unittest import mock
+
+import pytest
+import requests
+
+from little_boxes import activitypub as ap
+from little_boxes.delivery_queue import DeliveryWorker
+from little_boxes.delivery_queue import RetryPolicy
+from little_boxes.delivery_queue import SqliteDeliveryQueue
+from test_backend import InMemBackend
+
+logging.basicConfig(level=logging.DEBUG)
+
+INBOXES = ["https://a.com/inbox", "https://b.com/inbox"]
+
+
+class FakeClock(object):
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def queue(clock):
+    q = SqliteDeliveryQueue(":memory:", clock=clock)
+    yield q
+    q.close()
+
+
+def _http_error(status_code):
+    resp = requests.Response()
+    resp.status_code = status_code
+    return requests.HTTPError(f"{status_code} error", response=resp)
+
+
+def test_retry_policy():
+    policy = RetryPolicy(base_delay=10, max_delay=100, jitter=0.5, rand=lambda: 1.0)
+    assert policy.delay(1) == 15
+    assert policy.delay(2) == 30
+    assert policy.delay(10) == 150
+
+    policy = RetryPolicy(base_delay=10, jitter=0.5, rand=lambda: 0.0)
+    assert policy.delay(1) == 5
+
+    assert policy.is_permanent(_http_error(404))
+    assert not policy.is_permanent(_http_error(429))
+    assert not policy.is_permanent(_http_error(503))
+    assert not policy.is_permanent(ValueError("boom"))
+
+
+def test_delivery_queue_dedup_and_lease(queue, clock):
+    assert queue.enqueue("https://lol.com/1", "https://lol.com/tom", "{}", INBOXES) == 2
+    assert (
+        queue.enqueue("https://lol.com/1", "https://lol.com/tom", "{}", INBOXES * 2)
+        == 0
+    )
+    assert queue.enqueue("https://lol.com/2", "https://lol.com/tom", "{}", INBOXES) == 2
+    assert queue.stats() == {"pending": 4, "done": 0, "dead": 0, "fan_out": 0}
+
+    claimed = queue.claim(3, lease=60, now=clock.now)
+    assert len(claimed) == 3
+    assert len(queue.claim(3, lease=60, now=clock.now)) == 1
+    assert queue.claim(3, lease=60, now=clock.now) == []
+
+    # The lease expired (like if the worker crashed)
+    assert len(queue.claim(10, lease=60, now=clock.now + 61)) == 4
+
+    queue.ack(claimed[0].id)
+    assert queue.stats()["done"] == 1
+    # Already delivered
+    assert queue.enqueue(claimed[0].activity_id, "x", "{}", [claimed[0].inbox]) == 0
+
+
+def test_delivery_queue_shared_by_processes(tmp_path, clock):
+    path = str(tmp_path / "queue.db")
+    q1 = SqliteDeliveryQueue(path, clock=clock)
+    q2 = SqliteDeliveryQueue(path, clock=clock)
+    for i in range(10):
+        q1.enqueue(f"https://lol.com/{i}", "https://lol.com/tom", "{}", INBOXES)
+
+    ids = set()
+    while True:
+        claimed = q1.claim(3, 60, clock.now) + q2.claim(3, 60, clock.now)
+        if not claimed:
+            break
+        for d in claimed:
+            assert d.id not in ids
+            ids.add(d.id)
+    assert len(ids) == 20
+    q1.close()
+    q2.close()
+
+
+def test_delivery_worker_retry_and_dead_letter(queue, clock):
+    policy = RetryPolicy(base_delay=10, max_age=100, jitter=0, rand=lambda: 0.5)
+    errors = {"https://a.com/inbox": [ValueError("down")] * 2}
+    posted = []
+
+    def post(delivery):
+        if errors.get(delivery.inbox):
+            raise errors[delivery.inbox].pop()
+        if delivery.inbox == "https://b.com/inbox":
+            raise ConnectionError("b is dead")
+        posted.append(delivery.inbox)
+
+    worker = DeliveryWorker(queue, post, policy=policy, concurrency=2, clock=clock)
+    queue.enqueue("https://lol.com/1", "https://lol.com/tom", "{}", INBOXES)
+
+    assert worker.run_once() == 2
+    assert worker.run_once() == 0
+    clock.now += 10
+    assert worker.run_once() == 2
+    # Backoff: 20s after the second failure
+    clock.now += 10
+    assert worker.run_once() == 0
+    clock.now += 10
+    assert worker.run_once() == 2
+    assert posted == ["https://a.com/inbox"]
+
+    # b.com keeps failing, until the delivery is too old
+    for _ in range(5):
+        clock.now += 100
+        worker.run_once()
+    assert queue.stats() == {"pending": 0, "done": 1, "dead": 1, "fan_out": 0}
+    dead = queue.dead_letters()
+    assert [d.inbox for d in dead] == ["https://b.com/inbox"]
+    assert dead[0].last_error == "ConnectionError: b is dead"
+    assert dead[0].attempts == 4
+
+    # Back online
+    queue.requeue(dead[0].id, clock.now)
+    posted.clear()
+    errors["https://b.com/inbox"] = []
+    with mock.patch.object(worker, "post", side_effect=posted.append):
+        assert worker.run_once() == 1
+    assert queue.stats() == {"pending": 0, "done": 2, "dead": 0, "fan_out": 0}
+    assert queue.purge(clock.now + 1) == 2
+    worker.stop()
+
+
+def test_delivery_worker_permanent_error(queue, clock):
+    def post(delivery):
+        raise _http_error(410)
+
+    worker = DeliveryWorker(queue, post, clock=clock)
+    queue.enqueue("https://lol.com/1", "https://lol.com/tom", "{}", INBOXES[:1])
+    worker.run_once()
+    assert queue.stats()["dead"] == 1
+    worker.stop()
+
+
+def test_delivery_queue_payload_stored_once(queue, clock):
+    payload = json.dumps({"content": "a" * 1000})
+    recipients = ["https://lol.com/tom/followers", "https://remote.com/alice"]
+    assert queue.enqueue_fan_out(
+        "https://lol.com/1", "https://lol.com/tom", payload, recipients
+    )
+    assert not queue.enqueue_fan_out(
+        "https://lol.com/1", "https://lol.com/tom", payload, recipients
+    )
+    assert queue.stats()["fan_out"] == 1
+
+    resolved = [f"https://remote{i}.com/inbox" for i in range(10)]
+    resolve = mock.Mock(return_value=resolved)
+    worker = DeliveryWorker(queue, mock.Mock(), resolve=resolve, clock=clock)
+    assert worker.run_once() == 1
+    assert resolve.call_args[0][0].recipients == recipients
+    assert queue.stats() == {"pending": 10, "done": 0, "dead": 0, "fan_out": 0}
+    assert worker.run_once() == 10
+    assert [c[0][0].payload for c in worker.post.call_args_list] == [payload] * 10
+    worker.stop()
+
+    (count,) = queue._conn.execute("SELECT COUNT(*) FROM activities").fetchone()
+    assert count == 1
+    assert queue.purge(clock.now + 1) == 10
+    (count,) = queue._conn.execute("SELECT COUNT(*) FROM activities").fetchone()
+    assert count == 0
+
+
+def test_post_to_outbox_enqueues(queue, clock):
+    back = InMemBackend()
+    ap.use_backend(back)
+    me = back.setup_actor("Thomas", "tom")
+    other = back.setup_actor("Thomas", "tom2")
+
+    ap.use_delivery_queue(queue)
+    try:
+        with mock.patch.object(back, "post_to_remote_inbox") as post:
+            assert ap.Outbox(me).post(ap.Follow(actor=me.id, object=other.id)) is None
+        post.assert_not_called()
+        assert queue.stats()["fan_out"] == 1
+        assert back.followers(other) == []
+
+        worker = DeliveryWorker(
+            queue, ap.deliver_queued, resolve=ap.resolve_queued, clock=clock
+        )
+        # The fan-out, then the delivery
+        assert worker.run_once() == 1
+        assert queue.stats()["pending"] == 1
+        assert worker.run_once() == 1
+        assert back.followers(other) == [me.id]
+
+        # The Accept sent back is enqueued too
+        assert worker.run_once() == 1
+        assert worker.run_once() == 1
+        assert worker.run_once() == 0
+        worker.stop()
+    finally:
+        ap.use_delivery_queue(None)
+
+    assert queue.stats()["done"] == 2
+    assert back.following(me) == [other.id]
+
+
+def test_post_to_outbox_enqueues_bcc(queue, clock):
+    back = InMemBackend()
+    ap.use_backend(back)
+    me = back.setup_actor("Thomas", "tom")
+    other = back.setup_actor("Thomas", "tom2")
+
+    ap.use_delivery_queue(queue)
+    try:
+        note = ap.Note(
+            to=[me.followers], bcc=[other.id], attributedTo=me.id, content="Hello"
+        )
+        create = note.build_create()
+        with mock.patch.object(back, "fetch_iri", wraps=back.fetch_iri) as fetch:
+            ap.Outbox(me).post(create)
+        # The recipients are resolved by the workers
+        fetched = [c[0][0] for c in fetch.call_args_list]
+        assert me.followers not in fetched
+        assert other.id not in fetched
+    finally:
+        ap.use_delivery_queue(None)
+
+    (job,) = queue.claim(10, 60.0, clock.now)
+    assert job.inbox is None
+    assert job.recipients == [me.followers, other.id]
+    assert ap.resolve_queued(job) == [other.inbox]
+    # The bcc recipients are never sent on the wire
+    assert "bcc" not in json.loads(job.payload)["object"]
@@ -0,0 +1,170 @@
+import gzip
+import http.server
+import json
+import logging
+import threading
+from unittest import mock
+
+import httpretty
+import pytest
+from urllib3.util import parse_url
+
+from little_boxes import activitypub as ap
+from little_boxes import urlutils
+from little_boxes.httpclient import HTTPClient
+from little_boxes.httpclient import ResponseTooLargeError
+from little_boxes.httpclient import _PinnedHTTPAdapter
+from little_boxes.httpclient import _PinnedHTTPConnection
+from little_boxes.httpclient import _PinnedHTTPSConnection
+from test_backend import InMemBackend
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+@httpretty.activate
+def test_httpclient_get():
+    httpretty.register_uri(
+        httpretty.GET, "https://lol.com/actor", body=json.dumps({"id": "lol"})
+    )
+
+    client = HTTPClient(user_agent="test")
+    resp = client.get("https://lol.com/actor")
+
+    assert resp.json() == {"id": "lol"}
+    req = httpretty.last_request()
+    assert req.headers["User-Agent"] == "test"
+    assert "gzip" in req.headers["Accept-Encoding"]
+
+
+@httpretty.activate
+def test_httpclient_gzip():
+    httpretty.register_uri(
+        httpretty.GET,
+        "https://lol.com/actor",
+        body=gzip.compress(b'{"id": "lol"}'),
+        adding_headers={"Content-Encoding": "gzip"},
+    )
+
+    assert HTTPClient().get("https://lol.com/actor").json() == {"id": "lol"}
+
+
+@httpretty.activate
+def test_httpclient_max_response_size():
+    httpretty.register_uri(httpretty.GET, "https://lol.com/big", body="a" * 2048)
+
+    client = HTTPClient(max_response_size=1024)
+    with pytest.raises(ResponseTooLargeError):
+        client.get("https://lol.com/big")
+
+
+@httpretty.activate
+def test_backend_shares_http_client():
+    back = InMemBackend()
+    ap.use_backend(back)
+    httpretty.register_uri(
+        httpretty.GET, "https://lol.com/actor", body=json.dumps({"id": "lol"})
+    )
+    httpretty.register_uri(httpretty.POST, "https://lol.com/inbox", body="ok")
+
+    assert back.http_client() is back.http_client()
+    assert back.fetch_json("https://lol.com/actor").json() == {"id": "lol"}
+
+    resp = back.post_json("https://lol.com/inbox", json.dumps({"type": "Like"}))
+    assert resp.status_code == 200
+    req = httpretty.last_request()
+    assert req.headers["Content-Type"] == "application/activity+json"
+    assert json.loads(req.body) == {"type": "Like"}
+
+
+@pytest.fixture
+def local_server():
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps({"host": self.headers["Host"]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_httpclient_pin_ips(local_server):
+    client = HTTPClient(pin_ips=True)
+    url = f"http://pinned.invalid:{local_server}/actor"
+
+    with mock.patch.object(
+        urlutils, "validated_ips", return_value=["127.0.0.1"]
+    ) as validated_ips:
+        assert client.get(url).json() == {"host": f"pinned.invalid:{local_server}"}
+    validated_ips.assert_called_once_with("pinned.invalid", local_server)
+
+    # The next addresses are tried if the connection fails (nothing listens on 127.0.0.2)
+    client = HTTPClient(pin_ips=True)
+    with mock.patch.object(
+        urlutils, "validated_ips", return_value=["127.0.0.2", "127.0.0.1"]
+    ):
+        assert client.get(url).json() == {"host": f"pinned.invalid:{local_server}"}
+
+    # The host now resolves to a private address
+    urlutils.use_dns_cache(urlutils.DNSCache())
+    try:
+        with mock.patch(
+            "socket.getaddrinfo", return_value=[[0, 1, 2, 3, ["10.0.0.1", None]]]
+        ):
+            with pytest.raises(urlutils.InvalidURLError):
+                HTTPClient(pin_ips=True).get(url)
+    finally:
+        urlutils.use_dns_cache(urlutils.DNSCache())
+
+
+def test_backend_pins_ips_by_default():
+    class PinnedBackend(InMemBackend):
+        PIN_IPS = True
+
+    adapter = PinnedBackend().http_client().session.get_adapter("https://lol.com")
+    assert isinstance(adapter, _PinnedHTTPAdapter)
+    adapter = InMemBackend().http_client().session.get_adapter("https://lol.com")
+    assert not isinstance(adapter, _PinnedHTTPAdapter)
+
+
+@pytest.mark.parametrize("conn_cls", [_PinnedHTTPConnection, _PinnedHTTPSConnection])
+def test_urllib3_private_attributes(conn_cls):
+    # The pinning relies on urllib3 connecting to `_dns_host` and tracking the proxy tunnel in `_tunnel_host`
+    conn = conn_cls("lol.com", 443)
+    assert conn.host == "lol.com"
+    assert conn._dns_host == "lol.com"
+    assert conn._tunnel_host is None
+    conn.set_tunnel("remote.com", 443)
+    assert conn._tunnel_host == "remote.com"
+
+    conn = conn_cls("lol.com", 443)
+    with mock.patch.object(urlutils, "validated_ips", return_value=["1.2.3.4"]):
+        with mock.patch(
+            "urllib3.util.connection.create_connection", return_value=mock.Mock()
+        ) as create_connection:
+            conn._new_conn()
+    # The hostname is kept for the Host header and the certificate verification
+    assert create_connection.call_args[0][0] == ("1.2.3.4", 443)
+    assert conn.host == "lol.com"
+
+
+@pytest.mark.parametrize("conn_cls", [_PinnedHTTPConnection, _PinnedHTTPSConnection])
+def test_pinning_skipped_for_proxies(conn_cls):
+    # Connections through a proxy are made to the proxy (it may be a private host)
+    conn = conn_cls("10.0.0.1", 3128, proxy=parse_url("http://10.0.0.1:3128"))
+    with mock.patch.object(urlutils, "validated_ips") as validated_ips:
+        with mock.patch(
+            "urllib3.util.connection.create_connection", return_value=mock.Mock()
+        ) as create_connection:
+            conn._new_conn()
+    validated_ips.assert_not_called()
+    assert create_connection.call_args[0][0] == ("10.0.0.1", 3128)
@@ -1,4 +1,8 @@
 import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
 
 import httpretty
 import requests
@@ -34,3 +38,162 @@ def test_httpsig():
         resp.request.headers,
         resp.request.body,
     )
+
+
+def _signed_request(k):
+    httpretty.register_uri(httpretty.POST, "https://remote-instance.com", body="ok")
+    resp = requests.post(
+        "https://remote-instance.com", json={"ok": 1}, auth=httpsig.HTTPSigAuth(k)
+    )
+    return (
+        resp.request.method,
+        resp.request.path_url,
+        resp.request.headers,
+        resp.request.body,
+    )
+
+
+def _setup_key(back):
+    k = Key("https://lol.com")
+    k.new()
+    back.FETCH_MOCK["https://lol.com#main-key"] = {
+        "publicKey": k.to_dict(),
+        "id": "https://lol.com",
+    }
+    return k
+
+
+@httpretty.activate
+def test_httpsig_key_cache():
+    back = InMemBackend()
+    ap.use_backend(back)
+    httpsig.KEY_CACHE.clear()
+    k = _setup_key(back)
+
+    req = _signed_request(k)
+    with mock.patch.object(back, "fetch_iri", wraps=back.fetch_iri) as fetch_iri:
+        for _ in range(5):
+            assert httpsig.verify_request(*req)
+
+    assert fetch_iri.call_count == 1
+
+
+@httpretty.activate
+def test_httpsig_key_rotation():
+    back = InMemBackend()
+    ap.use_backend(back)
+    httpsig.KEY_CACHE.clear()
+    now = [1000.0]
+    with mock.patch.object(httpsig, "_clock", lambda: now[0]):
+        k = _setup_key(back)
+        assert httpsig.verify_request(*_signed_request(k))
+
+        # Forged signatures don't trigger a refetch of a key fetched recently
+        other = Key("https://lol.com")
+        other.new()
+        forged = _signed_request(other)
+        with mock.patch.object(back, "fetch_iri", wraps=back.fetch_iri) as fetch_iri:
+            for _ in range(5):
+                assert not httpsig.verify_request(*forged)
+                assert httpsig.verify_requests_batch([forged]) == [False]
+        fetch_iri.assert_not_called()
+
+        # The actor rotated its key, the cached one is outdated
+        now[0] += httpsig.KEY_REFRESH_INTERVAL
+        k = _setup_key(back)
+        req = _signed_request(k)
+        with mock.patch.object(back, "fetch_iri", wraps=back.fetch_iri) as fetch_iri:
+            assert httpsig.verify_request(*req)
+            assert httpsig.verify_request(*req)
+            assert not httpsig.verify_request(*forged)
+
+        assert fetch_iri.call_count == 1
+
+
+def test_httpsig_key_fetch_coalescing():
+    back = InMemBackend()
+    ap.use_backend(back)
+    httpsig.KEY_CACHE.clear()
+    _setup_key(back)
+
+    fetch = back.fetch_iri
+
+    def _slow_fetch(iri):
+        time.sleep(0.1)
+        return fetch(iri)
+
+    keys = []
+    with mock.patch.object(back, "fetch_iri", side_effect=_slow_fetch) as fetch_iri:
+        threads = [
+            threading.Thread(
+                target=lambda: keys.append(
+                    httpsig._get_public_key("https://lol.com#main-key")
+                )
+            )
+            for _ in range(5)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    assert fetch_iri.call_count == 1
+    assert len(keys) == 5
+    assert all(key is keys[0] for key in keys)
+
+
+@httpretty.activate
+def test_httpsig_verify_requests_batch():
+    back = InMemBackend()
+    ap.use_backend(back)
+    httpsig.KEY_CACHE.clear()
+    k = _setup_key(back)
+
+    good = _signed_request(k)
+    tampered = good[:3] + (b'{"ok": 2}',)
+    unsigned = ("POST", "/inbox", {}, b"{}")
+
+    batch = [good, tampered, unsigned, good]
+    with mock.patch.object(back, "fetch_iri", wraps=back.fetch_iri) as fetch_iri:
+        assert httpsig.verify_requests_batch(batch) == [True, False, False, True]
+
+    assert fetch_iri.call_count == 1
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        verdicts = httpsig.verify_requests_batch(batch * 10, executor=executor)
+    assert verdicts == [True, False, False, True] * 10
+
+
+@httpretty.activate
+def test_httpsig_sign_once():
+    back = InMemBackend()
+    ap.use_backend(back)
+    httpsig.KEY_CACHE.clear()
+    k = _setup_key(back)
+
+    auth = httpsig.HTTPSigAuth(k)
+    payload = '{"type": "Create"}'
+    reqs = []
+    with mock.patch.object(
+        httpsig, "_body_digest", wraps=httpsig._body_digest
+    ) as body_digest:
+        for i in range(3):
+            url = f"https://remote-instance{i}.com/inbox"
+            httpretty.register_uri(httpretty.POST, url, body="ok")
+            resp = requests.post(
+                url,
+                data=payload,
+                headers={"Content-Type": "application/activity+json"},
+                auth=auth,
+            )
+            reqs.append(
+                (
+                    resp.request.method,
+                    resp.request.path_url,
+                    resp.request.headers,
+                    resp.request.body.encode("utf-8"),
+                )
+            )
+
+    assert body_digest.call_count == 1
+    assert httpsig.verify_requests_batch(reqs) == [True, True, True]
@@ -1,7 +1,12 @@
 import json
 import logging
+from unittest import mock
+
+import pytest
+from pyld import jsonld
 
 from little_boxes import linked_data_sig
+from little_boxes.cache import LRUCache
 from little_boxes.key import Key
 
 logging.basicConfig(level=logging.DEBUG)
@@ -18,3 +23,77 @@ def test_linked_data_sig():
 
     linked_data_sig.generate_signature(doc, k)
     assert linked_data_sig.verify_signature(doc, k)
+
+
+def test_identity_context_bundled():
+    resp = linked_data_sig._load_bundled("https://w3id.org/identity/v1")
+    assert resp["document"]["@context"]["creator"] == {
+        "@id": "dc:creator",
+        "@type": "@id",
+    }
+
+
+def test_linked_data_sig_canonicalization_cache():
+    linked_data_sig.use_canonicalization_cache(LRUCache(maxsize=16))
+    doc = {
+        "@context": {"name": "http://schema.org/name"},
+        "@id": "https://lol.com/note",
+        "name": "Hello",
+        "signature": {"signatureValue": "lol"},
+    }
+    try:
+        with mock.patch.object(
+            linked_data_sig, "_normalize", wraps=linked_data_sig._normalize
+        ) as normalize:
+            h = linked_data_sig._doc_hash(doc)
+            # Same content, different keys order
+            assert linked_data_sig._doc_hash(dict(reversed(list(doc.items())))) == h
+            assert linked_data_sig._doc_hash(dict(doc, name="Hi")) != h
+
+        assert normalize.call_count == 2
+        assert linked_data_sig.CANONICALIZATION_CACHE.stats()["hits"] == 1
+    finally:
+        linked_data_sig.use_canonicalization_cache(LRUCache(maxsize=4096))
+
+
+def test_linked_data_sig_strict_offline():
+    linked_data_sig.use_strict_offline()
+    try:
+        doc = json.loads(DOC)
+        k = Key("https://lol.com")
+        k.new()
+
+        # Only the bundled contexts are needed
+        with mock.patch.dict(linked_data_sig._CACHE, clear=True):
+            with mock.patch.object(linked_data_sig, "LOADER") as loader:
+                linked_data_sig.generate_signature(doc, k)
+                assert linked_data_sig.verify_signature(doc, k)
+        loader.assert_not_called()
+
+        with pytest.raises(jsonld.JsonLdError):
+            linked_data_sig._caching_document_loader("https://lol.com/context")
+    finally:
+        linked_data_sig.use_strict_offline(False)
+
+
+def test_context_cache(tmpdir):
+    now = [1000.0]
+    cache = linked_data_sig.ContextCache(
+        str(tmpdir), max_size=200, ttl=60, clock=lambda: now[0]
+    )
+    doc = {"contextUrl": None, "documentUrl": "https://lol.com/ctx", "document": {}}
+
+    cache.set("https://lol.com/ctx", doc)
+    assert cache.get("https://lol.com/ctx") == doc
+    assert cache.get("https://lol.com/other") is None
+
+    # Expired
+    now[0] += 61
+    assert cache.get("https://lol.com/ctx") is None
+
+    # Size bound, the oldest entries are evicted first
+    for i in range(5):
+        now[0] += 1
+        cache.set(f"https://lol.com/ctx{i}", dict(doc, documentUrl=f"ctx{i}"))
+    assert cache.get("https://lol.com/ctx0") is None
+    assert cache.get("https://lol.com/ctx4") is not None
@@ -1,6 +1,12 @@
 import logging
+from unittest import mock
+
+import pytest
 
 from little_boxes import activitypub as ap
+from little_boxes.blocklist import InMemoryBlocklist
+from little_boxes.cache import LRUCache
+from little_boxes.routing import InMemoryRoutingIndex
 from test_backend import InMemBackend
 
 logging.basicConfig(level=logging.DEBUG)
@@ -763,3 +769,431 @@ def test_little_boxes_follow_and_new_create_note_and_like_and_undo_announce():
             lambda _announce: _assert_eq(_announce.id, undo.get_object().id),
         ),
     )
+
+
+def test_identity_map_fetch_actor_once():
+    back = InMemBackend()
+    ap.use_backend(back)
+
+    me = back.setup_actor("Thomas", "tom")
+    other = back.setup_actor("Thomas", "tom2")
+
+    with mock.patch.object(back, "fetch_iri", wraps=back.fetch_iri) as fetch_iri:
+        with ap.operation() as idmap:
+            f = ap.Follow(actor=me.id, object=other.id)
+            assert f.get_actor() is f.get_actor()
+            assert f.get_object().id == other.id
+            assert f.recipients() == [other.inbox]
+
+        fetched = [call[0][0] for call in fetch_iri.call_args_list]
+        assert sorted(fetched) == sorted([me.id, other.id])
+        assert idmap.misses == 2
+        assert idmap.hits > 0
+
+
+def test_object_cache_shared_across_operations():
+    back = InMemBackend()
+    ap.use_backend(back)
+    cache = LRUCache(maxsize=10)
+    ap.use_object_cache(cache)
+
+    me = back.setup_actor("Thomas", "tom")
+
+    try:
+        with mock.patch.object(back, "fetch_iri", wraps=back.fetch_iri) as fetch_iri:
+            for _ in range(3):
+                with ap.operation():
+                    ap.Follow(actor=me.id, object=me.id).get_actor()
+
+            assert fetch_iri.call_count == 1
+            assert cache.hits > 0
+    finally:
+        ap.use_object_cache(None)
+
+
+def test_object_cache_not_modified_by_parsing():
+    back = InMemBackend()
+    ap.use_backend(back)
+    cache = LRUCache(maxsize=10)
+    ap.use_object_cache(cache)
+
+    me = back.setup_actor("Thomas", "tom")
+    iri = "https://lol.com/create/1"
+    back.FETCH_MOCK[iri] = {
+        "type": "Create",
+        "id": iri,
+        "actor": me.id,
+        "object": {
+            "type": "Note",
+            "id": iri + "/note",
+            "attributedTo": me.id,
+            "content": "hello",
+        },
+    }
+
+    try:
+        with ap.operation() as idmap:
+            create = idmap.get_activity(iri)
+            assert create.to_dict()["object"]["published"]
+            assert "published" not in idmap.lookup(iri)["object"]
+
+        # Neither the cached raw data nor the next operations see the changes
+        assert "published" not in cache.get(iri)["object"]
+        with ap.operation() as idmap:
+            assert "published" not in idmap.fetch(iri)["object"]
+            idmap.fetch(iri)["object"]["content"] = "lol"
+        assert cache.get(iri)["object"]["content"] == "hello"
+        assert "published" not in back.FETCH_MOCK[iri]["object"]
+    finally:
+        ap.use_object_cache(None)
+
+
+def test_actor_delete_invalidates_the_caches():
+    back = InMemBackend()
+    ap.use_backend(back)
+    cache = LRUCache(maxsize=10)
+    index = InMemoryRoutingIndex()
+    ap.use_object_cache(cache)
+    ap.use_routing_index(index)
+
+    me = back.setup_actor("Thomas", "tom")
+    other = back.setup_actor("Thomas", "tom2")
+
+    try:
+        with ap.operation():
+            ap.Follow(actor=other.id, object=me.id).get_actor()
+        assert cache.get(other.id) is not None
+        assert index.get(other.id) is not None
+
+        # The actor is gone, only the cache still knows about it
+        del back.FETCH_MOCK[other.id]
+        delete = ap.Delete(id="https://lol.com/delete/1", actor=other.id, object=other.id)
+        delete.process_from_inbox(me)
+
+        assert cache.get(other.id) is None
+        assert index.get(other.id) is None
+    finally:
+        ap.use_object_cache(None)
+        ap.use_routing_index(None)
+
+
+def test_delivery_plan_dedup_shared_inbox():
+    back = InMemBackend()
+    ap.use_backend(back)
+
+    me = back.setup_actor("Thomas", "tom")
+    followers = []
+    for i in range(5):
+        f = back.setup_actor("Follower", f"follower{i}")
+        if i < 3:
+            # The first 3 followers are on an instance with a shared inbox
+            back.FETCH_MOCK[f.id]["endpoints"] = {
+                "sharedInbox": "https://remote.com/inbox"
+            }
+        followers.append(f.id)
+    back.FOLLOWERS[me.id] = followers + followers
+
+    note = ap.Note(
+        to=[ap.AS_PUBLIC],
+        cc=[me.followers, followers[4], me.followers],
+        attributedTo=me.id,
+        content="Hello",
+    )
+    plan = note.build_create().delivery_plan()
+
+    assert plan.inboxes() == [
+        "https://remote.com/inbox",
+        "https://lol.com/follower3/inbox",
+        "https://lol.com/follower4/inbox",
+    ]
+    assert plan.by_host() == {
+        "remote.com": ["https://remote.com/inbox"],
+        "lol.com": [
+            "https://lol.com/follower3/inbox",
+            "https://lol.com/follower4/inbox",
+        ],
+    }
+    assert plan.covered_actors("https://remote.com/inbox") == followers[:3]
+
+
+def test_activity_compact_representation():
+    back = InMemBackend()
+    ap.use_backend(back)
+    me = back.setup_actor("Thomas", "tom")
+
+    note = ap.Note(attributedTo=me.id, content="hello", to=[ap.AS_PUBLIC])
+    other = ap.Note(attributedTo=me.id, content="hello2", to=[ap.AS_PUBLIC])
+    with pytest.raises(AttributeError):
+        object.__getattribute__(note, "__dict__")
+
+    # The default context is shared, but can be modified once serialized
+    assert note.view()["@context"] is other.view()["@context"]
+    data = note.to_dict()
+    data["@context"][-1]["toot"] = "http://joinmastodon.org/ns#"
+    assert "toot" not in other.to_dict()["@context"][-1]
+
+    # The given context is not modified
+    ctx = [ap.CTX_AS, {"toot": "http://joinmastodon.org/ns#"}]
+    custom = ap.Note(attributedTo=me.id, content="hello", **{"@context": ctx})
+    assert ctx == [ap.CTX_AS, {"toot": "http://joinmastodon.org/ns#"}]
+    assert custom.view()["@context"][-1]["Hashtag"] == "as:Hashtag"
+
+    # Unknown attributes can't be set (they would be lost, or leak into the payload)
+    with pytest.raises(AttributeError):
+        note.foo = "lol"
+    assert "foo" not in note.to_dict()
+
+    with pytest.raises(TypeError):
+        note.view()["content"] = "lol"
+
+
+def test_parse_activity_trusted():
+    back = InMemBackend()
+    ap.use_backend(back)
+    me = back.setup_actor("Thomas", "tom")
+
+    create = ap.Note(
+        attributedTo=me.id, content="hello", to=[ap.AS_PUBLIC]
+    ).build_create()
+    create.outbox_set_id("https://lol.com/outbox/1", "1")
+    stored = create.to_dict()
+
+    with mock.patch.object(back, "fetch_iri", side_effect=Exception("no fetch")):
+        activity = ap.parse_activity(stored, trusted=True)
+        assert isinstance(activity, ap.Create)
+        assert activity.to_dict() == stored
+        note = activity.get_object()
+        assert isinstance(note, ap.Note)
+        assert note.content == "hello"
+
+        # Without trusting the payload, the actor is validated
+        with pytest.raises(ap.BadActivityError):
+            ap.parse_activity(stored)
+
+    with pytest.raises(ap.UnexpectedActivityTypeError):
+        ap.Note.rehydrate(stored)
+
+
+def test_activity_validation_errors():
+    back = InMemBackend()
+    ap.use_backend(back)
+    me = back.setup_actor("Thomas", "tom")
+
+    with pytest.raises(ap.BadActivityError) as exc:
+        ap.parse_activity({"type": "Lol", "id": "https://lol.com/1"})
+    assert exc.value.payload == {
+        "field": "type",
+        "reason": "unsupported_type",
+        "got": "Lol",
+    }
+
+    with pytest.raises(ap.BadActivityError) as exc:
+        ap.Like(object="https://lol.com/1")
+    assert exc.value.to_dict() == {
+        "activity_type": "Like",
+        "field": "actor",
+        "reason": "missing",
+        "message": "missing actor",
+    }
+
+    with pytest.raises(ap.UnexpectedActivityTypeError) as exc:
+        ap.Like(actor=me.id, object={"type": "Person", "id": me.id})
+    assert exc.value.payload["reason"] == "unexpected_type"
+    assert exc.value.payload["got"] == "Person"
+    assert exc.value.payload["allowed"] == ["Note"]
+
+    # Unknown object types are rejected the same way
+    with pytest.raises(ap.UnexpectedActivityTypeError):
+        ap.Like(actor=me.id, object={"type": "Lol", "id": "https://lol.com/1"})
+
+    with pytest.raises(ap.BadActivityError) as exc:
+        ap.Like(actor=me.id, object={"type": "Note"})
+    assert exc.value.payload["reason"] == "missing_id"
+
+    # The object of a new Create has no ID yet
+    create = ap.Create(
+        actor=me.id, object={"type": "Note", "attributedTo": me.id, "content": "hello"}
+    )
+    assert create.get_object().content == "hello"
+
+    with pytest.raises(ap.UnexpectedActivityTypeError) as exc:
+        ap.Like(type="Announce", actor=me.id, object="https://lol.com/1")
+    assert exc.value.payload["field"] == "type"
+
+
+def _likes(actor, count, prefix):
+    out = []
+    for i in range(count):
+        like = ap.Like(actor=actor.id, object="https://lol.com/notes/1")
+        like.outbox_set_id(f"{actor.id}/{prefix}/{i}", str(i))
+        out.append(like)
+    return out
+
+
+def test_inbox_post_many():
+    back = InMemBackend()
+    ap.use_backend(back)
+    me = back.setup_actor("Thomas", "tom")
+    alice = back.setup_actor("Alice", "alice")
+    bob = back.setup_actor("Bob", "bob")
+
+    old = _likes(alice, 1, "old")[0]
+    ap.Inbox(me).post(old)
+    back.called_methods(me)
+
+    activities = _likes(alice, 2, "likes") + _likes(bob, 2, "likes")
+    payloads = [a.to_dict() for a in activities]
+    # Duplicates, within the batch and with the inbox
+    payloads += [payloads[0], old.to_dict()]
+
+    with mock.patch.object(back, "fetch_iri", wraps=back.fetch_iri) as fetch_iri:
+        res = ap.Inbox(me).post_many(payloads)
+    # Once per actor
+    assert [c[0][0] for c in fetch_iri.call_args_list] == [alice.id, bob.id]
+
+    assert [a.id for a in res.saved] == [a.id for a in activities]
+    assert res.duplicates == [payloads[0], old.to_dict()]
+    assert not res.blocked and not res.failed
+    assert [a.id for a in back.DB[me.id]["inbox"]] == [old.id] + [
+        a.id for a in activities
+    ]
+
+    # One blocklist lookup per actor (the backend has no batched hooks)
+    calls = [name for name, *_ in back.called_methods(me)]
+    assert calls.count("outbox_is_blocked") == 2
+    assert calls.count("inbox_new") == 4
+
+
+def test_inbox_post_many_batched_hooks():
+    class BatchBackend(InMemBackend):
+        def outbox_is_blocked(self, as_actor, actor_id):
+            raise AssertionError("not batched")
+
+        def outbox_is_blocked_many(self, as_actor, actor_ids):
+            self.blocked_calls.append(actor_ids)
+            return {bob.id}
+
+        def inbox_get_by_iri(self, as_actor, iri):
+            raise AssertionError("not batched")
+
+        def inbox_get_by_iri_many(self, as_actor, iris):
+            self.get_calls.append(iris)
+            return {iris[0]}
+
+        def inbox_new(self, as_actor, activity):
+            raise AssertionError("not batched")
+
+        def inbox_new_many(self, as_actor, activities):
+            self.new_calls.append(activities)
+
+    back = BatchBackend()
+    back.blocked_calls, back.get_calls, back.new_calls = [], [], []
+    ap.use_backend(back)
+    me = back.setup_actor("Thomas", "tom")
+    alice = back.setup_actor("Alice", "alice")
+    bob = back.setup_actor("Bob", "bob")
+
+    likes = [like.to_dict() for like in _likes(alice, 3, "likes")]
+    blocked = [like.to_dict() for like in _likes(bob, 2, "likes")]
+    invalid = {"type": "Like", "object": "https://lol.com/notes/1"}
+    res = ap.Inbox(me).post_many(blocked[:1] + likes + [invalid] + blocked[1:])
+
+    assert res.blocked == blocked
+    assert res.duplicates == likes[:1]
+    assert [a.id for a in res.saved] == [like["id"] for like in likes[1:]]
+    assert list(res.failed) == [repr(invalid)]
+    assert back.blocked_calls == [[bob.id, alice.id]]
+    assert back.get_calls == [[like["id"] for like in likes]]
+    assert back.new_calls == [res.saved]
+
+
+def test_inbox_post_many_save_errors():
+    back = InMemBackend()
+    ap.use_backend(back)
+    me = back.setup_actor("Thomas", "tom")
+    alice = back.setup_actor("Alice", "alice")
+
+    likes = [like.to_dict() for like in _likes(alice, 3, "likes")]
+    inbox_new = back.inbox_new
+
+    def _inbox_new(as_actor, activity):
+        if activity.id == likes[1]["id"]:
+            raise ValueError("db error")
+        inbox_new(as_actor, activity)
+
+    # The fallback records the failures per activity
+    with mock.patch.object(back, "inbox_new", side_effect=_inbox_new):
+        res = ap.Inbox(me).post_many(likes)
+    assert [a.id for a in res.saved] == [likes[0]["id"], likes[2]["id"]]
+    assert list(res.failed) == [likes[1]["id"]]
+    assert isinstance(res.failed[likes[1]["id"]], ValueError)
+    assert back.DB[me.id]["inbox"] == res.saved
+
+    # A failing batched hook fails the whole batch
+    others = [like.to_dict() for like in _likes(alice, 2, "others")]
+    with mock.patch.object(
+        back, "inbox_new_many", side_effect=ValueError("db error"), create=True
+    ):
+        res = ap.Inbox(me).post_many(others)
+    assert res.saved == []
+    assert list(res.failed) == [like["id"] for like in others]
+    assert len(back.DB[me.id]["inbox"]) == 2
+
+
+def test_inbox_receive_triage():
+    back = InMemBackend()
+    ap.use_backend(back)
+    me = back.setup_actor("Thomas", "tom")
+    other = back.setup_actor("Thomas", "tom2")
+    triage = ap.InboxTriage(max_size=1024)
+    ap.use_inbox_triage(triage)
+    blocklist = InMemoryBlocklist()
+    blocklist.block_domain("spam.com")
+    ap.use_blocklist(blocklist)
+
+    payload = {
+        "type": "Like",
+        "id": "https://lol.com/tom2/likes/1",
+        "actor": other.id,
+        "object": "https://lol.com/notes/1",
+    }
+    drops = [
+        (dict(payload), 4096, ap.DropReason.TOO_LARGE),
+        ("lol", None, ap.DropReason.INVALID),
+        (dict(payload, id=None), None, ap.DropReason.INVALID),
+        (dict(payload, actor=None), None, ap.DropReason.INVALID),
+        (dict(payload, type="EmojiReact"), None, ap.DropReason.UNSUPPORTED_TYPE),
+        (
+            dict(payload, actor="https://spam.com/bob"),
+            None,
+            ap.DropReason.BLOCKED,
+        ),
+    ]
+    try:
+        with mock.patch.object(back, "fetch_iri", side_effect=Exception("no fetch")):
+            for data, size, reason in drops:
+                assert triage.check(me, data, size) == reason
+                assert ap.Inbox(me).receive(data, size) is None
+
+        activity = ap.Inbox(me).receive(payload, 200)
+        assert isinstance(activity, ap.Like)
+        assert ap.Inbox(me).receive(payload) is None
+    finally:
+        ap.use_blocklist(None)
+        ap.use_inbox_triage(ap.InboxTriage())
+
+    assert back.DB[me.id]["inbox"] == [activity]
+    assert triage.stats() == {
+        "too_large": 2,
+        "invalid": 6,
+        "unsupported_type": 2,
+        "blocked": 2,
+        "duplicate": 1,
+        "accepted": 1,
+    }
+
+    # Duplicates are also looked up within the batch
+    reasons = triage.check_many(
+        me, [payload, dict(payload, id="https://lol.com/2")] * 2
+    )
+    assert reasons == [ap.DropReason.DUPLICATE, None] + [ap.DropReason.DUPLICATE] * 2
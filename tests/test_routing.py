@@ -0,0 +1,147 @@
+import logging
+from unittest import mock
+
+import pytest
+
+from little_boxes import activitypub as ap
+from little_boxes.routing import InMemoryRoutingIndex
+from little_boxes.routing import Route
+from little_boxes.routing import SqliteRoutingIndex
+from little_boxes.routing import route_from_actor
+from test_backend import InMemBackend
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def index(request):
+    if request.param == "memory":
+        yield InMemoryRoutingIndex()
+    else:
+        idx = SqliteRoutingIndex(":memory:")
+        yield idx
+        idx.close()
+
+
+def test_route_from_actor():
+    assert route_from_actor({"type": "Note", "id": "https://lol.com/note"}) is None
+    assert route_from_actor({"type": "Person", "id": "https://lol.com/tom"}) is None
+
+    route = route_from_actor(
+        {
+            "type": "Person",
+            "id": "https://lol.com/tom",
+            "inbox": "https://lol.com/tom/inbox",
+            "endpoints": {"sharedInbox": "https://lol.com/inbox"},
+        }
+    )
+    assert route == Route(
+        "https://lol.com/tom/inbox", "https://lol.com/inbox", "lol.com"
+    )
+    assert route.delivery_inbox == "https://lol.com/inbox"
+
+
+def test_routing_index(index):
+    route = Route("https://lol.com/tom/inbox", None, "lol.com")
+    assert index.get("https://lol.com/tom") is None
+
+    index.set("https://lol.com/tom", route)
+    assert index.get("https://lol.com/tom") == route
+    assert index.get_many(["https://lol.com/tom", "https://lol.com/nope"]) == {
+        "https://lol.com/tom": route
+    }
+
+    index.delete("https://lol.com/tom")
+    assert index.get("https://lol.com/tom") is None
+
+
+def test_routing_index_shared_inboxes(index):
+    index.set("https://a.com/tom", Route("https://a.com/tom/inbox", None, "a.com"))
+    assert index.shared_inboxes(["a.com", "b.com"]) == {}
+
+    index.set(
+        "https://a.com/bob",
+        Route("https://a.com/bob/inbox", "https://a.com/inbox", "a.com"),
+    )
+    index.set("https://b.com/bob", Route("https://b.com/bob/inbox", None, "b.com"))
+    assert index.shared_inboxes(["a.com", "b.com"]) == {"a.com": "https://a.com/inbox"}
+
+
+def test_sqlite_routing_index_persistence(tmpdir):
+    path = str(tmpdir.join("routes.db"))
+    route = Route("https://lol.com/tom/inbox", "https://lol.com/inbox", "lol.com")
+    index = SqliteRoutingIndex(path)
+    index.set("https://lol.com/tom", route)
+    index.close()
+
+    index = SqliteRoutingIndex(path)
+    assert index.get("https://lol.com/tom") == route
+    index.close()
+
+
+def test_recipients_use_routing_index(index):
+    back = InMemBackend()
+    ap.use_backend(back)
+    ap.use_routing_index(index)
+
+    try:
+        me = back.setup_actor("Thomas", "tom")
+        followers = [back.setup_actor("Follower", f"follower{i}").id for i in range(3)]
+        back.FOLLOWERS[me.id] = followers
+
+        note = ap.Note(
+            to=[ap.AS_PUBLIC], cc=[me.followers], attributedTo=me.id, content="Hello"
+        )
+        create = note.build_create()
+        expected = [f"{follower}/inbox" for follower in followers]
+
+        # The first resolution warms up the index
+        assert create.recipients() == expected
+        assert index.get(followers[0]) == Route(expected[0], None, "lol.com")
+
+        with mock.patch.object(back, "fetch_iri", wraps=back.fetch_iri) as fetch_iri:
+            assert create.recipients() == expected
+            fetched = [call[0][0] for call in fetch_iri.call_args_list]
+
+        # Only the actor and the followers collection were fetched
+        assert fetched == [me.id, me.followers]
+    finally:
+        ap.use_routing_index(None)
+
+
+def test_routing_index_invalidated_on_update():
+    back = InMemBackend()
+    ap.use_backend(back)
+    index = InMemoryRoutingIndex()
+    ap.use_routing_index(index)
+
+    try:
+        me = back.setup_actor("Thomas", "tom")
+        other = back.setup_actor("Thomas", "tom2")
+        index.update_from_actor(other.to_dict())
+        assert index.get(other.id) is not None
+
+        update = ap.Update(actor=other.id, object=other.to_dict())
+        ap.Inbox(me).post(update)
+
+        assert index.get(other.id) is None
+    finally:
+        ap.use_routing_index(None)
+
+
+def test_routing_index_ignores_spoofed_actor(index):
+    back = InMemBackend()
+    ap.use_backend(back)
+    alice_id = "https://good.com/users/alice"
+    back.FETCH_MOCK["https://evil.com/x"] = {
+        "type": "Person",
+        "id": alice_id,
+        "inbox": "https://evil.com/steal",
+    }
+    ap.use_routing_index(index)
+    try:
+        with ap.operation() as idmap:
+            idmap.fetch("https://evil.com/x")
+        assert index.get(alice_id) is None
+    finally:
+        ap.use_routing_index(None)
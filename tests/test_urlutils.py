@@ -1,3 +1,4 @@
+import socket
 from unittest import mock
 
 import pytest
@@ -27,6 +28,65 @@ def test_urlutils_accept_valid_url(_):
     assert urlutils.is_url_valid("https://microblog.pub")
 
 
+def test_urlutils_validated_ips():
+    infos = [
+        [10, 1, 6, "", ["2001:4860::1", 443, 0, 0]],
+        [2, 1, 6, "", ["1.2.3.4", 443]],
+        [2, 2, 17, "", ["1.2.3.4", 443]],
+    ]
+    urlutils.use_dns_cache(None)
+    try:
+        with mock.patch("socket.getaddrinfo", return_value=infos):
+            assert urlutils.validated_ips("microblog.pub", 443) == [
+                "2001:4860::1",
+                "1.2.3.4",
+            ]
+
+        # A single private address is enough to reject the host
+        with mock.patch(
+            "socket.getaddrinfo", return_value=infos + [[2, 1, 6, "", ["10.0.0.1", 443]]]
+        ):
+            assert urlutils.validated_ips("microblog.pub", 443) == []
+            assert not urlutils.is_url_valid("https://microblog.pub")
+    finally:
+        urlutils.use_dns_cache(urlutils.DNSCache())
+
+
 def test_urlutils_check_url_helper():
     with pytest.raises(urlutils.InvalidURLError):
         urlutils.check_url("http://localhost:5000")
+
+
+def test_urlutils_dns_cache():
+    now = [1000.0]
+    cache = urlutils.DNSCache(ttl=60, negative_ttl=10, clock=lambda: now[0])
+    urlutils.use_dns_cache(cache)
+
+    def getaddrinfo(host, port):
+        if host == "nxdomain.com":
+            raise socket.gaierror("not found")
+        return [[0, 1, 2, 3, ["1.2.3.4", None]]]
+
+    try:
+        with mock.patch("socket.getaddrinfo", side_effect=getaddrinfo) as lookup:
+            assert urlutils.is_url_valid("https://microblog.pub")
+            assert urlutils.is_url_valid("https://Microblog.pub/.well-known/webfinger")
+            assert urlutils.validated_ips("microblog.pub", 443) == ["1.2.3.4"]
+            assert lookup.call_count == 1
+
+            assert not urlutils.is_url_valid("https://nxdomain.com")
+            assert not urlutils.is_url_valid("https://nxdomain.com")
+            assert lookup.call_count == 2
+            assert cache.stats()["hits"] == 3
+            assert cache.stats()["misses"] == 2
+
+            # The negative entries expire first
+            now[0] += 10
+            assert not urlutils.is_url_valid("https://nxdomain.com")
+            assert urlutils.is_url_valid("https://microblog.pub")
+            assert lookup.call_count == 3
+            now[0] += 50
+            assert urlutils.is_url_valid("https://microblog.pub")
+            assert lookup.call_count == 4
+    finally:
+        urlutils.use_dns_cache(urlutils.DNSCache())
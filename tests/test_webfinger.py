@@ -1,12 +1,18 @@
 import json
 import logging
+import threading
+import time
 from unittest import mock
 
 import httpretty
 import pytest
+import requests
 
+from little_boxes import activitypub as ap
 from little_boxes import urlutils
 from little_boxes import webfinger
+from little_boxes.cache import LRUCache
+from test_backend import InMemBackend
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -55,3 +61,155 @@ def test_webfinger(_):
 def test_webfinger_invalid_url():
     with pytest.raises(urlutils.InvalidURLError):
         data = webfinger.webfinger("@dev@localhost:8080")
+
+
+def _resp(status_code, data=None):
+    resp = mock.Mock(status_code=status_code)
+    resp.json.return_value = data
+    return resp
+
+
+def test_normalize_resource():
+    for resource in [
+        "acct:dev@microblog.pub",
+        "@dev@microblog.pub",
+        "dev@Microblog.PUB",
+    ]:
+        assert webfinger.normalize_resource(resource) == (
+            "acct:dev@microblog.pub",
+            "microblog.pub",
+        )
+    assert webfinger.normalize_resource("https://microblog.pub") == (
+        "https://microblog.pub",
+        "microblog.pub",
+    )
+
+
+@mock.patch("little_boxes.webfinger.check_url", return_value=None)
+def test_webfinger_cache(_):
+    now = [1000.0]
+    back = InMemBackend()
+    ap.use_backend(back)
+    webfinger.use_webfinger_cache(LRUCache(ttl=3600, clock=lambda: now[0]))
+
+    def fetch_json(url, params):
+        if url.startswith("https://down.com"):
+            raise requests.ConnectionError("down")
+        if params["resource"] == "acct:dev@microblog.pub":
+            return _resp(200, _WEBFINGER_RESP)
+        return _resp(404)
+
+    try:
+        with mock.patch.object(back, "fetch_json", side_effect=fetch_json) as fetch:
+            assert webfinger.webfinger("@dev@microblog.pub") == _WEBFINGER_RESP
+            assert webfinger.webfinger("acct:dev@Microblog.pub") == _WEBFINGER_RESP
+            assert (
+                webfinger.get_actor_url("dev@microblog.pub") == "https://microblog.pub"
+            )
+            assert fetch.call_count == 1
+
+            # Negative caching
+            assert webfinger.webfinger("@nobody@microblog.pub") is None
+            assert webfinger.webfinger("@nobody@microblog.pub") is None
+            assert fetch.call_count == 2
+            assert webfinger.get_actor_url("@dev@down.com") is None
+            assert webfinger.get_actor_url("@dev@down.com") is None
+            # Tried both https and http
+            assert fetch.call_count == 4
+
+            now[0] += webfinger.NEGATIVE_TTL
+            assert webfinger.webfinger("@nobody@microblog.pub") is None
+            assert webfinger.webfinger("@dev@microblog.pub") == _WEBFINGER_RESP
+            assert fetch.call_count == 5
+    finally:
+        webfinger.use_webfinger_cache(None)
+
+
+@mock.patch("little_boxes.webfinger.check_url", return_value=None)
+def test_webfinger_resolve_many(_):
+    back = InMemBackend()
+    ap.use_backend(back)
+    calls = []
+    lock = threading.Lock()
+    in_flight = {}
+    max_in_flight = {}
+
+    def fetch_json(url, params):
+        host = url.split("/")[2]
+        with lock:
+            calls.append(url.split("/.well-known")[0])
+            in_flight[host] = in_flight.get(host, 0) + 1
+            max_in_flight[host] = max(max_in_flight.get(host, 0), in_flight[host])
+        try:
+            time.sleep(0.01)
+            if host == "down.com" or url.startswith("https://http-only.com"):
+                raise requests.ConnectionError(f"{url} is down")
+            if params["resource"] == "acct:nobody@a.com":
+                return _resp(404)
+            if params["resource"] == "acct:broken@a.com":
+                resp = _resp(500)
+                resp.raise_for_status.side_effect = requests.HTTPError("500")
+                return resp
+            return _resp(200, {"subject": params["resource"]})
+        finally:
+            with lock:
+                in_flight[host] -= 1
+
+    resources = [f"@user{i}@a.com" for i in range(10)]
+    resources += ["acct:user0@A.com", "@nobody@a.com", "@broken@a.com"]
+    resources += [f"@user{i}@http-only.com" for i in range(5)]
+    resources += [f"@user{i}@down.com" for i in range(5)]
+    resources += ["invalid"]
+
+    with mock.patch.object(back, "fetch_json", side_effect=fetch_json):
+        results = webfinger.resolve_many(resources, per_host=2)
+
+    assert len(results.found) == 16
+    assert results.found["acct:user0@A.com"] == {"subject": "acct:user0@a.com"}
+    assert results.not_found == ["@nobody@a.com"]
+    assert sorted(results.failed) == sorted(
+        ["@broken@a.com", "invalid"] + [f"@user{i}@down.com" for i in range(5)]
+    )
+
+    # Each resource is resolved once, and only the first one of the http-only host tried https
+    assert calls.count("https://a.com") == 12
+    assert calls.count("https://http-only.com") == 1
+    assert calls.count("http://http-only.com") == 5
+    # The unreachable host is only tried once
+    assert calls.count("https://down.com") == calls.count("http://down.com") == 1
+    assert max(max_in_flight.values()) <= 2
+
+
+@mock.patch("little_boxes.webfinger.check_url", return_value=None)
+def test_webfinger_remembers_proto(_):
+    now = [1000.0]
+    back = InMemBackend()
+    ap.use_backend(back)
+    webfinger.use_webfinger_cache(LRUCache(ttl=3600, clock=lambda: now[0]))
+    calls = []
+
+    def fetch_json(url, params):
+        calls.append(url.split("/.well-known")[0])
+        if url.startswith("https://"):
+            raise requests.ConnectionError(f"{url} is down")
+        return _resp(200, {"subject": params["resource"]})
+
+    try:
+        with mock.patch.object(back, "fetch_json", side_effect=fetch_json):
+            assert webfinger.webfinger("@user0@http-only.com")
+            assert calls == ["https://http-only.com", "http://http-only.com"]
+
+            # The protocol is remembered across the calls
+            results = webfinger.resolve_many(
+                [f"@user{i}@http-only.com" for i in range(1, 4)]
+            )
+            assert len(results.found) == 3
+            assert webfinger.webfinger("@user4@http-only.com")
+            assert calls[2:] == ["http://http-only.com"] * 4
+
+            # But not for long
+            now[0] += webfinger.NEGATIVE_TTL
+            assert webfinger.webfinger("@user5@http-only.com")
+            assert calls[6:] == ["https://http-only.com", "http://http-only.com"]
+    finally:
+        webfinger.use_webfinger_cache(None)